@@ -1,87 +1,230 @@
 from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
+from typing import Optional
 import os
+import json
+import asyncio
 import logging
-from backend.supabase_handler import get_supabase
-supabase = get_supabase()
-from backend.openai_handler import get_openai_client, generate_response
-from backend.prompt_engine import PromptEngine
-from modules.memory_system import MemorySystem
+from backend.supabase_handler import get_async_supabase
+supabase = get_async_supabase()
+from backend.openai_handler import get_openai_client, generate_response, stream_response
+from backend.prompt_engine import PromptEngine, get_personality_cache
+from backend.write_pipeline import get_write_pipeline
+from backend.request_coalescing import get_single_flight, get_conversation_locks
+from modules.memory_system import MemorySystem, TurnEmbeddings
+from modules.memory_ranking import get_access_tracker
+from modules.memory_compaction import get_compaction_engine
+from modules.token_budget import count_tokens, tokenizer_name
+from modules.response_cache import get_response_cache, fingerprint
 
 router = APIRouter()
 logger = logging.getLogger("chat_router")
 
+# 生成回應前各個讀取階段的逾時（秒），逾時就降級為空內容繼續回應
+PERSONALITY_TIMEOUT = float(os.getenv("CHAT_PERSONALITY_TIMEOUT", "2"))
+RECALL_TIMEOUT = float(os.getenv("CHAT_RECALL_TIMEOUT", "3"))
+HISTORY_TIMEOUT = float(os.getenv("CHAT_HISTORY_TIMEOUT", "2"))
+
 class ChatRequest(BaseModel):
     user_message: str
     conversation_id: str
     user_id: str = "default_user"
+    # 前端每次送出時產生的 id；重試時沿用，用來合併重複送出的請求
+    client_request_id: Optional[str] = None
 
 class ChatResponse(BaseModel):
     assistant_message: str
     emotion_analysis: dict
     conversation_id: str
+    metadata: dict = {}
 
-@router.post("/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest):
-    try:
-        logger.info(f"🟢 接收到聊天請求，conversation_id: {request.conversation_id}")
-        openai_client = get_openai_client()
-        memories_table = os.getenv("SUPABASE_MEMORIES_TABLE", "xiaochenguang_memories")
+def _create_turn(request: ChatRequest):
+    """建立本輪對話所需的記憶系統與 prompt 引擎"""
+    openai_client = get_openai_client()
+    memories_table = os.getenv("SUPABASE_MEMORIES_TABLE", "xiaochenguang_memories")
 
-        memory_system = MemorySystem(supabase, openai_client, memories_table)
-        prompt_engine = PromptEngine(request.conversation_id, memories_table)
+    access_tracker = get_access_tracker(supabase, submit=get_write_pipeline().submit)
+    memory_system = MemorySystem(supabase, openai_client, memories_table, access_tracker=access_tracker)
+    prompt_engine = PromptEngine(request.conversation_id, memories_table)
+    turn = TurnEmbeddings(request.user_message)
+    return openai_client, memory_system, prompt_engine, turn
 
-        recalled_memories = await memory_system.recall_memories(
-            request.user_message,
-            request.conversation_id
-        )
-        logger.debug(f"🧠 回憶資料：{recalled_memories}")
+async def _with_timeout(stage: str, coro, timeout: float, default=None):
+    """執行單一讀取階段；逾時或失敗時回傳預設值，不讓整個請求失敗"""
+    try:
+        return await asyncio.wait_for(coro, timeout)
+    except asyncio.TimeoutError:
+        logger.warning(f"⏱️ {stage} 逾時（{timeout}s），略過此階段")
+    except Exception:
+        logger.exception(f"❌ {stage} 失敗，略過此階段")
+    return default
 
-        conversation_history = memory_system.get_conversation_history(
-            request.conversation_id,
-            limit=5
+async def _prepare_messages(request: ChatRequest, memory_system: MemorySystem, prompt_engine: PromptEngine,
+                            turn: TurnEmbeddings, emotion_analysis: dict = None):
+    """同時載入個性、召回記憶與歷史，組出送給模型的 messages"""
+    _, recalled_memories, conversation_history, conversation_summary = await asyncio.gather(
+        _with_timeout(
+            "load_personality",
+            prompt_engine.load_personality(),
+            PERSONALITY_TIMEOUT
+        ),
+        _with_timeout(
+            "recall_memories",
+            memory_system.recall_memories(request.user_message, request.conversation_id, turn=turn),
+            RECALL_TIMEOUT,
+            ""
+        ),
+        _with_timeout(
+            "conversation_history",
+            memory_system.get_conversation_history(request.conversation_id, limit=5),
+            HISTORY_TIMEOUT,
+            ""
+        ),
+        _with_timeout(
+            "conversation_summary",
+            memory_system.get_conversation_summary(request.conversation_id),
+            HISTORY_TIMEOUT,
+            ""
         )
-        logger.debug(f"📜 對話歷史：{conversation_history}")
+    )
+    logger.debug(f"🧠 回憶資料：{recalled_memories}")
+    logger.debug(f"📜 對話歷史：{conversation_history}")
 
-        messages, emotion_analysis = prompt_engine.build_prompt(
-            request.user_message,
-            recalled_memories,
-            conversation_history
-        )
+    return prompt_engine.build_prompt(
+        request.user_message,
+        recalled_memories,
+        conversation_history,
+        emotion_analysis=emotion_analysis,
+        conversation_summary=conversation_summary
+    )
 
-        assistant_message = await generate_response(
-            openai_client,
-            messages,
-            model="gpt-4o-mini",
-            max_tokens=1000,
-            temperature=0.8
-        )
+async def _persist_turn(request: ChatRequest, memory_system: MemorySystem, prompt_engine: PromptEngine,
+                        turn: TurnEmbeddings, assistant_message: str, emotion_analysis: dict):
+    """把本輪記憶、情緒狀態與個性變化排入背景寫入管線"""
+    pipeline = get_write_pipeline()
 
-        await memory_system.save_memory(
-            request.conversation_id,
-            request.user_message,
-            assistant_message,
-            emotion_analysis,
-            ai_id=os.getenv("AI_ID", "xiaochenguang_v1")
-        )
+    await pipeline.submit(
+        "save_memory",
+        memory_system.save_memory,
+        request.conversation_id,
+        request.user_message,
+        assistant_message,
+        emotion_analysis,
+        ai_id=os.getenv("AI_ID", "xiaochenguang_v1"),
+        turn=turn
+    )
 
-        await memory_system.save_emotional_state(
-            request.user_id,
-            emotion_analysis,
-            context=request.user_message
-        )
+    await pipeline.submit(
+        "save_emotional_state",
+        memory_system.save_emotional_state,
+        request.user_id,
+        emotion_analysis,
+        context=request.user_message
+    )
 
-        prompt_engine.personality_engine.learn_from_interaction(
-            request.user_message,
-            assistant_message,
-            emotion_analysis
-        )
-        prompt_engine.personality_engine.save_personality()
+    compaction_engine = get_compaction_engine(
+        supabase, memory_system.memories_table, memory_system.openai_client,
+        indexes=(memory_system.vector_index, memory_system.lexical_index)
+    )
+    if compaction_engine is not None:
+        compaction_engine.note_turn(request.conversation_id)
+
+    prompt_engine.personality_engine.learn_from_interaction(
+        request.user_message,
+        assistant_message,
+        emotion_analysis
+    )
+    if prompt_engine.personality_engine.loaded:
+        await get_personality_cache().mark_dirty(prompt_engine.personality_engine)
+
+def _cache_bucket(route: str, request: ChatRequest, prompt_engine: PromptEngine, emotion_analysis: dict) -> tuple:
+    """快取分桶包含 conversation_id：回覆是依該對話的記憶與歷史生成的，不能給其他對話使用"""
+    emotion_style = prompt_engine.emotion_detector.get_emotion_response_style(emotion_analysis)
+    return (route, request.conversation_id, fingerprint(prompt_engine.persona_prompt()), emotion_style["tone"])
+
+async def _load_personality(prompt_engine: PromptEngine):
+    """命中快取時不會經過 _prepare_messages，仍需載入個性，_persist_turn 的學習結果才會保存"""
+    await _with_timeout("load_personality", prompt_engine.load_personality(), PERSONALITY_TIMEOUT)
+
+async def _cached_response(route: str, request: ChatRequest, memory_system: MemorySystem,
+                           prompt_engine: PromptEngine, turn: TurnEmbeddings, emotion_analysis: dict):
+    """查詢回應快取：先完全比對，再以本輪的查詢向量找語意相近的訊息（未命中時召回可直接重用該向量）"""
+    cache = get_response_cache()
+    if not cache.cacheable(route, request.user_message):
+        return None
+    bucket = _cache_bucket(route, request, prompt_engine, emotion_analysis)
+    cached = cache.get(bucket, request.user_message)
+    if cached is None:
+        try:
+            turn.query_embedding = await memory_system.embed(request.user_message)
+        except Exception:
+            logger.exception("❌ 回應快取的 embedding 失敗，只做完全比對")
+        cached = cache.get_similar(bucket, turn.query_embedding)
+    if cached is None:
+        cache.record_miss()
+    return cached
+
+def _store_response(route: str, request: ChatRequest, prompt_engine: PromptEngine, turn: TurnEmbeddings,
+                    emotion_analysis: dict, assistant_message: str):
+    cache = get_response_cache()
+    if cache.cacheable(route, request.user_message):
+        bucket = _cache_bucket(route, request, prompt_engine, emotion_analysis)
+        cache.put(bucket, request.user_message, assistant_message, turn.query_embedding)
+
+def _token_usage(prompt_engine: PromptEngine, assistant_message: str, cached: bool = False) -> dict:
+    """本輪的 token 用量：prompt 各段（本地計算）與回覆長度；命中回應快取時沒有呼叫模型，用量皆為 0"""
+    if cached:
+        return {"tokenizer": tokenizer_name(), "cached": True, "prompt_tokens": 0, "completion_tokens": 0, "sections": {}}
+    return {**prompt_engine.token_usage, "cached": False, "completion_tokens": count_tokens(assistant_message)}
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@router.post("/chat", response_model=ChatResponse)
+async def chat(request: ChatRequest):
+    logger.info(f"🟢 接收到聊天請求，conversation_id: {request.conversation_id}")
+    # 重複送出（同對話、同訊息、同 client_request_id）的請求共用同一次處理結果
+    key = (request.conversation_id, request.user_message, request.client_request_id)
+    return await get_single_flight().run(key, _ordered_chat, request)
+
+async def _ordered_chat(request: ChatRequest) -> ChatResponse:
+    """同一個對話的請求依序處理，不同對話可並行"""
+    async with get_conversation_locks().hold(request.conversation_id):
+        return await _chat(request)
+
+async def _chat(request: ChatRequest) -> ChatResponse:
+    try:
+        openai_client, memory_system, prompt_engine, turn = _create_turn(request)
+        emotion_analysis = prompt_engine.emotion_detector.analyze_emotion(request.user_message)
+
+        # 命中回應快取時略過召回與生成，仍照常寫入記憶
+        assistant_message = await _cached_response("chat", request, memory_system, prompt_engine, turn, emotion_analysis)
+        cache_status = "hit" if assistant_message is not None else "miss"
+        if assistant_message is not None:
+            await _load_personality(prompt_engine)
+        else:
+            messages, _ = await _prepare_messages(request, memory_system, prompt_engine, turn, emotion_analysis)
+
+            assistant_message = await generate_response(
+                openai_client,
+                messages,
+                model="gpt-4o-mini",
+                max_tokens=1000,
+                temperature=0.8
+            )
+            _store_response("chat", request, prompt_engine, turn, emotion_analysis, assistant_message)
+
+        await _persist_turn(request, memory_system, prompt_engine, turn, assistant_message, emotion_analysis)
 
         return ChatResponse(
             assistant_message=assistant_message,
             emotion_analysis=emotion_analysis,
-            conversation_id=request.conversation_id
+            conversation_id=request.conversation_id,
+            metadata={
+                "token_usage": _token_usage(prompt_engine, assistant_message, cached=cache_status == "hit"),
+                "response_cache": cache_status
+            }
         )
 
     except Exception as e:
@@ -90,11 +233,82 @@ async def chat(request: ChatRequest):
         print("🔥 Exception occurred:", traceback_str)
         raise HTTPException(status_code=500, detail=traceback_str)
 
-   
+# 進行中的串流生成 task（保留參照，避免客戶端斷線後被回收）
+_stream_tasks = set()
 
+async def _stream_turn(request: ChatRequest, openai_client, memory_system: MemorySystem, prompt_engine: PromptEngine,
+                       turn: TurnEmbeddings, emotion_analysis: dict, events: asyncio.Queue):
+    """生成回覆並把 SSE 事件放入 events（最後放 None）；生成完成後一定會寫入本輪記憶"""
+    parts = []
+    try:
+        async with get_conversation_locks().hold(request.conversation_id):
+            cached = await _cached_response("chat_stream", request, memory_system, prompt_engine, turn, emotion_analysis)
+            if cached is not None:
+                parts.append(cached)
+                events.put_nowait(_sse("delta", {"content": cached}))
+                await _load_personality(prompt_engine)
+            else:
+                messages, _ = await _prepare_messages(request, memory_system, prompt_engine, turn, emotion_analysis)
+                async for delta in stream_response(
+                    openai_client,
+                    messages,
+                    model="gpt-4o-mini",
+                    max_tokens=1000,
+                    temperature=0.8
+                ):
+                    parts.append(delta)
+                    events.put_nowait(_sse("delta", {"content": delta}))
 
+        assistant_message = "".join(parts)
+        if cached is None:
+            _store_response("chat_stream", request, prompt_engine, turn, emotion_analysis, assistant_message)
+        events.put_nowait(_sse("done", {
+            "conversation_id": request.conversation_id,
+            "metadata": {
+                "token_usage": _token_usage(prompt_engine, assistant_message, cached=cached is not None),
+                "response_cache": "hit" if cached is not None else "miss"
+            }
+        }))
+    except Exception as e:
+        logger.exception("❌ 串流聊天失敗")
+        events.put_nowait(_sse("error", {"detail": str(e)}))
+        return
+    finally:
+        events.put_nowait(None)
 
+    # 回應送完後才排入寫入工作，不影響首字延遲
+    await _persist_turn(request, memory_system, prompt_engine, turn, assistant_message, emotion_analysis)
 
+@router.post("/chat/stream")
+async def chat_stream(request: ChatRequest):
+    """以 SSE 逐段回傳模型輸出：emotion → delta... → done（或 error）"""
+    logger.info(f"🟢 接收到串流聊天請求，conversation_id: {request.conversation_id}")
+    try:
+        openai_client, memory_system, prompt_engine, turn = _create_turn(request)
+    except Exception as e:
+        logger.exception("❌ 初始化串流聊天失敗")
+        raise HTTPException(status_code=500, detail=str(e))
 
+    async def event_stream():
+        # 情緒分析只需本地計算，先送出讓前端立即有回饋
+        emotion_analysis = prompt_engine.emotion_detector.analyze_emotion(request.user_message)
+        yield _sse("emotion", {
+            "emotion_analysis": emotion_analysis,
+            "conversation_id": request.conversation_id
+        })
 
+        # 生成與寫入在獨立的 task 中進行；客戶端斷線只會取消這個 generator，不影響記憶寫入
+        events = asyncio.Queue()
+        task = asyncio.ensure_future(
+            _stream_turn(request, openai_client, memory_system, prompt_engine, turn, emotion_analysis, events)
+        )
+        _stream_tasks.add(task)
+        task.add_done_callback(_stream_tasks.discard)
+        while (event := await events.get()) is not None:
+            yield event
 
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
@@ -0,0 +1,32 @@
+from fastapi import APIRouter, HTTPException
+from starlette.concurrency import run_in_threadpool
+from pydantic import BaseModel
+from typing import List
+import os
+import logging
+from modules.emotion_detector import EnhancedEmotionDetector
+
+router = APIRouter()
+logger = logging.getLogger("emotion_router")
+
+# 單次請求可分析的最大筆數
+EMOTION_BATCH_MAX_TEXTS = int(os.getenv("EMOTION_BATCH_MAX_TEXTS", "100000"))
+
+emotion_detector = EnhancedEmotionDetector()
+
+class EmotionBatchRequest(BaseModel):
+    texts: List[str]
+
+@router.post("/emotions/analyze")
+async def analyze_emotions(request: EmotionBatchRequest):
+    if len(request.texts) > EMOTION_BATCH_MAX_TEXTS:
+        raise HTTPException(status_code=413, detail=f"一次最多分析 {EMOTION_BATCH_MAX_TEXTS} 筆")
+    try:
+        logger.info(f"🔍 批次情感分析：{len(request.texts)} 筆")
+        # 計算密集，移到執行緒中避免阻塞事件迴圈
+        results = await run_in_threadpool(emotion_detector.analyze_emotions_batch, request.texts)
+        return {"results": results}
+
+    except Exception as e:
+        logger.exception("❌ 批次情感分析失敗")
+        raise HTTPException(status_code=500, detail=str(e))
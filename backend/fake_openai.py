@@ -0,0 +1,100 @@
+# backend/fake_openai.py - 本機假 OpenAI 服務，用來離線壓測併發能力
+#
+# 啟動：uvicorn backend.fake_openai:app --port 9000
+# 後端：OPENAI_BASE_URL=http://127.0.0.1:9000/v1 OPENAI_API_KEY=fake uvicorn main:app
+
+import os
+import time
+import random
+import asyncio
+import json
+import hashlib
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+# 模擬模型延遲（秒），預設接近真實 gpt-4o-mini 的回應時間
+FAKE_CHAT_LATENCY = float(os.getenv("FAKE_OPENAI_CHAT_LATENCY", "1.5"))
+FAKE_EMBEDDING_LATENCY = float(os.getenv("FAKE_OPENAI_EMBEDDING_LATENCY", "0.2"))
+# 串流模式下第一個 token 前的延遲與每個 token 之間的間隔（秒）
+FAKE_FIRST_TOKEN_LATENCY = float(os.getenv("FAKE_OPENAI_FIRST_TOKEN_LATENCY", "0.3"))
+FAKE_TOKEN_INTERVAL = float(os.getenv("FAKE_OPENAI_TOKEN_INTERVAL", "0.02"))
+FAKE_EMBEDDING_DIMENSIONS = 1536
+
+app = FastAPI()
+
+def fake_embedding(text: str, dimensions: int = FAKE_EMBEDDING_DIMENSIONS) -> list:
+    """依文字雜湊產生固定的單位向量（相同文字永遠得到相同向量）"""
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "big")
+    rng = random.Random(seed)
+    vector = [rng.gauss(0.0, 1.0) for _ in range(dimensions)]
+    norm = sum(v * v for v in vector) ** 0.5 or 1.0
+    return [v / norm for v in vector]
+
+def fake_reply(messages: list) -> str:
+    user_message = messages[-1].get("content", "") if messages else ""
+    return f"嘿嘿～我聽到你說「{user_message[:50]}」了，小光一直都在喔 ✨"
+
+async def stream_chunks(completion_id: str, model: str, reply: str):
+    await asyncio.sleep(FAKE_FIRST_TOKEN_LATENCY)
+    for char in reply:
+        chunk = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": {"content": char}, "finish_reason": None}]
+        }
+        yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+        await asyncio.sleep(FAKE_TOKEN_INTERVAL)
+    final = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]
+    }
+    yield f"data: {json.dumps(final)}\n\n"
+    yield "data: [DONE]\n\n"
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    data = await request.json()
+    completion_id = f"chatcmpl-fake-{time.time_ns()}"
+    reply = fake_reply(data.get("messages", []))
+    if data.get("stream"):
+        return StreamingResponse(
+            stream_chunks(completion_id, data.get("model", "gpt-4o-mini"), reply),
+            media_type="text/event-stream"
+        )
+
+    await asyncio.sleep(FAKE_CHAT_LATENCY)
+    return {
+        "id": completion_id,
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": data.get("model", "gpt-4o-mini"),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": reply},
+            "finish_reason": "stop"
+        }],
+        "usage": {"prompt_tokens": 0, "completion_tokens": len(reply), "total_tokens": len(reply)}
+    }
+
+@app.post("/v1/embeddings")
+async def embeddings(request: Request):
+    data = await request.json()
+    await asyncio.sleep(FAKE_EMBEDDING_LATENCY)
+    inputs = data.get("input", [])
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    dimensions = data.get("dimensions") or FAKE_EMBEDDING_DIMENSIONS
+    return {
+        "object": "list",
+        "data": [
+            {"object": "embedding", "index": i, "embedding": fake_embedding(text, dimensions)}
+            for i, text in enumerate(inputs)
+        ],
+        "model": data.get("model", "text-embedding-3-small"),
+        "usage": {"prompt_tokens": 0, "total_tokens": 0}
+    }
@@ -1,27 +1,123 @@
-from fastapi import APIRouter, UploadFile, File, HTTPException
-from backend.supabase_handler import get_supabase
-supabase = get_supabase()
+import os
+from typing import Optional
+from contextlib import aclosing
+from fastapi import APIRouter, Request, HTTPException
+from starlette.datastructures import UploadFile
+from starlette.formparsers import MultiPartParser, MultiPartException
+from backend.supabase_handler import get_async_supabase
+from backend.openai_handler import get_openai_client
+from backend.write_pipeline import get_write_pipeline
+from modules.file_handler import (
+    MAX_UPLOAD_BYTES, UploadTooLarge, hash_fileobj, limit_stream, spool_stream, storage_path, upload_fileobj,
+    guess_content_type
+)
+from modules.memory_system import MemorySystem
+from modules.document_ingestion import can_ingest, extract_text, get_document_ingestor
+supabase = get_async_supabase()
 import logging
 router = APIRouter()
 logger = logging.getLogger("file_upload")
 
-@router.post("/upload")
-async def upload_file(file: UploadFile = File(...)):
-    try:
-        file_bytes = await file.read()
-        file_name = file.filename
+UPLOAD_BUCKET = os.getenv("SUPABASE_UPLOAD_BUCKET", "uploads")
+# multipart 表單除了檔案本身以外的欄位與邊界字串
+MULTIPART_OVERHEAD = 64 * 1024
 
-        # ✅ 上傳到 Supabase Storage（你的 bucket 名稱是 uploads）
-        response = supabase.storage.from_("uploads").upload(file_name, file_bytes)
+def _check_content_length(request: Request, limit: int):
+    """讀取 body 之前先以 Content-Length 擋掉過大的請求"""
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > limit:
+        raise HTTPException(status_code=413, detail=f"檔案超過 {MAX_UPLOAD_BYTES} bytes 上限")
 
-        if response.get("error"):
-            logger.error(f"Upload failed: {response['error']['message']}")
-            raise HTTPException(status_code=500, detail="Upload failed")
+async def _parse_form(request: Request):
+    """解析 multipart 表單；邊收邊計算大小，沒有 Content-Length（chunked）的請求也會在超過上限時立即中止"""
+    if not request.headers.get("content-type", "").startswith("multipart/form-data"):
+        raise HTTPException(status_code=400, detail="請以 multipart/form-data 上傳，或改用 PUT /upload/stream/{file_name}")
+    async with aclosing(limit_stream(request.stream(), MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD)) as stream:
+        try:
+            return await MultiPartParser(request.headers, stream).parse()
+        except MultiPartException as e:
+            raise HTTPException(status_code=400, detail=e.message)
+        except UploadTooLarge:
+            # 上限包含表單的額外位元組，訊息只顯示檔案上限
+            raise UploadTooLarge(f"檔案超過 {MAX_UPLOAD_BYTES} bytes 上限")
 
-        return {"message": "File uploaded successfully", "filename": file_name}
+async def _store(fileobj, digest: str, size: int, file_name: str) -> dict:
+    """在執行緒池中上傳（相同內容已存在時跳過）"""
+    path = storage_path(digest, file_name)
+    deduplicated = await supabase.run(
+        upload_fileobj, supabase.client, UPLOAD_BUCKET, path, fileobj, size, guess_content_type(file_name)
+    )
+    logger.info(f"✅ 上傳完成：{file_name} -> {path}（{size} bytes{'，內容重複略過' if deduplicated else ''}）")
+    return {
+        "message": "File uploaded successfully",
+        "filename": file_name,
+        "file_name": file_name,
+        "path": path,
+        "sha256": digest,
+        "size": size,
+        "deduplicated": deduplicated
+    }
 
+async def _schedule_ingestion(fileobj, file_name: str, conversation_id: Optional[str]) -> str:
+    """有 conversation_id 且格式支援時，取出文字後交給背景管線切塊、embedding 並寫入記憶"""
+    if not conversation_id or not can_ingest(file_name):
+        return "skipped"
+    try:
+        ingestor = get_document_ingestor() or get_document_ingestor(MemorySystem(
+            supabase, get_openai_client(), os.getenv("SUPABASE_MEMORIES_TABLE", "xiaochenguang_memories")
+        ))
+        text = await supabase.run(extract_text, file_name, fileobj)
+        if not text or not text.strip():
+            return "skipped"
+        await get_write_pipeline().submit(f"ingest_document:{file_name}", ingestor.ingest, conversation_id, file_name, text)
+        return "queued"
+    except Exception as e:
+        # 上傳本身已成功，匯入失敗不影響回應
+        logger.error(f"Ingestion error: {str(e)}")
+        return "failed"
+
+@router.post("/upload")
+async def upload_file(request: Request):
+    """multipart 上傳（欄位名稱 file）；表單解析時檔案已由 Starlette 暫存，這裡分塊計算雜湊後上傳。
+
+    物件以內容雜湊命名（回應中的 path），不再以原始檔名存放；原始檔名在 filename / file_name。
+    """
+    _check_content_length(request, MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD)
+    try:
+        form = await _parse_form(request)
+        file = form.get("file")
+        if not isinstance(file, UploadFile):
+            raise HTTPException(status_code=400, detail="缺少 file 欄位")
+        try:
+            digest, size = await supabase.run(hash_fileobj, file.file)
+            result = await _store(file.file, digest, size, file.filename)
+            result["ingestion"] = await _schedule_ingestion(file.file, file.filename, form.get("conversation_id"))
+            return result
+        finally:
+            await form.close()
+
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Upload error: {str(e)}")
         raise HTTPException(status_code=500, detail="Upload failed")
 
+@router.put("/upload/stream/{file_name}")
+async def upload_stream(file_name: str, request: Request, conversation_id: Optional[str] = None):
+    """以原始 body 串流上傳：邊收邊寫入暫存檔並計算雜湊，超過上限立即中止"""
+    _check_content_length(request, MAX_UPLOAD_BYTES)
+    try:
+        spool, digest, size = await spool_stream(request.stream())
+        with spool:
+            file_name = os.path.basename(file_name)
+            result = await _store(spool, digest, size, file_name)
+            result["ingestion"] = await _schedule_ingestion(spool, file_name, conversation_id)
+            return result
 
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except Exception as e:
+        logger.error(f"Upload error: {str(e)}")
+        raise HTTPException(status_code=500, detail="Upload failed")
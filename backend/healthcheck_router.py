@@ -3,6 +3,15 @@ from starlette.responses import JSONResponse
 import os
 import traceback
 from supabase import create_client, Client
+from backend.write_pipeline import get_write_pipeline
+from modules.embedding_cache import get_embedding_cache
+from modules.vector_index import get_vector_index
+from modules.lexical_index import get_lexical_index
+from modules.memory_ranking import get_access_tracker
+from modules.memory_compaction import get_compaction_engine
+from modules.response_cache import get_response_cache
+from modules.document_ingestion import get_document_ingestor
+from backend.request_coalescing import get_single_flight, get_conversation_locks
 
 router = APIRouter()
 
@@ -66,3 +75,21 @@ def health_check():
         result["error_log"].append(f"Chat API error: {traceback.format_exc()}")
 
     return JSONResponse(content=result)
+
+@router.get("/health/metrics")
+def metrics():
+    """背景寫入管線與快取的運作指標"""
+    from backend.prompt_engine import get_personality_cache
+    return {
+        "write_pipeline": get_write_pipeline().get_metrics(),
+        "personality_cache": get_personality_cache().get_metrics(),
+        "embedding_cache": get_embedding_cache().get_metrics(),
+        "vector_index": get_vector_index().get_metrics() if get_vector_index() else {"enabled": False},
+        "lexical_index": get_lexical_index().get_metrics() if get_lexical_index() else {},
+        "access_tracker": get_access_tracker().get_metrics() if get_access_tracker() else {},
+        "compaction": get_compaction_engine().get_metrics() if get_compaction_engine() else {"enabled": False},
+        "response_cache": get_response_cache().get_metrics(),
+        "document_ingestion": get_document_ingestor().get_metrics() if get_document_ingestor() else {},
+        "chat_single_flight": get_single_flight().get_metrics(),
+        "conversation_locks": get_conversation_locks().get_metrics()
+    }
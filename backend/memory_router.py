@@ -1,63 +1,184 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional
 import os
+import json
+import base64
+import hashlib
 import logging
-from backend.supabase_handler import get_supabase
-supabase = get_supabase()
+from datetime import datetime
+from backend.supabase_handler import get_async_supabase
+supabase = get_async_supabase()
 router = APIRouter()
 logger = logging.getLogger("memory_router")
 
+# 單次查詢筆數上限（超過時自動截到上限）
+MEMORY_LIST_MAX_LIMIT = int(os.getenv("MEMORY_LIST_MAX_LIMIT", "100"))
+# NDJSON 匯出時每次向資料庫取的筆數
+MEMORY_EXPORT_PAGE_SIZE = int(os.getenv("MEMORY_EXPORT_PAGE_SIZE", "500"))
+
+# 可透過 fields 參數選取的欄位；id 與排序欄位一定會回傳（分頁游標需要）
+MEMORY_FIELDS = ("id", "user_message", "assistant_message", "created_at", "importance_score",
+                 "access_count", "memory_type", "file_name", "message_type")
+MEMORY_DEFAULT_FIELDS = ("id", "user_message", "assistant_message", "created_at", "importance_score", "access_count")
+EMOTION_FIELDS = ("id", "user_id", "emotion_type", "intensity", "context", "timestamp")
+
 class MemoryItem(BaseModel):
     id: int
-    user_message: str
-    assistant_message: str
-    created_at: str
+    user_message: Optional[str] = None
+    assistant_message: Optional[str] = None
+    created_at: Optional[str] = None
     importance_score: Optional[float] = None
     access_count: Optional[int] = None
+    memory_type: Optional[str] = None
+    file_name: Optional[str] = None
+    message_type: Optional[str] = None
+
+def _memories_table() -> str:
+    return os.getenv("SUPABASE_MEMORIES_TABLE", "xiaochenguang_memories")
+
+def _select_fields(fields: Optional[str], allowed: tuple, default: tuple, required: tuple) -> str:
+    """解析逗號分隔的 fields 參數，只接受白名單內的欄位"""
+    requested = [f.strip() for f in fields.split(",") if f.strip()] if fields else list(default)
+    unknown = [f for f in requested if f not in allowed]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"不支援的欄位：{', '.join(unknown)}")
+    selected = list(required) + [f for f in requested if f not in required]
+    return ", ".join(selected)
+
+def _clamp_limit(limit: int) -> int:
+    return max(1, min(limit, MEMORY_LIST_MAX_LIMIT))
+
+def encode_cursor(row: dict, column: str) -> str:
+    """以最後一筆的 (排序欄位, id) 作為下一頁游標"""
+    raw = json.dumps([row[column], row["id"]], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
 
-@router.get("/memories/{conversation_id}", response_model=List[MemoryItem])
-async def get_memories(conversation_id: str, limit: int = 20):
+def decode_cursor(cursor: str) -> tuple:
+    """回傳 (排序欄位值, id)；值必須是 ISO 8601 時間或 null，避免把任意字串放進 PostgREST 篩選式"""
     try:
-        logger.info(f"🔍 查詢記憶：conversation_id={conversation_id}, limit={limit}")
-        memories_table = os.getenv("SUPABASE_MEMORIES_TABLE", "xiaochenguang_memories")
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        value, last_id = json.loads(raw)
+        if value is not None:
+            datetime.fromisoformat(value)
+        return value, int(last_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="無效的 cursor")
+
+def _keyset(query, column: str, cursor: Optional[str]):
+    """依 (column DESC NULLS LAST, id DESC) 排序，從游標之後開始取（keyset 分頁，不使用 offset）"""
+    if cursor:
+        value, last_id = decode_cursor(cursor)
+        if value is None:
+            # 排序欄位為 null 的資料排在最後，只剩 id 較小的 null 列
+            query = query.is_(column, "null").lt("id", last_id)
+        else:
+            query = query.or_(
+                f'{column}.lt."{value}",{column}.is.null,and({column}.eq."{value}",id.lt.{last_id})'
+            )
+    return query.order(column, desc=True, nullsfirst=False).order("id", desc=True)
+
+async def _page(query, column: str, cursor: Optional[str], limit: int) -> tuple[list, Optional[str]]:
+    """多取一筆判斷是否還有下一頁，回傳 (資料, 下一頁游標)"""
+    result = await supabase.execute(_keyset(query, column, cursor).limit(limit + 1))
+    rows = result.data or []
+    next_cursor = encode_cursor(rows[limit - 1], column) if len(rows) > limit else None
+    return rows[:limit], next_cursor
 
-        result = supabase.table(memories_table)\
-            .select("id, user_message, assistant_message, created_at, importance_score, access_count")\
-            .eq("conversation_id", conversation_id)\
-            .eq("memory_type", "conversation")\
-            .order("created_at", desc=True)\
-            .limit(limit)\
-            .execute()
+def _conditional(request: Request, response: Response, rows: list, next_cursor: Optional[str]):
+    """設定 ETag 與下一頁游標；內容與 If-None-Match 相同時回傳 304"""
+    body = json.dumps([rows, next_cursor], sort_keys=True, default=str, ensure_ascii=False)
+    etag = f'"{hashlib.sha256(body.encode("utf-8")).hexdigest()[:32]}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
+    if etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
+
+@router.get("/memories/{conversation_id}", response_model=List[MemoryItem], response_model_exclude_unset=True)
+async def get_memories(conversation_id: str, request: Request, response: Response, limit: int = 20,
+                       cursor: Optional[str] = None, fields: Optional[str] = None):
+    """對話記憶列表（新到舊）；下一頁游標放在 X-Next-Cursor 標頭"""
+    select = _select_fields(fields, MEMORY_FIELDS, MEMORY_DEFAULT_FIELDS, ("id", "created_at"))
+    limit = _clamp_limit(limit)
+    try:
+        logger.info(f"🔍 查詢記憶：conversation_id={conversation_id}, limit={limit}")
+        rows, next_cursor = await _page(
+            supabase.table(_memories_table())
+            .select(select)
+            .eq("conversation_id", conversation_id)
+            .eq("memory_type", "conversation"),
+            "created_at", cursor, limit
+        )
 
         logger.info("✅ 記憶查詢成功")
-        return result.data
+        return _conditional(request, response, rows, next_cursor) or rows
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.exception("❌ 讀取記憶失敗")
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.get("/memories/{conversation_id}/export")
+async def export_memories(conversation_id: str, fields: Optional[str] = None, memory_type: str = "conversation"):
+    """以 NDJSON 串流匯出整段對話（舊到新），逐頁讀取，不會一次載入全部資料"""
+    select = _select_fields(fields, MEMORY_FIELDS, MEMORY_FIELDS, ("id",))
+
+    async def stream():
+        last_id, exported = 0, 0
+        try:
+            while True:
+                result = await supabase.execute(
+                    supabase.table(_memories_table())
+                    .select(select)
+                    .eq("conversation_id", conversation_id)
+                    .eq("memory_type", memory_type)
+                    .gt("id", last_id)
+                    .order("id")
+                    .limit(MEMORY_EXPORT_PAGE_SIZE)
+                )
+                rows = result.data or []
+                if rows:
+                    yield "".join(json.dumps(row, ensure_ascii=False, default=str) + "\n" for row in rows)
+                    last_id = rows[-1]["id"]
+                    exported += len(rows)
+                if len(rows) < MEMORY_EXPORT_PAGE_SIZE:
+                    break
+            logger.info(f"✅ 匯出完成：conversation_id={conversation_id}, {exported} 筆")
+        except Exception:
+            # 回應標頭已送出，只能記錄錯誤並結束串流
+            logger.exception("❌ 匯出記憶失敗")
+
+    return StreamingResponse(
+        stream(),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{conversation_id}.ndjson"'}
+    )
+
 @router.get("/emotional-states/{user_id}")
-async def get_emotional_states(user_id: str, limit: int = 10):
+async def get_emotional_states(user_id: str, request: Request, response: Response, limit: int = 10,
+                               cursor: Optional[str] = None, fields: Optional[str] = None):
+    """情緒狀態列表（新到舊）；下一頁游標放在 X-Next-Cursor 標頭"""
+    select = _select_fields(fields, EMOTION_FIELDS, EMOTION_FIELDS, ("id", "timestamp"))
+    limit = _clamp_limit(limit)
     try:
         logger.info(f"🔍 查詢情緒：user_id={user_id}, limit={limit}")
-        result = supabase.table("emotional_states")\
-            .select("*")\
-            .eq("user_id", user_id)\
-            .order("timestamp", desc=True)\
-            .limit(limit)\
-            .execute()
+        rows, next_cursor = await _page(
+            supabase.table("emotional_states")
+            .select(select)
+            .eq("user_id", user_id),
+            "timestamp", cursor, limit
+        )
 
         logger.info("✅ 情緒查詢成功")
-        return result.data
+        return _conditional(request, response, rows, next_cursor) or rows
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.exception("❌ 讀取情緒失敗")
         raise HTTPException(status_code=500, detail=str(e))
-
-
-
-
-
-
-
@@ -1,7 +1,9 @@
 import os
-from openai import OpenAI
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 from dotenv import load_dotenv
 from fastapi import APIRouter, HTTPException, Request
+from modules.response_cache import get_response_cache, fingerprint
 
 # 初始化 FastAPI router
 router = APIRouter()
@@ -13,22 +15,51 @@ load_dotenv()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_ORG_ID = os.getenv("OPENAI_ORG_ID")
 OPENAI_PROJECT_ID = os.getenv("OPENAI_PROJECT_ID")
+# 可指向本機的假 OpenAI 服務（backend/fake_openai.py）做離線壓測
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "100"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
 
-def get_openai_client() -> OpenAI:
-    if not OPENAI_API_KEY:
-        raise ValueError("❌ 缺少 OPENAI_API_KEY 環境變數")
+_openai_client: AsyncOpenAI = None  # 單例變數，整個行程共用同一個連線池
 
-    if OPENAI_ORG_ID:
-        client = OpenAI(api_key=OPENAI_API_KEY, organization=OPENAI_ORG_ID)
-    else:
-        client = OpenAI(api_key=OPENAI_API_KEY)
+def init_openai_client() -> AsyncOpenAI:
+    """建立共用的 AsyncOpenAI 客戶端（啟動時呼叫一次，之後重複使用）"""
+    global _openai_client
+    if _openai_client is None:
+        if not OPENAI_API_KEY:
+            raise ValueError("❌ 缺少 OPENAI_API_KEY 環境變數")
 
-    print("✅ OpenAI 客戶端初始化成功")
-    return client
+        http_client = DefaultAsyncHttpxClient(
+            limits=httpx.Limits(
+                max_connections=OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENAI_MAX_CONNECTIONS
+            )
+        )
+
+        kwargs = {"api_key": OPENAI_API_KEY, "http_client": http_client, "timeout": OPENAI_TIMEOUT}
+        if OPENAI_ORG_ID:
+            kwargs["organization"] = OPENAI_ORG_ID
+        if OPENAI_BASE_URL:
+            kwargs["base_url"] = OPENAI_BASE_URL
+
+        _openai_client = AsyncOpenAI(**kwargs)
+        print("✅ OpenAI 客戶端初始化成功")
+    return _openai_client
+
+def get_openai_client() -> AsyncOpenAI:
+    """獲取共用的 AsyncOpenAI 客戶端實例（單例模式）。"""
+    return init_openai_client()
 
-async def generate_response(client: OpenAI, messages: list, model: str = "gpt-4o-mini", max_tokens: int = 1000, temperature: float = 0.8) -> str:
+async def close_openai_client():
+    """關閉共用客戶端與其連線池（應用關閉時呼叫）"""
+    global _openai_client
+    if _openai_client is not None:
+        await _openai_client.close()
+        _openai_client = None
+
+async def generate_response(client: AsyncOpenAI, messages: list, model: str = "gpt-4o-mini", max_tokens: int = 1000, temperature: float = 0.8) -> str:
     try:
-        response = client.chat.completions.create(
+        response = await client.chat.completions.create(
             model=model,
             messages=messages,
             max_tokens=max_tokens,
@@ -41,6 +72,23 @@ async def generate_response(client: OpenAI, messages: list, model: str = "gpt-4o
         print(f"❌ OpenAI API 錯誤: {e}")
         raise
 
+async def stream_response(client: AsyncOpenAI, messages: list, model: str = "gpt-4o-mini", max_tokens: int = 1000, temperature: float = 0.8):
+    """逐段產生模型輸出（async generator），每次 yield 一段文字增量"""
+    try:
+        stream = await client.chat.completions.create(
+            model=model,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            stream=True
+        )
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    except Exception as e:
+        print(f"❌ OpenAI 串流錯誤: {e}")
+        raise
+
 # ✅ 新增一個 POST API 路由：/api/openai/chat
 @router.post("/openai/chat")
 async def chat_with_openai(request: Request):
@@ -51,8 +99,22 @@ async def chat_with_openai(request: Request):
         max_tokens = data.get("max_tokens", 1000)
         temperature = data.get("temperature", 0.8)
 
+        # 回應快取（RESPONSE_CACHE_ROUTES 含 openai_chat 時啟用）：以最後一則使用者訊息為鍵，其餘訊息與參數為上下文
+        cache = get_response_cache()
+        last = messages[-1] if messages else {}
+        cacheable = last.get("role") == "user" and isinstance(last.get("content"), str) \
+            and cache.cacheable("openai_chat", last["content"])
+        if cacheable:
+            bucket = ("openai_chat", fingerprint(messages[:-1], model, max_tokens, temperature), "")
+            reply = cache.get(bucket, last["content"])
+            if reply is not None:
+                return {"response": reply}
+            cache.record_miss()
+
         client = get_openai_client()
         reply = await generate_response(client, messages, model, max_tokens, temperature)
+        if cacheable:
+            cache.put(bucket, last["content"], reply)
         return {"response": reply}
 
     except Exception as e:
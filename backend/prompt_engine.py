@@ -6,11 +6,35 @@ from fastapi import APIRouter, HTTPException, Request
 from pydantic import BaseModel
 from modules.soul import XiaoChenGuangSoul
 from modules.emotion_detector import EnhancedEmotionDetector
-from modules.personality_engine import PersonalityEngine
-from backend.supabase_handler import get_supabase
-supabase_client = get_supabase()
+from modules.personality_engine import PersonalityEngine, PersonalityCache
+from backend.supabase_handler import get_async_supabase
+from backend.write_pipeline import get_write_pipeline
+from modules.token_budget import count_tokens, fit_blocks, tokenizer_name
+supabase_client = get_async_supabase()
 router = APIRouter()
 
+# prompt 的 token 預算：總上限與各段上限（個性設定、情緒分析與使用者訊息固定保留）
+PROMPT_MAX_TOKENS = int(os.getenv("PROMPT_MAX_TOKENS", "3000"))
+PROMPT_BUDGET_HISTORY = int(os.getenv("PROMPT_BUDGET_HISTORY", "800"))
+PROMPT_BUDGET_MEMORIES = int(os.getenv("PROMPT_BUDGET_MEMORIES", "600"))
+PROMPT_BUDGET_SUMMARY = int(os.getenv("PROMPT_BUDGET_SUMMARY", "400"))
+# 模型端 prompt 快取的最小前綴長度（OpenAI 為 1024 tokens）；目前的人格設定約 370 tokens，
+# 未達門檻，前綴固定只是為了日後加長時能直接命中，現階段不會有快取折扣
+PROMPT_CACHE_MIN_TOKENS = int(os.getenv("PROMPT_CACHE_MIN_TOKENS", "1024"))
+
+_personality_cache: PersonalityCache = None # 單例變數，只建立一次
+
+def get_personality_cache() -> PersonalityCache:
+    """獲取行程內共用的個性快取（單例模式），寫回透過背景寫入管線。"""
+    global _personality_cache
+    if _personality_cache is None:
+        _personality_cache = PersonalityCache(
+            supabase_client,
+            os.getenv("SUPABASE_MEMORIES_TABLE", "xiaochenguang_memories"),
+            submit=get_write_pipeline().submit
+        )
+    return _personality_cache
+
 class PromptRequest(BaseModel):
     conversation_id: str
     user_message: str
@@ -25,19 +49,102 @@ class PromptEngine:
 
 class PromptEngine:
     def __init__(self, conversation_id: str, memories_table: str): # 移除 supabase_client
+        self.conversation_id = conversation_id
         self.soul = XiaoChenGuangSoul()
         self.emotion_detector = EnhancedEmotionDetector()
         # 這裡直接用檔案頂部已經實例化好的 supabase_client
+        # 尚未載入的預設個性；load_personality() 會換成快取中的版本
         self.personality_engine = PersonalityEngine(conversation_id, supabase_client, memories_table)
+        self.token_usage = {}
+
+    async def load_personality(self):
+        """從個性快取取得本對話的個性引擎（快取命中時不查詢資料庫）"""
+        self.personality_engine = await get_personality_cache().get(self.conversation_id)
     
+    def persona_prompt(self) -> str:
+        """本對話固定的人格設定（第一則 system 訊息）"""
+        return "\n\n".join([
+            self.soul.generate_static_prompt(),
+            self.soul.generate_language_prompt(self.conversation_id)
+        ])
+
     def build_prompt(self, user_message: str, recalled_memories: str = "", 
-                    conversation_history: str = "") -> tuple[list, dict]:
-        emotion_analysis = self.emotion_detector.analyze_emotion(user_message)
+                    conversation_history: str = "", emotion_analysis: dict = None,
+                    conversation_summary: str = "") -> tuple[list, dict]:
+        """組出 messages；摘要、記憶與歷史依各自的 token 預算與優先順序截斷，用量記錄在 self.token_usage
+
+        第一則 system 訊息只放固定的人格設定（同一對話每輪逐位元組相同），每輪變動的情緒風格、摘要、
+        記憶與歷史放在第二則 system 訊息。固定前綴要達到 PROMPT_CACHE_MIN_TOKENS 才會命中模型端的 prompt 快取，
+        是否達到記錄在 token_usage["prefix_cacheable"]。
+        """
+        if emotion_analysis is None:
+            emotion_analysis = self.emotion_detector.analyze_emotion(user_message)
         emotion_style = self.emotion_detector.get_emotion_response_style(emotion_analysis)
 
-        personality_prompt = self.soul.generate_personality_prompt(emotion_style)
+        persona_prompt = self.persona_prompt()
+        style_prompt = self.soul.generate_style_prompt(emotion_style)
+
+        fixed_tokens = count_tokens(persona_prompt) + count_tokens(
+            self._render(style_prompt, "", "", "", emotion_analysis, emotion_style)
+        )
+        user_tokens = count_tokens(user_message)
+        remaining = PROMPT_MAX_TOKENS - fixed_tokens - user_tokens
+        kept, sections, truncated = {}, {}, []
+
+        def fit(name: str, blocks: list, budget: int, keep_latest: bool):
+            nonlocal remaining
+            kept[name], sections[name] = fit_blocks(blocks, max(0, min(budget, remaining)), keep_latest)
+            remaining -= sections[name]
+            if kept[name] != blocks:
+                truncated.append(name)
+
+        # 預算依優先順序分配：最近對話 > 相關記憶 > 長期摘要
+        fit("history", _split_blocks(conversation_history, "用戶: "), PROMPT_BUDGET_HISTORY, True)
+
+        # 已出現在保留下來的歷史中的記憶不再重複放入
+        history_user_messages = {block.split("\n", 1)[0][len("用戶: "):] for block in kept["history"]}
+        memory_blocks = _split_blocks(recalled_memories, MEMORY_BLOCK_PREFIXES)
+        deduplicated = [block for block in memory_blocks if _memory_user_message(block) not in history_user_messages]
+        fit("memories", deduplicated, PROMPT_BUDGET_MEMORIES, False)
+        fit("summary", _split_blocks(conversation_summary, "- "), PROMPT_BUDGET_SUMMARY, True)
+
+        memories_text = "\n".join(["【喚醒記憶】"] + kept["memories"]) if kept["memories"] else ""
+        context_prompt = self._render(
+            style_prompt,
+            "\n".join(kept["summary"]),
+            memories_text,
+            "\n".join(kept["history"]),
+            emotion_analysis,
+            emotion_style
+        )
+
+        messages = [
+            {"role": "system", "content": persona_prompt},
+            {"role": "system", "content": context_prompt},
+            {"role": "user", "content": user_message}
+        ]
+
+        prefix_tokens = count_tokens(persona_prompt)
+        self.token_usage = {
+            "tokenizer": tokenizer_name(),
+            "budget": PROMPT_MAX_TOKENS,
+            "prompt_tokens": prefix_tokens + count_tokens(context_prompt) + user_tokens,
+            "prefix_tokens": prefix_tokens,
+            "prefix_cacheable": prefix_tokens >= PROMPT_CACHE_MIN_TOKENS,
+            "sections": {"fixed": fixed_tokens, "user_message": user_tokens, **sections},
+            "truncated": truncated,
+            "deduplicated_memories": len(memory_blocks) - len(deduplicated)
+        }
 
-        system_prompt = f"""{personality_prompt}
+        return messages, emotion_analysis
+
+    @staticmethod
+    def _render(style_prompt: str, conversation_summary: str, recalled_memories: str,
+                conversation_history: str, emotion_analysis: dict, emotion_style: dict) -> str:
+        return f"""{style_prompt}
+
+### 長期對話摘要
+{conversation_summary if conversation_summary else "（尚無摘要）"}
 
 ### 記憶與上下文
 {recalled_memories if recalled_memories else "（無相關記憶）"}
@@ -56,12 +163,28 @@ class PromptEngine:
 請根據以上所有資訊，以小宸光的身份回應用戶，展現出對應的情感理解與個性特質。
 """
 
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_message}
-        ]
-
-        return messages, emotion_analysis
+# recall_memories 輸出的每則記憶開頭：對話記憶與上傳文件的片段
+MEMORY_BLOCK_PREFIXES = ("- 你曾對我說：", "- 你分享的文件")
+
+def _split_blocks(text: str, prefix) -> list:
+    """依每個區塊的開頭字串（可為 tuple）切分（一輪對話、一則記憶、一段摘要），跨行內容併入同一區塊；標題行略過"""
+    blocks = []
+    for line in (text or "").split("\n"):
+        if line.startswith(prefix) or (blocks and line and not line.startswith("【")):
+            if line.startswith(prefix):
+                blocks.append(line)
+            else:
+                blocks[-1] += "\n" + line
+    if not blocks and text and not text.startswith("【"):
+        blocks.append(text)
+    return blocks
+
+def _memory_user_message(block: str):
+    """對話記憶的使用者訊息（用來與歷史去重）；文件片段回傳 None，一律保留"""
+    first_line = block.split("\n", 1)[0]
+    if not first_line.startswith("- 你曾對我說：「"):
+        return None
+    return first_line[len("- 你曾對我說：「"):].removesuffix("」")
 
 # 如果你想要在 prompt_engine.py 中開放一個 API，可以取消註解以下範例：
 
@@ -0,0 +1,68 @@
+# backend/request_coalescing.py - 重複請求合併與同對話排序
+#
+# SingleFlight：相同 key 的請求同時只執行一次，重複送出的請求等待同一個結果。
+# KeyedLocks：同一個對話的請求依序處理，不同對話仍可並行。
+
+import asyncio
+from contextlib import asynccontextmanager
+
+class SingleFlight:
+    def __init__(self):
+        self._inflight = {}
+        self.stats = {"executed": 0, "coalesced": 0}
+
+    async def run(self, key, fn, *args, **kwargs):
+        """執行 fn；已有相同 key 的工作進行中時直接等待它的結果"""
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn(*args, **kwargs))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+            self.stats["executed"] += 1
+        else:
+            self.stats["coalesced"] += 1
+        # shield：某個呼叫端斷線取消時，共用的工作仍會完成，其他等待者照樣拿到結果
+        return await asyncio.shield(task)
+
+    def get_metrics(self) -> dict:
+        return {"inflight": len(self._inflight), **self.stats}
+
+class KeyedLocks:
+    def __init__(self):
+        self._locks = {}  # key -> [lock, 使用中的數量]
+        self.stats = {"waited": 0}
+
+    @asynccontextmanager
+    async def hold(self, key):
+        """取得 key 專屬的鎖；沒有人使用時自動移除"""
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        if entry[0].locked():
+            self.stats["waited"] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    def get_metrics(self) -> dict:
+        return {"active_keys": len(self._locks), **self.stats}
+
+_single_flight: SingleFlight = None # 單例變數，只建立一次
+_conversation_locks: KeyedLocks = None
+
+def get_single_flight() -> SingleFlight:
+    """獲取聊天請求共用的 SingleFlight（單例模式）。"""
+    global _single_flight
+    if _single_flight is None:
+        _single_flight = SingleFlight()
+    return _single_flight
+
+def get_conversation_locks() -> KeyedLocks:
+    """獲取以 conversation_id 為鍵的鎖（單例模式）。"""
+    global _conversation_locks
+    if _conversation_locks is None:
+        _conversation_locks = KeyedLocks()
+    return _conversation_locks
@@ -1,12 +1,19 @@
+
 # backend/supabase_handler.py - 請完整貼上以下代碼
 
 import os
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from supabase import create_client, Client
 
 SUPABASE_URL = os.environ.get("SUPABASE_URL")
 SUPABASE_ANON_KEY = os.environ.get("SUPABASE_ANON_KEY")
+# 同時進行中的 PostgREST 請求上限（執行緒池大小）
+SUPABASE_MAX_WORKERS = int(os.environ.get("SUPABASE_MAX_WORKERS", "16"))
 
 _supabase: Client = None # 單例變數，只建立一次
+_async_supabase = None
 
 def get_supabase() -> Client:
     """獲取 Supabase 客戶端實例（單例模式）。"""
@@ -17,3 +24,50 @@ def get_supabase() -> Client:
             raise ValueError("❌ 缺少 SUPABASE_URL 或 SUPABASE_ANON_KEY 環境變數。")
         _supabase = create_client(SUPABASE_URL, SUPABASE_ANON_KEY)
     return _supabase
+
+class AsyncSupabase:
+    """非同步資料存取層：查詢照常用 table()/rpc() 建構，再以 await execute() 送出。
+
+    實際的 HTTP 請求在有界執行緒池中執行，共用同一個 supabase client 的連線池，
+    不會阻塞事件迴圈。
+    """
+
+    def __init__(self, client: Client, max_workers: int = SUPABASE_MAX_WORKERS):
+        self.client = client
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="supabase")
+
+    def table(self, table_name: str):
+        return self.client.table(table_name)
+
+    def rpc(self, fn: str, params: dict = None):
+        return self.client.rpc(fn, params or {})
+
+    @property
+    def storage(self):
+        return self.client.storage
+
+    async def execute(self, query):
+        """在執行緒池中執行 query.execute()"""
+        return await self.run(query.execute)
+
+    async def run(self, fn, *args, **kwargs):
+        """在執行緒池中執行任意阻塞呼叫（例如 storage 上傳）"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+def get_async_supabase() -> AsyncSupabase:
+    """獲取非同步資料存取層實例（單例模式）。"""
+    global _async_supabase
+    if _async_supabase is None:
+        _async_supabase = AsyncSupabase(get_supabase())
+    return _async_supabase
+
+def close_async_supabase():
+    """應用關閉時釋放執行緒池"""
+    global _async_supabase
+    if _async_supabase is not None:
+        _async_supabase.shutdown()
+        _async_supabase = None
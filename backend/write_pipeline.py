@@ -0,0 +1,129 @@
+# backend/write_pipeline.py - 背景寫入管線（write-behind）
+#
+# 回應送出後的持久化工作（記憶、情緒狀態、個性）排入佇列，
+# 由固定數量的 worker 非同步執行，失敗自動重試，關閉時會先清空佇列。
+
+import os
+import time
+import asyncio
+import logging
+
+logger = logging.getLogger("write_pipeline")
+
+WRITE_PIPELINE_WORKERS = int(os.getenv("WRITE_PIPELINE_WORKERS", "4"))
+WRITE_PIPELINE_MAX_BACKLOG = int(os.getenv("WRITE_PIPELINE_MAX_BACKLOG", "1000"))
+WRITE_PIPELINE_MAX_RETRIES = int(os.getenv("WRITE_PIPELINE_MAX_RETRIES", "3"))
+WRITE_PIPELINE_RETRY_DELAY = float(os.getenv("WRITE_PIPELINE_RETRY_DELAY", "0.5"))
+WRITE_PIPELINE_DRAIN_TIMEOUT = float(os.getenv("WRITE_PIPELINE_DRAIN_TIMEOUT", "30"))
+
+class WritePipeline:
+    def __init__(self, workers: int = WRITE_PIPELINE_WORKERS, max_backlog: int = WRITE_PIPELINE_MAX_BACKLOG,
+                 max_retries: int = WRITE_PIPELINE_MAX_RETRIES, retry_delay: float = WRITE_PIPELINE_RETRY_DELAY):
+        self.workers = workers
+        self.max_backlog = max_backlog
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.queue = None
+        self._tasks = []
+        self._pending_since = {}
+        self.stats = {
+            "submitted": 0,
+            "completed": 0,
+            "failed": 0,
+            "retried": 0,
+            "inline": 0,
+            "last_lag_seconds": 0.0,
+            "max_lag_seconds": 0.0
+        }
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    async def start(self):
+        """啟動 worker 池（應用啟動時呼叫）"""
+        if self.running:
+            return
+        self.queue = asyncio.Queue(maxsize=self.max_backlog)
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        print(f"✅ 背景寫入管線已啟動（{self.workers} 個 worker）")
+
+    async def submit(self, name: str, fn, *args, **kwargs):
+        """排入一個寫入工作；fn 為 async 函式，失敗時應拋出例外以觸發重試（retryable = False 的例外不重試）。
+
+        佇列已滿時會等待空位（背壓）；管線未啟動時直接執行。
+        """
+        self.stats["submitted"] += 1
+        if not self.running:
+            self.stats["inline"] += 1
+            await self._run(name, fn, args, kwargs)
+            return
+        job_id = self.stats["submitted"]
+        self._pending_since[job_id] = time.monotonic()
+        await self.queue.put((job_id, name, fn, args, kwargs))
+
+    async def _worker(self, index: int):
+        while True:
+            job_id, name, fn, args, kwargs = await self.queue.get()
+            try:
+                lag = time.monotonic() - self._pending_since.pop(job_id, time.monotonic())
+                self.stats["last_lag_seconds"] = lag
+                self.stats["max_lag_seconds"] = max(self.stats["max_lag_seconds"], lag)
+                await self._run(name, fn, args, kwargs)
+            finally:
+                self.queue.task_done()
+
+    async def _run(self, name: str, fn, args, kwargs):
+        for attempt in range(self.max_retries + 1):
+            try:
+                await fn(*args, **kwargs)
+                self.stats["completed"] += 1
+                return
+            except Exception as e:
+                # 例外帶有 retryable = False（例如缺少資料庫遷移）時重試也無效，直接記錄
+                if getattr(e, "retryable", True) is False:
+                    self.stats["failed"] += 1
+                    logger.error(f"❌ 背景寫入失敗（不重試）: {name}: {e}")
+                    return
+                if attempt >= self.max_retries:
+                    self.stats["failed"] += 1
+                    logger.error(f"❌ 背景寫入失敗（已重試 {self.max_retries} 次）: {name}: {e}")
+                    return
+                self.stats["retried"] += 1
+                await asyncio.sleep(self.retry_delay * (2 ** attempt))
+
+    async def drain(self, timeout: float = WRITE_PIPELINE_DRAIN_TIMEOUT):
+        """等待佇列清空後停止 worker（應用關閉時呼叫）"""
+        if not self.running:
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"❌ 背景寫入管線關閉逾時，仍有 {self.queue.qsize()} 筆未寫入")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        print("✅ 背景寫入管線已關閉")
+
+    def get_metrics(self) -> dict:
+        """佇列深度與延遲等指標"""
+        now = time.monotonic()
+        oldest = min(self._pending_since.values(), default=None)
+        return {
+            "running": self.running,
+            "workers": self.workers,
+            "queue_depth": self.queue.qsize() if self.queue else 0,
+            "max_backlog": self.max_backlog,
+            "oldest_pending_seconds": now - oldest if oldest is not None else 0.0,
+            **self.stats
+        }
+
+_write_pipeline: WritePipeline = None # 單例變數，只建立一次
+
+def get_write_pipeline() -> WritePipeline:
+    """獲取背景寫入管線實例（單例模式）。"""
+    global _write_pipeline
+    if _write_pipeline is None:
+        _write_pipeline = WritePipeline()
+    return _write_pipeline
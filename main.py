@@ -1,16 +1,52 @@
 from dotenv import load_dotenv 
 load_dotenv() 
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
 # 引入 backend 資料夾下的各個 router
 from backend.chat_router import router as chat_router
 from backend.memory_router import router as memory_router
-from backend.openai_handler import router as openai_router
+from backend.openai_handler import router as openai_router, init_openai_client, close_openai_client
 from backend.file_upload import router as file_upload_router
 from backend.healthcheck_router import router as health_router
+from backend.emotion_router import router as emotion_router
+from backend.supabase_handler import close_async_supabase
+from backend.write_pipeline import get_write_pipeline
+from backend.prompt_engine import get_personality_cache
+from modules.embedding_cache import close_embedding_cache
+from modules.emotion_detector import close_emotion_process_pool
+from modules.vector_index import get_vector_index
+from modules.memory_ranking import get_access_tracker
+from modules.memory_compaction import get_compaction_engine
+from modules.file_handler import close_download_client
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 啟動時建立共用的 OpenAI 連線池，關閉時釋放
+    try:
+        init_openai_client()
+    except ValueError as e:
+        print(e)
+    await get_write_pipeline().start()
+    get_personality_cache().start()
+    yield
+    # 先把尚未寫入的資料寫完，再關閉連線
+    if get_compaction_engine() is not None:
+        await get_compaction_engine().close()
+    await get_personality_cache().close()
+    if get_access_tracker() is not None:
+        await get_access_tracker().close()
+    await get_write_pipeline().drain()
+    if get_vector_index() is not None:
+        await get_vector_index().persist()
+    await close_openai_client()
+    await close_download_client()
+    close_async_supabase()
+    close_embedding_cache()
+    close_emotion_process_pool()
+
+app = FastAPI(lifespan=lifespan)
 
 # ✅ 設定跨來源資源共享（CORS）
 app.add_middleware(
@@ -31,6 +67,7 @@ app.include_router(chat_router, prefix="/api")
 app.include_router(memory_router, prefix="/api")
 app.include_router(openai_router, prefix="/api")
 app.include_router(file_upload_router, prefix="/api")
+app.include_router(emotion_router, prefix="/api")
 
 # 根路由檢查是否運行中
 @app.get("/")
@@ -0,0 +1,212 @@
+import os
+import re
+import html
+import time
+import asyncio
+import zipfile
+from datetime import datetime
+from typing import Optional
+from modules.memory_system import message_hash, EMBEDDING_BATCH_SIZE
+from modules.token_budget import count_tokens, split_by_tokens
+
+try:
+    from pypdf import PdfReader
+except ImportError:  # 未安裝時不處理 PDF
+    PdfReader = None
+
+# 上傳文件切塊後寫入記憶（memory_type = 'document'），召回時與對話記憶一起搜尋
+DOCUMENT_CHUNK_TOKENS = int(os.getenv("DOCUMENT_CHUNK_TOKENS", "300"))
+DOCUMENT_CHUNK_OVERLAP = int(os.getenv("DOCUMENT_CHUNK_OVERLAP", "50"))
+# 單一文件最多處理的字數，避免超大檔案占滿記憶體與 embedding 額度
+DOCUMENT_MAX_CHARS = int(os.getenv("DOCUMENT_MAX_CHARS", "1000000"))
+DOCUMENT_IMPORTANCE = float(os.getenv("DOCUMENT_IMPORTANCE", "0.5"))
+
+TEXT_EXTENSIONS = {".txt", ".md", ".markdown", ".csv", ".tsv", ".json", ".log"}
+
+_SENTENCE_RE = re.compile(r"[^。！？!?.\n]*(?:[。！？!?.]+|\n+|$)")
+_DOCX_BREAK_RE = re.compile(r"</w:p>|<w:br/>|<w:tab/>")
+_XML_TAG_RE = re.compile(r"<[^>]+>")
+
+def can_ingest(file_name: str) -> bool:
+    extension = os.path.splitext(file_name)[1].lower()
+    return extension in TEXT_EXTENSIONS or extension == ".docx" or (extension == ".pdf" and PdfReader is not None)
+
+def extract_text(file_name: str, fileobj) -> Optional[str]:
+    """從檔案取出純文字（阻塞呼叫，請在執行緒池中執行）；不支援的格式回傳 None"""
+    extension = os.path.splitext(file_name)[1].lower()
+    fileobj.seek(0)
+    if extension in TEXT_EXTENSIONS:
+        # UTF-8 每字最多 4 bytes，只讀取需要的部分
+        text = fileobj.read(DOCUMENT_MAX_CHARS * 4).decode("utf-8-sig", errors="ignore")
+    elif extension == ".docx":
+        with zipfile.ZipFile(fileobj) as archive:
+            xml = archive.read("word/document.xml").decode("utf-8", errors="ignore")
+        text = html.unescape(_XML_TAG_RE.sub("", _DOCX_BREAK_RE.sub("\n", xml)))
+    elif extension == ".pdf" and PdfReader is not None:
+        pages, size = [], 0
+        for page in PdfReader(fileobj).pages:
+            pages.append(page.extract_text() or "")
+            size += len(pages[-1])
+            if size >= DOCUMENT_MAX_CHARS:
+                break
+        text = "\n".join(pages)
+    else:
+        return None
+    return text[:DOCUMENT_MAX_CHARS]
+
+def chunk_text(text: str, max_tokens: int = DOCUMENT_CHUNK_TOKENS, overlap: int = DOCUMENT_CHUNK_OVERLAP) -> list:
+    """以句子為單位組成不超過 max_tokens 的片段，相鄰片段重疊約 overlap 個 token。
+
+    CPU 密集，請在執行緒中呼叫；每個句子只計算一次 token 數，沒有標點的超長句子依 token 數線性切開。
+    """
+    chunks, current, used = [], [], 0  # current: [(句子, token 數)]
+    for sentence in _SENTENCE_RE.findall(text):
+        if not sentence:
+            continue
+        tokens = count_tokens(sentence)
+        pieces = [(sentence, tokens)] if tokens <= max_tokens else [
+            (piece, count_tokens(piece)) for piece in split_by_tokens(sentence, max_tokens)
+        ]
+        for piece, tokens in pieces:
+            if current and used + tokens > max_tokens:
+                chunks.append("".join(piece for piece, _ in current).strip())
+                # 保留上一段結尾的句子作為重疊
+                tail, tail_used = [], 0
+                for previous, previous_tokens in reversed(current):
+                    if tail_used + previous_tokens > overlap or tail_used + previous_tokens + tokens > max_tokens:
+                        break
+                    tail.insert(0, (previous, previous_tokens))
+                    tail_used += previous_tokens
+                current, used = tail, tail_used
+            current.append((piece, tokens))
+            used += tokens
+    if current:
+        chunks.append("".join(piece for piece, _ in current).strip())
+    return [chunk for chunk in chunks if chunk]
+
+def _keyed_chunks(conversation_id: str, file_name: str, text: str) -> dict:
+    """切塊並算出每個片段的 message_hash（在執行緒中執行）"""
+    return {
+        message_hash(conversation_id, "document", f"{file_name}\x1f{chunk}"): chunk
+        for chunk in chunk_text(text)
+    }
+
+class DocumentIngestor:
+    """把文件片段批次 embedding 後寫入記憶表。
+
+    每個片段以 (對話, 檔名, 片段內容) 的雜湊為 message_hash：重新上傳同名檔案時，
+    內容沒變的片段直接略過，只對新片段計算 embedding，已不存在的舊片段會被刪除。
+    """
+
+    def __init__(self, memory_system, batch_size: int = EMBEDDING_BATCH_SIZE):
+        self.memory_system = memory_system
+        self.supabase = memory_system.supabase
+        self.memories_table = memory_system.memories_table
+        self.batch_size = batch_size
+        self.stats = {
+            "documents": 0, "chunks": 0, "embedded": 0, "skipped": 0, "deleted": 0, "failed": 0,
+            "tokens": 0, "seconds": 0.0, "embed_seconds": 0.0, "write_seconds": 0.0
+        }
+
+    async def ingest(self, conversation_id: str, file_name: str, text: str) -> dict:
+        """切塊、embedding 並寫入；回傳本次處理的統計"""
+        started = time.monotonic()
+        try:
+            # 切塊是 CPU 密集的工作，放到執行緒中避免卡住事件迴圈
+            chunks = await asyncio.to_thread(_keyed_chunks, conversation_id, file_name, text)
+            existing = await self._existing_chunks(conversation_id, file_name)
+            new = [(key, chunk) for key, chunk in chunks.items() if key not in existing]
+            stale = [memory_id for key, memory_id in existing.items() if key not in chunks]
+
+            for start in range(0, len(new), self.batch_size):
+                await self._write_batch(conversation_id, file_name, new[start:start + self.batch_size])
+            if stale:
+                await self._delete(conversation_id, stale)
+        except Exception:
+            self.stats["failed"] += 1
+            raise
+
+        elapsed = time.monotonic() - started
+        result = {"chunks": len(chunks), "embedded": len(new), "skipped": len(chunks) - len(new),
+                  "deleted": len(stale), "seconds": round(elapsed, 3)}
+        self.stats["documents"] += 1
+        self.stats["chunks"] += len(chunks)
+        self.stats["skipped"] += len(chunks) - len(new)
+        self.stats["deleted"] += len(stale)
+        self.stats["seconds"] += elapsed
+        print(f"✅ 文件已匯入記憶：{file_name}（{len(chunks)} 段，新增 {len(new)}、略過 {result['skipped']}、刪除 {len(stale)}，{elapsed:.2f} 秒）")
+        return result
+
+    async def _existing_chunks(self, conversation_id: str, file_name: str, page_size: int = 1000) -> dict:
+        """已寫入的片段：message_hash -> id"""
+        existing, last_id = {}, 0
+        while True:
+            result = await self.supabase.execute(
+                self.supabase.table(self.memories_table)
+                .select("id, message_hash")
+                .eq("conversation_id", conversation_id)
+                .eq("memory_type", "document")
+                .eq("file_name", file_name)
+                .gt("id", last_id)
+                .order("id")
+                .limit(page_size)
+            )
+            for row in result.data or []:
+                existing[row["message_hash"]] = row["id"]
+            if not result.data or len(result.data) < page_size:
+                return existing
+            last_id = result.data[-1]["id"]
+
+    async def _write_batch(self, conversation_id: str, file_name: str, batch: list):
+        embed_started = time.monotonic()
+        embeddings = await self.memory_system.embed_many([chunk for _, chunk in batch])
+        write_started = time.monotonic()
+        now = datetime.now().isoformat()
+        await self.memory_system.upsert_rows([
+            {
+                "conversation_id": conversation_id,
+                "user_message": f"《{file_name}》",
+                "assistant_message": chunk,
+                "embedding": embedding,
+                "memory_type": "document",
+                "platform": "Web",
+                "document_content": chunk,
+                "created_at": now,
+                "access_count": 1,
+                "importance_score": DOCUMENT_IMPORTANCE,
+                "file_name": file_name,
+                "ai_id": "xiaochenguang_v1",
+                "message_type": "file",
+                "message_hash": key
+            }
+            for (key, chunk), embedding in zip(batch, embeddings)
+        ])
+        self.stats["embed_seconds"] += write_started - embed_started
+        self.stats["write_seconds"] += time.monotonic() - write_started
+        self.stats["embedded"] += len(batch)
+        self.stats["tokens"] += sum(count_tokens(chunk) for _, chunk in batch)
+
+    async def _delete(self, conversation_id: str, memory_ids: list):
+        await self.supabase.execute(
+            self.supabase.table(self.memories_table).delete().in_("id", memory_ids)
+        )
+        for index in (self.memory_system.vector_index, self.memory_system.lexical_index):
+            if index is not None:
+                index.remove(conversation_id, memory_ids)
+
+    def get_metrics(self) -> dict:
+        seconds = self.stats["seconds"]
+        return {
+            **self.stats,
+            "chunks_per_second": round(self.stats["embedded"] / seconds, 2) if seconds else 0.0,
+            "tokens_per_second": round(self.stats["tokens"] / seconds, 2) if seconds else 0.0
+        }
+
+_document_ingestor: DocumentIngestor = None # 單例變數，只建立一次
+
+def get_document_ingestor(memory_system=None) -> DocumentIngestor:
+    """獲取文件匯入器（單例模式）；尚未建立且沒有傳入 memory_system 時回傳 None。"""
+    global _document_ingestor
+    if _document_ingestor is None and memory_system is not None:
+        _document_ingestor = DocumentIngestor(memory_system)
+    return _document_ingestor
@@ -0,0 +1,152 @@
+import os
+import hashlib
+import asyncio
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# 記憶體快取筆數上限；EMBEDDING_CACHE_PATH 有設定時另外寫入 SQLite 磁碟快取
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "10000"))
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH")
+
+def normalize_text(text: str) -> str:
+    """快取鍵用的正規化：NFKC（全半形統一）、合併空白、去頭尾空白"""
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+class EmbeddingCache:
+    """兩層 embedding 快取：記憶體 LRU + 選用的 SQLite（float32 blob）。
+
+    鍵為 模型名稱 + 正規化文字 的 SHA-256，相同文字不會重複呼叫 embedding API。
+    SQLite 只在專用的單一執行緒中存取：查詢一次批次 SELECT，寫入排入佇列後以一次 commit 寫完，不卡住事件迴圈。
+    """
+
+    def __init__(self, max_size: int = EMBEDDING_CACHE_SIZE, path: str = EMBEDDING_CACHE_PATH):
+        self.max_size = max_size
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._executor = None
+        self._pending_writes = set()
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, model TEXT, vector BLOB)"
+            )
+            self._db.commit()
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embedding-cache")
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+
+    @staticmethod
+    def make_key(model: str, text: str) -> str:
+        return hashlib.sha256(f"{model}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+    async def get(self, model: str, text: str):
+        """取得快取的 embedding；沒有時回傳 None"""
+        return (await self.get_many(model, [text]))[0]
+
+    async def get_many(self, model: str, texts: list) -> list:
+        """批次取得快取的 embedding（與 texts 對應，沒有的位置為 None）；記憶體未命中的鍵一次向 SQLite 查詢"""
+        keys = [self.make_key(model, text) for text in texts]
+        embeddings = [None] * len(keys)
+        with self._lock:
+            for i, key in enumerate(keys):
+                embedding = self._memory.get(key)
+                if embedding is not None:
+                    self._memory.move_to_end(key)
+                    self.stats["memory_hits"] += 1
+                    embeddings[i] = embedding
+
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing and self._db is not None:
+            loop = asyncio.get_running_loop()
+            found = await loop.run_in_executor(self._executor, self._read_rows, {keys[i] for i in missing})
+            with self._lock:
+                for i in missing:
+                    vector = found.get(keys[i])
+                    if vector is not None:
+                        embeddings[i] = np.frombuffer(vector, dtype=np.float32).tolist()
+                        self._remember(keys[i], embeddings[i])
+                        self.stats["disk_hits"] += 1
+
+        self.stats["misses"] += sum(1 for embedding in embeddings if embedding is None)
+        return embeddings
+
+    async def put(self, model: str, text: str, embedding: list):
+        await self.put_many(model, [(text, embedding)])
+
+    async def put_many(self, model: str, items: list):
+        """寫入 [(文字, embedding)]；記憶體立即生效，磁碟寫入交給快取執行緒（不等待完成）"""
+        rows = []
+        with self._lock:
+            for text, embedding in items:
+                key = self.make_key(model, text)
+                self._remember(key, embedding)
+                rows.append((key, model, np.asarray(embedding, dtype=np.float32).tobytes()))
+        if rows and self._db is not None:
+            future = asyncio.get_running_loop().run_in_executor(self._executor, self._write_rows, rows)
+            self._pending_writes.add(future)
+            future.add_done_callback(self._write_done)
+
+    def _read_rows(self, keys: set) -> dict:
+        """（快取執行緒）以 IN 查詢批次讀取，每次最多 500 個鍵"""
+        keys, found = list(keys), {}
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            found.update(self._db.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch
+            ).fetchall())
+        return found
+
+    def _write_rows(self, rows: list):
+        """（快取執行緒）一次 executemany + commit"""
+        self._db.executemany("INSERT OR REPLACE INTO embeddings (key, model, vector) VALUES (?, ?, ?)", rows)
+        self._db.commit()
+
+    def _write_done(self, future):
+        self._pending_writes.discard(future)
+        if not future.cancelled() and future.exception() is not None:
+            print(f"⚠️ embedding 磁碟快取寫入失敗：{future.exception()}")
+
+    def _remember(self, key: str, embedding: list):
+        self._memory[key] = embedding
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_size:
+            self._memory.popitem(last=False)
+
+    def close(self):
+        """等待排入的磁碟寫入完成後關閉 SQLite"""
+        if self._executor is not None:
+            self._executor.submit(self._db.close)
+            self._executor.shutdown(wait=True)
+            self._executor = None
+            self._db = None
+
+    def get_metrics(self) -> dict:
+        lookups = sum(self.stats.values())
+        hits = self.stats["memory_hits"] + self.stats["disk_hits"]
+        return {
+            "size": len(self._memory),
+            "disk_enabled": self._db is not None,
+            "pending_disk_writes": len(self._pending_writes),
+            "hit_rate": hits / lookups if lookups else 0.0,
+            **self.stats
+        }
+
+_embedding_cache: EmbeddingCache = None # 單例變數，只建立一次
+
+def get_embedding_cache() -> EmbeddingCache:
+    """獲取行程內共用的 embedding 快取（單例模式）。"""
+    global _embedding_cache
+    if _embedding_cache is None:
+        _embedding_cache = EmbeddingCache()
+    return _embedding_cache
+
+def close_embedding_cache():
+    global _embedding_cache
+    if _embedding_cache is not None:
+        _embedding_cache.close()
+        _embedding_cache = None
@@ -0,0 +1,95 @@
+import os
+import sys
+import json
+import base64
+import numpy as np
+
+# 精簡 embedding 格式（選用）："float16" 或 "int8"；設定時 save_memory 另外寫入 embedding_compact 欄位
+EMBEDDING_COMPACT_FORMAT = os.getenv("EMBEDDING_COMPACT_FORMAT", "")
+# 是否仍寫入完整精度的 embedding 欄位（pgvector 的 match_memories 需要）；只用本機索引時可關閉
+EMBEDDING_STORE_FULL = os.getenv("EMBEDDING_STORE_FULL", "1") == "1"
+
+def quantize_int8(vectors: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """每列對稱量化成 int8：codes * scale ≈ 原向量"""
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    scales = np.abs(vectors).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+def encode_embedding(vector, fmt: str = EMBEDDING_COMPACT_FORMAT) -> str:
+    """把向量編成可放進文字欄位的精簡字串："f16:<base64>" 或 "i8:<scale>:<base64>" """
+    vector = np.asarray(vector, dtype=np.float32)
+    if fmt == "float16":
+        return "f16:" + base64.b64encode(vector.astype("<f2").tobytes()).decode("ascii")
+    if fmt == "int8":
+        codes, scales = quantize_int8(vector)
+        return f"i8:{float(scales[0])!r}:" + base64.b64encode(codes[0].tobytes()).decode("ascii")
+    raise ValueError(f"不支援的 embedding 格式：{fmt}")
+
+def decode_embedding(payload: str) -> list:
+    """encode_embedding 的反向操作"""
+    kind, _, rest = payload.partition(":")
+    if kind == "f16":
+        return np.frombuffer(base64.b64decode(rest), dtype="<f2").astype(np.float32).tolist()
+    if kind == "i8":
+        scale, _, data = rest.partition(":")
+        codes = np.frombuffer(base64.b64decode(data), dtype=np.int8)
+        return (codes.astype(np.float32) * np.float32(scale)).tolist()
+    raise ValueError(f"無法辨識的 embedding 格式：{kind}")
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1.0, norms)
+
+def _recall_at_k(exact: np.ndarray, approximate: np.ndarray, k: int) -> float:
+    truth = np.argsort(-exact, axis=1)[:, :k]
+    found = np.argsort(-approximate, axis=1)[:, :k]
+    return float(np.mean([len(set(t) & set(f)) / k for t, f in zip(truth, found)]))
+
+def evaluate_quantization(vectors, queries=None, k: int = 10, rescore_factor: int = 4) -> dict:
+    """比較各種儲存格式的每列位元組數與 recall@k（以 float32 完整精度的結果為基準）。
+
+    int8 另外量測「int8 粗篩 k * rescore_factor 筆、再以完整精度重新排序」的 recall@k。
+    """
+    vectors = _normalize(np.asarray(vectors, dtype=np.float32))
+    queries = vectors[:min(100, len(vectors))] if queries is None else _normalize(np.asarray(queries, dtype=np.float32))
+    k = min(k, len(vectors))
+    exact = queries @ vectors.T
+
+    float16_scores = queries @ vectors.astype(np.float16).astype(np.float32).T
+    codes, scales = quantize_int8(vectors)
+    int8_scores = (queries @ codes.astype(np.float32).T) * scales
+
+    candidates = np.argsort(-int8_scores, axis=1)[:, :k * rescore_factor]
+    rescored = np.full_like(exact, -np.inf)
+    rows = np.arange(len(queries))[:, None]
+    rescored[rows, candidates] = exact[rows, candidates]
+
+    sample = vectors[0]
+    return {
+        "rows": len(vectors),
+        "dimensions": vectors.shape[1],
+        "k": k,
+        "bytes_per_row": {
+            "json": len(json.dumps(sample.tolist())),
+            "float32": sample.nbytes,
+            "float16": sample.astype(np.float16).nbytes,
+            "int8": codes[0].nbytes + 4,
+            "float16_base64": len(encode_embedding(sample, "float16")),
+            "int8_base64": len(encode_embedding(sample, "int8"))
+        },
+        "recall_at_k": {
+            "float16": _recall_at_k(exact, float16_scores, k),
+            "int8": _recall_at_k(exact, int8_scores, k),
+            "int8_rescored": _recall_at_k(exact, rescored, k)
+        }
+    }
+
+if __name__ == "__main__":
+    # 用法：python -m modules.embedding_quantization [向量檔 .npy，例如 vector_index/<對話>.npy]
+    if len(sys.argv) > 1:
+        data = np.load(sys.argv[1])
+    else:
+        data = np.random.default_rng(0).standard_normal((2000, 1536)).astype(np.float32)
+    print(json.dumps(evaluate_quantization(data), indent=2, ensure_ascii=False))
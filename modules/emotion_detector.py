@@ -1,48 +1,245 @@
+import os
 import re
+import threading
+import unicodedata
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+from types import MappingProxyType
+from modules.keyword_matcher import AhoCorasick
+
+# 批次分析超過此筆數、且有多顆 CPU 時才分散到多個行程（單一行程每秒約 3～5 萬筆，吞吐量只能靠多行程提高）
+EMOTION_BATCH_PROCESS_THRESHOLD = int(os.getenv("EMOTION_BATCH_PROCESS_THRESHOLD", "20000"))
+EMOTION_BATCH_PROCESSES = int(os.getenv("EMOTION_BATCH_PROCESSES", str(os.cpu_count() or 1)))
+
+def _freeze(value):
+    """把巢狀的 dict/list 轉成唯讀結構，讓整個行程安全共用"""
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+# 情緒詞典（行程內唯一、唯讀）
+EMOTION_DICTIONARY = _freeze({
+    "joy": {
+        "keywords": ["開心", "快樂", "高興", "興奮", "爽", "棒", "讚", "好", "耶", "哈哈", "嘻嘻"],
+        "patterns": [r"太好了", r"真棒", r"好開心", r"超級.*好", r"非常.*興奮"],
+        "intensity_multipliers": {"超級": 1.5, "非常": 1.3, "真的": 1.2, "好": 1.1}
+    },
+    "sadness": {
+        "keywords": ["難過", "傷心", "哭", "沮喪", "失望", "憂鬱", "痛苦", "嗚嗚"],
+        "patterns": [r"好難過", r"想哭", r"心情.*低落", r"很失望", r"受傷"],
+        "intensity_multipliers": {"超級": 1.5, "非常": 1.3, "真的": 1.2, "好": 1.1}
+    },
+    "anger": {
+        "keywords": ["生氣", "憤怒", "氣死", "討厭", "煩", "爛", "可惡"],
+        "patterns": [r"氣死.*了", r"超級.*煩", r"真的.*討厭", r"受不了"],
+        "intensity_multipliers": {"超級": 1.8, "非常": 1.5, "真的": 1.3, "好": 1.2}
+    },
+    "fear": {
+        "keywords": ["害怕", "恐懼", "緊張", "擔心", "焦慮", "怕", "驚", "慌"],
+        "patterns": [r"好怕", r"很緊張", r"擔心.*得", r"焦慮.*不安"],
+        "intensity_multipliers": {"超級": 1.6, "非常": 1.4, "真的": 1.2, "好": 1.1}
+    },
+    "love": {
+        "keywords": ["愛", "喜歡", "心動", "溫暖", "甜蜜", "幸福"],
+        "patterns": [r"好愛", r"很喜歡", r"心動.*了", r"好甜蜜", r"感覺.*溫暖"],
+        "intensity_multipliers": {"超級": 1.4, "非常": 1.3, "真的": 1.2, "好": 1.1}
+    },
+    "tired": {
+        "keywords": ["累", "疲憊", "睏", "想睡", "沒力", "筋疲力盡"],
+        "patterns": [r"好累", r"累死.*了", r"沒.*力氣", r"想睡覺"],
+        "intensity_multipliers": {"超級": 1.5, "非常": 1.3, "真的": 1.2, "好": 1.1}
+    },
+    "confused": {
+        "keywords": ["困惑", "不懂", "搞不懂", "迷惑", "？", "??"],
+        "patterns": [r"搞不懂", r"不明白", r"很困惑", r"看不懂"],
+        "intensity_multipliers": {"完全": 1.5, "真的": 1.3, "好": 1.1}
+    },
+    "grateful": {
+        "keywords": ["謝謝", "感謝", "感恩", "謝", "3Q", "thx"],
+        "patterns": [r"謝謝.*你", r"真的.*感謝", r"好感謝", r"太感謝"],
+        "intensity_multipliers": {"超級": 1.4, "非常": 1.3, "真的": 1.2, "好": 1.1}
+    }
+})
+
+def _literal_segments(pattern: str):
+    """句型若是以 .* 串接的純文字片段（例如 "超級.*好"），回傳各片段；否則回傳 None"""
+    segments = tuple(pattern.split(".*"))
+    for segment in segments:
+        # 片段需不分大小寫，才能直接在小寫化後的文字上比對
+        if (not segment or re.escape(segment) != segment or "\n" in segment
+                or segment.lower() != segment or segment.upper() != segment
+                or any(unicodedata.combining(char) for char in segment)):
+            return None
+    return segments
+
+def _build_matcher():
+    """把所有關鍵字、強化詞與句型片段編進同一個 Aho-Corasick 自動機"""
+    words = []
+    for data in EMOTION_DICTIONARY.values():
+        words.extend(keyword.lower() for keyword in data["keywords"])
+        words.extend(data.get("intensity_multipliers", {}).keys())
+        for pattern in data.get("patterns", ()):
+            words.extend(_literal_segments(pattern) or ())
+    matcher = AhoCorasick(words)
+    word_index = {word: index for index, word in enumerate(matcher.words)}
+
+    # 依自動機輸出的關鍵字索引反查：哪些情緒的關鍵字/句型/強化詞以它開頭
+    keyword_owners, pattern_owners, fallback_patterns, intensifiers = {}, {}, [], {}
+    for emotion, data in EMOTION_DICTIONARY.items():
+        for keyword in data["keywords"]:
+            keyword_owners.setdefault(word_index[keyword.lower()], []).append(emotion)
+        for pattern in data.get("patterns", ()):
+            segments = _literal_segments(pattern)
+            if segments:
+                spec = tuple((word_index[segment], len(segment)) for segment in segments)
+                pattern_owners.setdefault(spec[0][0], []).append((emotion, spec))
+            else:
+                fallback_patterns.append((emotion, re.compile(pattern)))
+        intensifiers[emotion] = tuple(
+            (word_index[word], word, multiplier)
+            for word, multiplier in data.get("intensity_multipliers", {}).items()
+        )
+    return matcher, MappingProxyType({
+        "keyword_owners": MappingProxyType({k: tuple(v) for k, v in keyword_owners.items()}),
+        "pattern_owners": MappingProxyType({k: tuple(v) for k, v in pattern_owners.items()}),
+        "fallback_patterns": tuple(fallback_patterns),
+        "intensifiers": MappingProxyType(intensifiers),
+        "intensifier_indices": frozenset(index for specs in intensifiers.values() for index, _, _ in specs)
+    })
+
+_MATCHER, _MATCHER_INDEX = _build_matcher()
+
+def _segments_match(segments, found: dict, newlines: list, text_length: int) -> bool:
+    """判斷片段是否依序出現在同一行內（等同 re.search("A.*B")）"""
+    first_index, first_length = segments[0]
+    for start in found.get(first_index, ()):
+        end = start + first_length
+        line = bisect_left(newlines, start)
+        line_end = newlines[line] if line < len(newlines) else text_length
+        for index, length in segments[1:]:
+            positions = found.get(index, ())
+            nearest = bisect_left(positions, end)
+            if nearest == len(positions) or positions[nearest] > line_end:
+                break
+            end = positions[nearest] + length
+        else:
+            return True
+    return False
+
+def _scan(text: str):
+    """回傳 (自動機命中結果, 各情緒關鍵字命中數, 各情緒句型命中數)"""
+    text_lower = text.lower()
+    found = _MATCHER.find_all(text_lower)
+    newlines = [i for i, char in enumerate(text_lower) if char == "\n"] if "\n" in text_lower else []
+
+    keyword_hits = dict.fromkeys(EMOTION_DICTIONARY, 0)
+    pattern_hits = dict.fromkeys(EMOTION_DICTIONARY, 0)
+    for index in found:
+        for emotion in _MATCHER_INDEX["keyword_owners"].get(index, ()):
+            keyword_hits[emotion] += 1
+        for emotion, segments in _MATCHER_INDEX["pattern_owners"].get(index, ()):
+            if _segments_match(segments, found, newlines, len(text_lower)):
+                pattern_hits[emotion] += 1
+    for emotion, pattern in _MATCHER_INDEX["fallback_patterns"]:
+        if pattern.search(text):
+            pattern_hits[emotion] += 1
+    return found, keyword_hits, pattern_hits
+
+_EXCLAMATION_RE = re.compile(r"!!+")
+_INTERROBANG_RE = re.compile(r"\?!+")
+_REPEATED_CHAR_RE = re.compile(r"(.)\1{2,}")
+
+# 回應風格表：數值欄位若為函式，依情緒強度計算
+RESPONSE_STYLES = _freeze({
+    "joy": {
+        "tone": "cheerful_enthusiastic",
+        "emoji_frequency": lambda intensity: min(0.9, 0.6 + intensity * 0.3),
+        "empathy_level": 0.7,
+        "energy_level": lambda intensity: min(1.0, 0.6 + intensity * 0.4),
+        "suggested_emojis": ["😊", "😄", "🎉", "✨", "💛"]
+    },
+    "sadness": {
+        "tone": "gentle_comforting",
+        "emoji_frequency": lambda intensity: min(0.8, 0.4 + intensity * 0.4),
+        "empathy_level": lambda intensity: min(1.0, 0.8 + intensity * 0.2),
+        "energy_level": lambda intensity: max(0.3, 0.6 - intensity * 0.3),
+        "suggested_emojis": ["🫂", "💙", "✨"]
+    },
+    "anger": {
+        "tone": "calm_understanding",
+        "emoji_frequency": lambda intensity: max(0.3, 0.6 - intensity * 0.3),
+        "empathy_level": lambda intensity: min(1.0, 0.7 + intensity * 0.3),
+        "energy_level": lambda intensity: max(0.4, 0.7 - intensity * 0.2),
+        "suggested_emojis": ["💙", "🫂", "✨"]
+    },
+    "fear": {
+        "tone": "reassuring_supportive",
+        "emoji_frequency": lambda intensity: min(0.7, 0.5 + intensity * 0.2),
+        "empathy_level": lambda intensity: min(1.0, 0.8 + intensity * 0.2),
+        "energy_level": lambda intensity: max(0.5, 0.7 - intensity * 0.2),
+        "suggested_emojis": ["🫂", "💙", "✨", "😊"]
+    },
+    "love": {
+        "tone": "warm_affectionate",
+        "emoji_frequency": lambda intensity: min(0.9, 0.7 + intensity * 0.2),
+        "empathy_level": 0.8,
+        "energy_level": lambda intensity: min(0.9, 0.7 + intensity * 0.2),
+        "suggested_emojis": ["💛", "✨", "💕"]
+    },
+    "tired": {
+        "tone": "gentle_caring",
+        "emoji_frequency": lambda intensity: min(0.6, 0.4 + intensity * 0.2),
+        "empathy_level": 0.8,
+        "energy_level": lambda intensity: max(0.3, 0.5 - intensity * 0.2),
+        "suggested_emojis": ["😊", "💙", "✨", "🫂"]
+    },
+    "confused": {
+        "tone": "patient_explanatory",
+        "emoji_frequency": lambda intensity: min(0.7, 0.5 + intensity * 0.2),
+        "empathy_level": 0.7,
+        "energy_level": 0.6,
+        "suggested_emojis": ["😊", "✨", "💡"]
+    },
+    "grateful": {
+        "tone": "warm_humble",
+        "emoji_frequency": lambda intensity: min(0.8, 0.6 + intensity * 0.2),
+        "empathy_level": 0.6,
+        "energy_level": lambda intensity: min(0.8, 0.6 + intensity * 0.2),
+        "suggested_emojis": ["😊", "💛", "✨", "🫂"]
+    },
+    "neutral": {
+        "tone": "balanced_friendly",
+        "emoji_frequency": 0.5,
+        "empathy_level": 0.6,
+        "energy_level": 0.6,
+        "suggested_emojis": ["😊", "✨"]
+    }
+})
 
 class EnhancedEmotionDetector:
     def __init__(self):
-        self.emotion_dictionary = {
-            "joy": {
-                "keywords": ["開心", "快樂", "高興", "興奮", "爽", "棒", "讚", "好", "耶", "哈哈", "嘻嘻"],
-                "patterns": [r"太好了", r"真棒", r"好開心", r"超級.*好", r"非常.*興奮"],
-                "intensity_multipliers": {"超級": 1.5, "非常": 1.3, "真的": 1.2, "好": 1.1}
-            },
-            "sadness": {
-                "keywords": ["難過", "傷心", "哭", "沮喪", "失望", "憂鬱", "痛苦", "嗚嗚"],
-                "patterns": [r"好難過", r"想哭", r"心情.*低落", r"很失望", r"受傷"],
-                "intensity_multipliers": {"超級": 1.5, "非常": 1.3, "真的": 1.2, "好": 1.1}
-            },
-            "anger": {
-                "keywords": ["生氣", "憤怒", "氣死", "討厭", "煩", "爛", "可惡"],
-                "patterns": [r"氣死.*了", r"超級.*煩", r"真的.*討厭", r"受不了"],
-                "intensity_multipliers": {"超級": 1.8, "非常": 1.5, "真的": 1.3, "好": 1.2}
-            },
-            "fear": {
-                "keywords": ["害怕", "恐懼", "緊張", "擔心", "焦慮", "怕", "驚", "慌"],
-                "patterns": [r"好怕", r"很緊張", r"擔心.*得", r"焦慮.*不安"],
-                "intensity_multipliers": {"超級": 1.6, "非常": 1.4, "真的": 1.2, "好": 1.1}
-            },
-            "love": {
-                "keywords": ["愛", "喜歡", "心動", "溫暖", "甜蜜", "幸福"],
-                "patterns": [r"好愛", r"很喜歡", r"心動.*了", r"好甜蜜", r"感覺.*溫暖"],
-                "intensity_multipliers": {"超級": 1.4, "非常": 1.3, "真的": 1.2, "好": 1.1}
-            },
-            "tired": {
-                "keywords": ["累", "疲憊", "睏", "想睡", "沒力", "筋疲力盡"],
-                "patterns": [r"好累", r"累死.*了", r"沒.*力氣", r"想睡覺"],
-                "intensity_multipliers": {"超級": 1.5, "非常": 1.3, "真的": 1.2, "好": 1.1}
-            },
-            "confused": {
-                "keywords": ["困惑", "不懂", "搞不懂", "迷惑", "？", "??"],
-                "patterns": [r"搞不懂", r"不明白", r"很困惑", r"看不懂"],
-                "intensity_multipliers": {"完全": 1.5, "真的": 1.3, "好": 1.1}
-            },
-            "grateful": {
-                "keywords": ["謝謝", "感謝", "感恩", "謝", "3Q", "thx"],
-                "patterns": [r"謝謝.*你", r"真的.*感謝", r"好感謝", r"太感謝"],
-                "intensity_multipliers": {"超級": 1.4, "非常": 1.3, "真的": 1.2, "好": 1.1}
+        # 共用模組層級的詞典，建立實例不再重建
+        self.emotion_dictionary = EMOTION_DICTIONARY
+
+    def scan(self, text: str) -> dict:
+        """單次掃描文字，取得各情緒的關鍵字命中數、句型命中數與出現的強化詞"""
+        found, keyword_hits, pattern_hits = _scan(text)
+
+        if _MATCHER_INDEX["intensifier_indices"].isdisjoint(found):
+            intensifiers = {emotion: [] for emotion in self.emotion_dictionary}
+        else:
+            intensifiers = {
+                emotion: [(word, multiplier) for index, word, multiplier in specs if index in found]
+                for emotion, specs in _MATCHER_INDEX["intensifiers"].items()
             }
+
+        return {
+            "keyword_hits": keyword_hits,
+            "pattern_hits": pattern_hits,
+            "intensifiers": intensifiers,
+            "keyword_score": sum(keyword_hits.values())
         }
 
     def analyze_emotion(self, text: str) -> dict:
@@ -51,22 +248,13 @@ class EnhancedEmotionDetector:
             return {"dominant_emotion": "neutral", "emotions": {}, "intensity": 0.5, "confidence": 0.0}
         
         emotions_scores = {}
-        text_lower = text.lower()
+        scan = self.scan(text)
         
-        for emotion, data in self.emotion_dictionary.items():
-            score = 0
-            
-            for keyword in data["keywords"]:
-                if keyword.lower() in text_lower:
-                    score += 1
+        for emotion in self.emotion_dictionary:
+            score = scan["keyword_hits"][emotion] + 1.5 * scan["pattern_hits"][emotion]
             
-            for pattern in data.get("patterns", []):
-                if re.search(pattern, text):
-                    score += 1.5
-            
-            for intensifier, multiplier in data.get("intensity_multipliers", {}).items():
-                if intensifier in text_lower:
-                    score *= multiplier
+            for _, multiplier in scan["intensifiers"][emotion]:
+                score *= multiplier
             
             if score > 0:
                 emotions_scores[emotion] = score
@@ -90,20 +278,37 @@ class EnhancedEmotionDetector:
             "confidence": confidence
         }
 
+    def analyze_emotions_batch(self, texts, processes: int = None) -> list:
+        """批次情感分析，結果與逐筆呼叫 analyze_emotion 相同。
+
+        只有一顆 CPU 或筆數少於 EMOTION_BATCH_PROCESS_THRESHOLD 時直接逐筆計算；
+        否則分散到共用的行程池（只建立一次）。
+        """
+        texts = list(texts)
+        if processes is None:
+            processes = EMOTION_BATCH_PROCESSES
+        if processes <= 1 or (os.cpu_count() or 1) <= 1 or len(texts) < EMOTION_BATCH_PROCESS_THRESHOLD:
+            return [self.analyze_emotion(text) for text in texts]
+
+        chunk_size = -(-len(texts) // processes)
+        chunks = [texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)]
+        pool = get_emotion_process_pool()
+        return [result for part in pool.map(_analyze_batch, chunks) for result in part]
+
     def _analyze_intensity(self, text: str) -> float:
         """分析語調強度"""
         intensity = 0.5
         
-        if re.search(r"!!+", text):
+        if _EXCLAMATION_RE.search(text):
             intensity *= 1.5
-        if re.search(r"\?!+", text):
+        if _INTERROBANG_RE.search(text):
             intensity *= 1.3
         
         caps_count = sum(1 for c in text if c.isupper())
         if caps_count > len(text) * 0.3:
             intensity *= 1.3
         
-        if re.search(r"(.)\1{2,}", text):
+        if _REPEATED_CHAR_RE.search(text):
             intensity *= 1.2
         
         if len(text) < 10:
@@ -117,71 +322,32 @@ class EnhancedEmotionDetector:
         """根據情感分析結果生成回應風格"""
         dominant_emotion = emotion_analysis["dominant_emotion"]
         intensity = emotion_analysis["intensity"]
-        
-        response_styles = {
-            "joy": {
-                "tone": "cheerful_enthusiastic",
-                "emoji_frequency": min(0.9, 0.6 + intensity * 0.3),
-                "empathy_level": 0.7,
-                "energy_level": min(1.0, 0.6 + intensity * 0.4),
-                "suggested_emojis": ["😊", "😄", "🎉", "✨", "💛"]
-            },
-            "sadness": {
-                "tone": "gentle_comforting",
-                "emoji_frequency": min(0.8, 0.4 + intensity * 0.4),
-                "empathy_level": min(1.0, 0.8 + intensity * 0.2),
-                "energy_level": max(0.3, 0.6 - intensity * 0.3),
-                "suggested_emojis": ["🫂", "💙", "✨"]
-            },
-            "anger": {
-                "tone": "calm_understanding",
-                "emoji_frequency": max(0.3, 0.6 - intensity * 0.3),
-                "empathy_level": min(1.0, 0.7 + intensity * 0.3),
-                "energy_level": max(0.4, 0.7 - intensity * 0.2),
-                "suggested_emojis": ["💙", "🫂", "✨"]
-            },
-            "fear": {
-                "tone": "reassuring_supportive",
-                "emoji_frequency": min(0.7, 0.5 + intensity * 0.2),
-                "empathy_level": min(1.0, 0.8 + intensity * 0.2),
-                "energy_level": max(0.5, 0.7 - intensity * 0.2),
-                "suggested_emojis": ["🫂", "💙", "✨", "😊"]
-            },
-            "love": {
-                "tone": "warm_affectionate",
-                "emoji_frequency": min(0.9, 0.7 + intensity * 0.2),
-                "empathy_level": 0.8,
-                "energy_level": min(0.9, 0.7 + intensity * 0.2),
-                "suggested_emojis": ["💛", "✨", "💕"]
-            },
-            "tired": {
-                "tone": "gentle_caring",
-                "emoji_frequency": min(0.6, 0.4 + intensity * 0.2),
-                "empathy_level": 0.8,
-                "energy_level": max(0.3, 0.5 - intensity * 0.2),
-                "suggested_emojis": ["😊", "💙", "✨", "🫂"]
-            },
-            "confused": {
-                "tone": "patient_explanatory",
-                "emoji_frequency": min(0.7, 0.5 + intensity * 0.2),
-                "empathy_level": 0.7,
-                "energy_level": 0.6,
-                "suggested_emojis": ["😊", "✨", "💡"]
-            },
-            "grateful": {
-                "tone": "warm_humble",
-                "emoji_frequency": min(0.8, 0.6 + intensity * 0.2),
-                "empathy_level": 0.6,
-                "energy_level": min(0.8, 0.6 + intensity * 0.2),
-                "suggested_emojis": ["😊", "💛", "✨", "🫂"]
-            },
-            "neutral": {
-                "tone": "balanced_friendly",
-                "emoji_frequency": 0.5,
-                "empathy_level": 0.6,
-                "energy_level": 0.6,
-                "suggested_emojis": ["😊", "✨"]
-            }
+
+        style = RESPONSE_STYLES.get(dominant_emotion, RESPONSE_STYLES["neutral"])
+        return {
+            key: value(intensity) if callable(value) else list(value) if isinstance(value, tuple) else value
+            for key, value in style.items()
         }
-        
-        return response_styles.get(dominant_emotion, response_styles["neutral"])
+
+def _analyze_batch(texts: list) -> list:
+    """行程池的工作函式：逐筆呼叫 analyze_emotion"""
+    detector = EnhancedEmotionDetector()
+    return [detector.analyze_emotion(text) for text in texts]
+
+_process_pool: ProcessPoolExecutor = None # 單例變數，只建立一次
+_process_pool_lock = threading.Lock()
+
+def get_emotion_process_pool() -> ProcessPoolExecutor:
+    """獲取批次情感分析共用的行程池（單例模式）；行程啟動成本只付一次。"""
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            _process_pool = ProcessPoolExecutor(max_workers=EMOTION_BATCH_PROCESSES)
+        return _process_pool
+
+def close_emotion_process_pool():
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is not None:
+            _process_pool.shutdown(wait=True)
+            _process_pool = None
@@ -1,10 +1,149 @@
 import os
+import time
+import base64
+import asyncio
+import hashlib
+import tempfile
 from typing import Optional, Tuple
+from urllib.parse import urljoin
 import mimetypes
+import httpx
+import aiofiles
+
+# 單一檔案大小上限（位元組）
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(50 * 1024 * 1024)))
+# 讀取 / 計算雜湊時每次處理的區塊大小
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+# 暫存檔超過此大小就從記憶體移到磁碟
+UPLOAD_SPOOL_MEMORY = int(os.getenv("UPLOAD_SPOOL_MEMORY", str(1024 * 1024)))
+# 超過此大小改用 TUS 續傳（Supabase 建議 6MB 以上使用），否則一次上傳
+UPLOAD_RESUMABLE_THRESHOLD = int(os.getenv("UPLOAD_RESUMABLE_THRESHOLD", str(6 * 1024 * 1024)))
+UPLOAD_MAX_RETRIES = int(os.getenv("UPLOAD_MAX_RETRIES", "3"))
+UPLOAD_TIMEOUT = float(os.getenv("UPLOAD_TIMEOUT", "60"))
+# 同時進行的下載數上限與每次寫入磁碟的區塊大小
+DOWNLOAD_MAX_CONCURRENCY = int(os.getenv("DOWNLOAD_MAX_CONCURRENCY", "4"))
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DOWNLOAD_CHUNK_SIZE", str(256 * 1024)))
+DOWNLOAD_MAX_RETRIES = int(os.getenv("DOWNLOAD_MAX_RETRIES", "3"))
+DOWNLOAD_TIMEOUT = float(os.getenv("DOWNLOAD_TIMEOUT", "60"))
+# Supabase 的 TUS 端點規定每個區塊固定 6MB（最後一塊除外）
+TUS_CHUNK_SIZE = 6 * 1024 * 1024
+
+class UploadTooLarge(ValueError):
+    """檔案超過 MAX_UPLOAD_BYTES"""
+
+def guess_content_type(file_name: str) -> str:
+    mime_type, _ = mimetypes.guess_type(file_name)
+    return mime_type or "application/octet-stream"
+
+def storage_path(digest: str, file_name: str) -> str:
+    """以內容雜湊命名物件，相同內容只會存一份"""
+    return f"{digest}{os.path.splitext(file_name)[1].lower()}"
+
+def hash_fileobj(fileobj, max_bytes: int = MAX_UPLOAD_BYTES) -> Tuple[str, int]:
+    """分塊計算已在磁碟上的檔案的 sha256 與大小，完成後把位置移回開頭"""
+    digest, size = hashlib.sha256(), 0
+    fileobj.seek(0)
+    while chunk := fileobj.read(UPLOAD_CHUNK_SIZE):
+        size += len(chunk)
+        if size > max_bytes:
+            raise UploadTooLarge(f"檔案超過 {max_bytes} bytes 上限")
+        digest.update(chunk)
+    fileobj.seek(0)
+    return digest.hexdigest(), size
+
+async def limit_stream(chunks, max_bytes: int):
+    """轉送非同步的位元組串流，累計超過 max_bytes 時立即以 UploadTooLarge 中止（不需要 Content-Length）"""
+    size = 0
+    async for chunk in chunks:
+        size += len(chunk)
+        if size > max_bytes:
+            raise UploadTooLarge(f"檔案超過 {max_bytes} bytes 上限")
+        yield chunk
+
+async def spool_stream(chunks, max_bytes: int = MAX_UPLOAD_BYTES):
+    """把非同步的位元組串流寫入暫存檔，同時計算 sha256；超過上限立即中止。
+
+    回傳 (暫存檔, sha256, 大小)，呼叫端負責關閉暫存檔。
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MEMORY)
+    digest, size = hashlib.sha256(), 0
+    try:
+        async for chunk in chunks:
+            size += len(chunk)
+            if size > max_bytes:
+                raise UploadTooLarge(f"檔案超過 {max_bytes} bytes 上限")
+            digest.update(chunk)
+            spool.write(chunk)
+    except BaseException:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool, digest.hexdigest(), size
+
+def upload_fileobj(client, bucket_name: str, path: str, fileobj, size: int, content_type: str) -> bool:
+    """把檔案上傳到 Supabase Storage（阻塞呼叫，請在執行緒池中執行）。
+
+    物件已存在（相同內容）時跳過並回傳 True；小檔一次上傳，大檔以 TUS 分塊續傳，
+    記憶體用量最多一個區塊。
+    """
+    bucket = client.storage.from_(bucket_name)
+    if bucket.exists(path):
+        return True
+    fileobj.seek(0)
+    if size <= UPLOAD_RESUMABLE_THRESHOLD:
+        bucket.upload(path, fileobj.read(), file_options={"content-type": content_type})
+    else:
+        _tus_upload(client, bucket_name, path, fileobj, size, content_type)
+    return False
+
+def _tus_upload(client, bucket_name: str, path: str, fileobj, size: int, content_type: str):
+    """Supabase 的 TUS 續傳：建立上傳後逐塊 PATCH，失敗時以 HEAD 取得伺服器端的進度再續傳"""
+    endpoint = urljoin(str(client.storage_url), "upload/resumable")
+    headers = {
+        "authorization": f"Bearer {client.supabase_key}",
+        "apikey": client.supabase_key,
+        "tus-resumable": "1.0.0"
+    }
+    metadata = {"bucketName": bucket_name, "objectName": path, "contentType": content_type, "cacheControl": "3600"}
+    with httpx.Client(timeout=UPLOAD_TIMEOUT) as http:
+        created = http.post(endpoint, headers={
+            **headers,
+            "upload-length": str(size),
+            "upload-metadata": ",".join(
+                f"{key} {base64.b64encode(value.encode('utf-8')).decode('ascii')}" for key, value in metadata.items()
+            )
+        })
+        if created.status_code == 409:
+            return  # 同一內容正在 / 已經上傳
+        created.raise_for_status()
+        location = urljoin(endpoint, created.headers["location"])
+
+        offset, failures = 0, 0
+        while offset < size:
+            fileobj.seek(offset)
+            chunk = fileobj.read(TUS_CHUNK_SIZE)
+            try:
+                response = http.patch(location, content=chunk, headers={
+                    **headers,
+                    "upload-offset": str(offset),
+                    "content-type": "application/offset+octet-stream"
+                })
+                response.raise_for_status()
+                offset = int(response.headers["upload-offset"])
+                failures = 0
+            except httpx.HTTPError as e:
+                failures += 1
+                if failures > UPLOAD_MAX_RETRIES:
+                    raise
+                print(f"⚠️ 分塊上傳失敗，{failures} 秒後續傳：{e}")
+                time.sleep(failures)
+                progress = http.head(location, headers=headers)
+                progress.raise_for_status()
+                offset = int(progress.headers["upload-offset"])
 
 async def handle_file(file_path: str, supabase_client, bucket_name: str = "files") -> Tuple[bool, str, Optional[str]]:
     """
-    處理檔案上傳到 Supabase Storage
+    處理檔案上傳到 Supabase Storage（分塊讀取與上傳，不會把整個檔案載入記憶體）
     
     Returns:
         Tuple[success: bool, message: str, file_url: Optional[str]]
@@ -14,44 +153,131 @@ async def handle_file(file_path: str, supabase_client, bucket_name: str = "files
             return False, "檔案不存在", None
         
         file_name = os.path.basename(file_path)
+        # 先用檔案大小擋掉過大的檔案，不必讀取內容
+        if os.path.getsize(file_path) > MAX_UPLOAD_BYTES:
+            return False, f"檔案上傳失敗: 檔案超過 {MAX_UPLOAD_BYTES} bytes 上限", None
         
-        with open(file_path, 'rb') as f:
-            file_data = f.read()
+        def upload():
+            with open(file_path, 'rb') as f:
+                digest, size = hash_fileobj(f)
+                path = storage_path(digest, file_name)
+                deduplicated = upload_fileobj(supabase_client, bucket_name, path, f, size, guess_content_type(file_name))
+            return path, deduplicated
         
-        mime_type, _ = mimetypes.guess_type(file_path)
-        if not mime_type:
-            mime_type = 'application/octet-stream'
-        
-        result = supabase_client.storage.from_(bucket_name).upload(
-            file_name,
-            file_data,
-            file_options={"content-type": mime_type}
-        )
-        
-        file_url = supabase_client.storage.from_(bucket_name).get_public_url(file_name)
+        path, deduplicated = await asyncio.to_thread(upload)
+        file_url = supabase_client.storage.from_(bucket_name).get_public_url(path)
         
+        if deduplicated:
+            return True, f"檔案已存在，略過上傳: {file_name}", file_url
         return True, f"檔案上傳成功: {file_name}", file_url
         
     except Exception as e:
         return False, f"檔案上傳失敗: {str(e)}", None
 
-async def download_full_file(file_url: str, save_path: str) -> Tuple[bool, str]:
+async def _hash_existing(path: str, digest) -> int:
+    """續傳前把已下載的部分加入雜湊，回傳其大小"""
+    size = 0
+    async with aiofiles.open(path, 'rb') as f:
+        while chunk := await f.read(DOWNLOAD_CHUNK_SIZE):
+            digest.update(chunk)
+            size += len(chunk)
+    return size
+
+async def _download_once(client: httpx.AsyncClient, file_url: str, part_path: str):
+    """下載（或從 .part 續傳）一次；回傳 (伺服器宣告的檔案總長度（未知時為 None）, 整個檔案的 sha256)"""
+    digest = hashlib.sha256()
+    offset = await _hash_existing(part_path, digest) if os.path.exists(part_path) else 0
+    # 要求不壓縮：Content-Length 與 Range 都以傳輸的 bytes 計算，必須與寫入磁碟的內容一致
+    headers = {"Accept-Encoding": "identity"}
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+    async with client.stream("GET", file_url, headers=headers) as response:
+        if response.status_code == 416 and offset:
+            return offset, digest  # 已完整下載
+        response.raise_for_status()
+        if offset and response.status_code != 206:
+            # 伺服器不支援 Range，從頭下載
+            digest = hashlib.sha256()
+            offset = 0
+        if response.headers.get("content-encoding", "identity").lower() == "identity":
+            total = response.headers.get("content-length")
+            total = offset + int(total) if total is not None else None
+            chunks = response.aiter_raw(DOWNLOAD_CHUNK_SIZE)
+        else:
+            # 伺服器仍然壓縮時寫入解壓後的內容，Content-Length 是壓縮後的長度，不能用來檢查
+            total = None
+            chunks = response.aiter_bytes(DOWNLOAD_CHUNK_SIZE)
+        async with aiofiles.open(part_path, 'ab' if offset else 'wb') as f:
+            async for chunk in chunks:
+                digest.update(chunk)
+                await f.write(chunk)
+        return total, digest
+
+async def download_full_file(file_url: str, save_path: str, expected_sha256: Optional[str] = None,
+                             transport: Optional[httpx.AsyncBaseTransport] = None) -> Tuple[bool, str]:
     """
-    從 Supabase Storage 下載檔案
+    從 Supabase Storage 下載檔案：分塊串流寫入 <save_path>.part，中斷時以 Range 續傳，
+    完成並通過檢查（長度、sha256）後才改名為 save_path
+    
+    transport 可注入 httpx 的 transport（例如測試用的 MockTransport），未指定時使用共用連線池
     
     Returns:
         Tuple[success: bool, message: str]
     """
+    part_path = save_path + ".part"
+    client = httpx.AsyncClient(transport=transport, timeout=DOWNLOAD_TIMEOUT) if transport else get_download_client()
     try:
-        import requests
-        
-        response = requests.get(file_url)
-        response.raise_for_status()
-        
-        with open(save_path, 'wb') as f:
-            f.write(response.content)
+        async with _get_download_semaphore():
+            for attempt in range(DOWNLOAD_MAX_RETRIES + 1):
+                try:
+                    total, digest = await _download_once(client, file_url, part_path)
+                    break
+                except httpx.TransportError as e:
+                    if attempt == DOWNLOAD_MAX_RETRIES:
+                        raise
+                    print(f"⚠️ 下載中斷，續傳中（第 {attempt + 1} 次）：{e}")
+                    await asyncio.sleep(attempt + 1)
+
+        size = os.path.getsize(part_path)
+        if total is not None and size != total:
+            os.remove(part_path)
+            return False, f"檔案下載失敗: 長度不符（{size} / {total} bytes）"
+        if expected_sha256 and digest.hexdigest() != expected_sha256.lower():
+            os.remove(part_path)
+            return False, "檔案下載失敗: sha256 不符"
+        os.replace(part_path, save_path)
         
         return True, f"檔案下載成功: {save_path}"
         
     except Exception as e:
         return False, f"檔案下載失敗: {str(e)}"
+    finally:
+        if transport:
+            await client.aclose()
+
+_download_client: httpx.AsyncClient = None # 單例變數，只建立一次
+_download_semaphore: asyncio.Semaphore = None
+
+def get_download_client() -> httpx.AsyncClient:
+    """獲取下載共用的 httpx 連線池（單例模式）。"""
+    global _download_client
+    if _download_client is None:
+        _download_client = httpx.AsyncClient(
+            timeout=DOWNLOAD_TIMEOUT,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=DOWNLOAD_MAX_CONCURRENCY * 2)
+        )
+    return _download_client
+
+def _get_download_semaphore() -> asyncio.Semaphore:
+    global _download_semaphore
+    if _download_semaphore is None:
+        _download_semaphore = asyncio.Semaphore(DOWNLOAD_MAX_CONCURRENCY)
+    return _download_semaphore
+
+async def close_download_client():
+    """應用關閉時釋放連線池"""
+    global _download_client
+    if _download_client is not None:
+        await _download_client.aclose()
+        _download_client = None
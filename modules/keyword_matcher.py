@@ -0,0 +1,56 @@
+from collections import deque
+
+class AhoCorasick:
+    """多關鍵字比對自動機：對文字做一次線性掃描，找出所有關鍵字（可重疊）的出現位置"""
+
+    def __init__(self, words):
+        self.words = list(dict.fromkeys(word for word in words if word))
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [()]
+        self._lengths = [len(word) for word in self.words]
+
+        for index, word in enumerate(self.words):
+            state = 0
+            for char in word:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][char] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(())
+                state = next_state
+            self._out[state] = self._out[state] + (index,)
+
+        # 以 BFS 建立失敗連結，並把失敗狀態的輸出合併進來
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._out[next_state] = self._out[next_state] + self._out[self._fail[next_state]]
+
+    def find_all(self, text: str) -> dict:
+        """回傳 {關鍵字索引: [起始位置, ...]}（位置由小到大）"""
+        goto, fail, out, lengths = self._goto, self._fail, self._out, self._lengths
+        found = {}
+        state = 0
+        for position, char in enumerate(text):
+            next_state = goto[state].get(char)
+            while next_state is None and state:
+                state = fail[state]
+                next_state = goto[state].get(char)
+            state = next_state or 0
+            if out[state]:
+                for index in out[state]:
+                    starts = found.get(index)
+                    if starts is None:
+                        found[index] = [position - lengths[index] + 1]
+                    else:
+                        starts.append(position - lengths[index] + 1)
+        return found
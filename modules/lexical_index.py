@@ -0,0 +1,185 @@
+import os
+import re
+import math
+import asyncio
+import unicodedata
+from collections import OrderedDict, Counter
+from modules.vector_index import RECALL_MEMORY_TYPES
+
+LEXICAL_INDEX_MAX_SHARDS = int(os.getenv("LEXICAL_INDEX_MAX_SHARDS", "256"))
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+# reciprocal rank fusion 的平滑常數
+RRF_K = int(os.getenv("RRF_K", "60"))
+
+SHARD_FIELDS = ["id", "user_message", "assistant_message", "created_at", "importance_score", "access_count", "memory_type"]
+
+_CJK_RE = re.compile(r"[぀-ヿ㐀-䶿一-鿿豈-﫿가-힯]+")
+_WORD_RE = re.compile(r"[0-9a-z_]+")
+
+def tokenize(text: str) -> list:
+    """CJK 連續字串切成字元雙字（bigram），單一字元則保留單字；英數字以單字為詞"""
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    tokens = []
+    for run in _CJK_RE.findall(text):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    tokens.extend(_WORD_RE.findall(text))
+    return tokens
+
+def reciprocal_rank_fusion(rankings: list, k: int = RRF_K) -> list:
+    """以 RRF 合併多個依 id 排序的結果清單，回傳合併後的記憶列（附 rrf_score）"""
+    scores, rows = {}, {}
+    for ranking in rankings:
+        for rank, row in enumerate(ranking):
+            scores[row["id"]] = scores.get(row["id"], 0.0) + 1.0 / (k + rank + 1)
+            rows[row["id"]] = {**row, **rows.get(row["id"], {})}
+    ordered = sorted(scores, key=lambda memory_id: -scores[memory_id])
+    return [{**rows[memory_id], "rrf_score": scores[memory_id]} for memory_id in ordered]
+
+class BM25Shard:
+    """單一對話的倒排索引（BM25）"""
+
+    def __init__(self, conversation_id: str):
+        self.conversation_id = conversation_id
+        self.rows = {}
+        self.lengths = {}
+        self.postings = {}  # token -> {memory_id: 詞頻}
+        self.total_length = 0
+
+    @property
+    def max_id(self):
+        return max(self.rows, default=0)
+
+    def upsert(self, row: dict):
+        memory_id = row["id"]
+        if memory_id in self.rows:
+            self.remove([memory_id])
+        tokens = Counter(tokenize(f"{row.get('user_message') or ''} {row.get('assistant_message') or ''}"))
+        self.rows[memory_id] = {field: row.get(field) for field in SHARD_FIELDS}
+        self.lengths[memory_id] = sum(tokens.values())
+        self.total_length += self.lengths[memory_id]
+        for token, frequency in tokens.items():
+            self.postings.setdefault(token, {})[memory_id] = frequency
+
+    def remove(self, memory_ids):
+        removed = {memory_id for memory_id in memory_ids if memory_id in self.rows}
+        if not removed:
+            return
+        for token in list(self.postings):
+            postings = self.postings[token]
+            for memory_id in removed & postings.keys():
+                del postings[memory_id]
+            if not postings:
+                del self.postings[token]
+        for memory_id in removed:
+            self.total_length -= self.lengths.pop(memory_id, 0)
+            del self.rows[memory_id]
+
+    def search(self, query: str, k: int) -> list:
+        """回傳 BM25 分數最高的 k 筆記憶（附 bm25_score 欄位）"""
+        if not self.rows:
+            return []
+        count = len(self.rows)
+        average_length = self.total_length / count or 1.0
+        scores = {}
+        for token in set(tokenize(query)):
+            postings = self.postings.get(token)
+            if not postings:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for memory_id, frequency in postings.items():
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[memory_id] / average_length)
+                scores[memory_id] = scores.get(memory_id, 0.0) + idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+        top = sorted(scores, key=lambda memory_id: -scores[memory_id])[:k]
+        return [{**self.rows[memory_id], "bm25_score": scores[memory_id]} for memory_id in top]
+
+class LexicalIndex:
+    """依 conversation_id 分片的 BM25 索引：第一次查詢時從 Supabase 載入一次，之後由 save_memory 增量更新"""
+
+    def __init__(self, supabase_client, memories_table: str, max_shards: int = LEXICAL_INDEX_MAX_SHARDS):
+        self.supabase = supabase_client
+        self.memories_table = memories_table
+        self.max_shards = max_shards
+        self._shards = OrderedDict()
+        self._loading = {}
+        self.stats = {"searches": 0, "loads": 0, "evictions": 0}
+
+    async def search(self, conversation_id: str, query: str, k: int) -> list:
+        shard = await self._get_shard(conversation_id)
+        if shard is None:
+            return []
+        self.stats["searches"] += 1
+        return shard.search(query, k)
+
+    def upsert(self, conversation_id: str, row: dict):
+        """同步新寫入的記憶；分片尚未載入時不處理，載入時會從資料庫讀到"""
+        shard = self._shards.get(conversation_id)
+        if shard is not None:
+            shard.upsert(row)
+
+    def remove(self, conversation_id: str, memory_ids):
+        shard = self._shards.get(conversation_id)
+        if shard is not None:
+            shard.remove(memory_ids)
+
+    async def _get_shard(self, conversation_id: str):
+        shard = self._shards.get(conversation_id)
+        if shard is not None:
+            self._shards.move_to_end(conversation_id)
+            return shard
+
+        task = self._loading.get(conversation_id)
+        if task is None:
+            task = asyncio.ensure_future(self._load(conversation_id))
+            self._loading[conversation_id] = task
+            task.add_done_callback(lambda _: self._loading.pop(conversation_id, None))
+        return await asyncio.shield(task)
+
+    async def _load(self, conversation_id: str, page_size: int = 1000):
+        shard = BM25Shard(conversation_id)
+        try:
+            last_id = 0
+            while True:
+                result = await self.supabase.execute(
+                    self.supabase.table(self.memories_table)
+                    .select(", ".join(SHARD_FIELDS))
+                    .eq("conversation_id", conversation_id)
+                    .in_("memory_type", RECALL_MEMORY_TYPES)
+                    .gt("id", last_id)
+                    .order("id")
+                    .limit(page_size)
+                )
+                for row in result.data or []:
+                    shard.upsert(row)
+                if not result.data or len(result.data) < page_size:
+                    break
+                last_id = result.data[-1]["id"]
+        except Exception as e:
+            print(f"❌ 載入關鍵字索引失敗：{e}")
+            return None
+
+        self.stats["loads"] += 1
+        self._shards[conversation_id] = shard
+        while len(self._shards) > self.max_shards:
+            self._shards.popitem(last=False)
+            self.stats["evictions"] += 1
+        return shard
+
+    def get_metrics(self) -> dict:
+        return {
+            "shards": len(self._shards),
+            "documents": sum(len(shard.rows) for shard in self._shards.values()),
+            **self.stats
+        }
+
+_lexical_index: LexicalIndex = None # 單例變數，只建立一次
+
+def get_lexical_index(supabase_client=None, memories_table: str = None):
+    """獲取行程內共用的關鍵字索引（單例模式）。"""
+    global _lexical_index
+    if _lexical_index is None and supabase_client is not None:
+        _lexical_index = LexicalIndex(supabase_client, memories_table)
+    return _lexical_index
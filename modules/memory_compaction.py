@@ -0,0 +1,209 @@
+import os
+import asyncio
+from datetime import datetime
+
+# 背景記憶壓縮：把較舊的對話逐段摘要成 archived 記錄，摘要再逐層合併
+# 預設關閉：會在背景呼叫 LLM（產生費用），且需要先執行 DATABASE_SETUP.md 的 summary_level / source_end_id 欄位遷移
+MEMORY_COMPACTION = os.getenv("MEMORY_COMPACTION", "0") == "1"
+COMPACTION_MODEL = os.getenv("COMPACTION_MODEL", "gpt-4o-mini")
+COMPACTION_INTERVAL = float(os.getenv("COMPACTION_INTERVAL", "300"))
+# 每段摘要涵蓋的對話輪數；最近的 COMPACTION_KEEP_RECENT 輪保持原樣
+COMPACTION_CHUNK_SIZE = int(os.getenv("COMPACTION_CHUNK_SIZE", "10"))
+COMPACTION_KEEP_RECENT = int(os.getenv("COMPACTION_KEEP_RECENT", "20"))
+COMPACTION_MAX_CHUNKS = int(os.getenv("COMPACTION_MAX_CHUNKS", "5"))
+# 同一層摘要超過此數量時，最舊的 COMPACTION_FANOUT 筆合併成上一層
+COMPACTION_FANOUT = int(os.getenv("COMPACTION_FANOUT", "5"))
+COMPACTION_SUMMARY_MAX_TOKENS = int(os.getenv("COMPACTION_SUMMARY_MAX_TOKENS", "200"))
+# 清理（選用）：已被摘要涵蓋、重要度與存取次數都低的原始對話會被刪除
+COMPACTION_PRUNE = os.getenv("COMPACTION_PRUNE", "0") == "1"
+COMPACTION_PRUNE_IMPORTANCE = float(os.getenv("COMPACTION_PRUNE_IMPORTANCE", "0.3"))
+COMPACTION_PRUNE_ACCESS = int(os.getenv("COMPACTION_PRUNE_ACCESS", "1"))
+
+SUMMARY_FIELDS = "id, assistant_message, summary_level, source_end_id, importance_score, created_at"
+
+class CompactionEngine:
+    """依對話累積的新輪數排程壓縮；每個對話以 archived 記錄的最大 source_end_id 作為水位線。"""
+
+    def __init__(self, supabase_client, memories_table: str, openai_client, indexes=(),
+                 interval: float = COMPACTION_INTERVAL):
+        self.supabase = supabase_client
+        self.memories_table = memories_table
+        self.openai_client = openai_client
+        self.indexes = [index for index in indexes if index is not None]
+        self.interval = interval
+        self._turns = {}  # conversation_id -> 上次壓縮後的新輪數
+        self._watermarks = {}
+        self._due = set()
+        self._worker = None
+        self.stats = {"runs": 0, "summaries": 0, "rollups": 0, "pruned": 0, "failed": 0}
+
+    def note_turn(self, conversation_id: str):
+        """記錄一輪新對話；第一次看到的對話會排入檢查以處理既有的舊資料"""
+        turns = self._turns.get(conversation_id)
+        self._turns[conversation_id] = (turns or 0) + 1
+        if turns is None or turns + 1 >= COMPACTION_CHUNK_SIZE:
+            self._due.add(conversation_id)
+        if self._worker is None:
+            self.start()
+
+    async def _get_summaries(self, conversation_id: str) -> list:
+        result = await self.supabase.execute(
+            self.supabase.table(self.memories_table)
+            .select(SUMMARY_FIELDS)
+            .eq("conversation_id", conversation_id)
+            .eq("memory_type", "archived")
+            .order("source_end_id")
+        )
+        return result.data or []
+
+    async def compact(self, conversation_id: str):
+        """壓縮單一對話：摘要水位線之後的舊對話、選擇性清理，再逐層合併摘要"""
+        watermark = await self._get_watermark(conversation_id)
+        fetch_limit = COMPACTION_CHUNK_SIZE * COMPACTION_MAX_CHUNKS + COMPACTION_KEEP_RECENT
+        result = await self.supabase.execute(
+            self.supabase.table(self.memories_table)
+            .select("id, user_message, assistant_message, importance_score, access_count, created_at")
+            .eq("conversation_id", conversation_id)
+            .eq("memory_type", "conversation")
+            .gt("id", watermark)
+            .order("id")
+            .limit(fetch_limit)
+        )
+        rows = result.data or []
+        compactable = len(rows) - COMPACTION_KEEP_RECENT
+        for start in range(0, compactable - COMPACTION_CHUNK_SIZE + 1, COMPACTION_CHUNK_SIZE):
+            chunk = rows[start:start + COMPACTION_CHUNK_SIZE]
+            await self._summarize_chunk(conversation_id, chunk)
+            if COMPACTION_PRUNE:
+                await self._prune(conversation_id, chunk)
+        await self._roll_up(conversation_id)
+        self.stats["runs"] += 1
+
+    async def _get_watermark(self, conversation_id: str) -> int:
+        if conversation_id not in self._watermarks:
+            result = await self.supabase.execute(
+                self.supabase.table(self.memories_table)
+                .select("source_end_id")
+                .eq("conversation_id", conversation_id)
+                .eq("memory_type", "archived")
+                .order("source_end_id", desc=True)
+                .limit(1)
+            )
+            self._watermarks[conversation_id] = (result.data[0]["source_end_id"] or 0) if result.data else 0
+        return self._watermarks[conversation_id]
+
+    async def _summarize(self, instruction: str, text: str) -> str:
+        response = await self.openai_client.chat.completions.create(
+            model=COMPACTION_MODEL,
+            messages=[
+                {"role": "system", "content": instruction},
+                {"role": "user", "content": text}
+            ],
+            max_tokens=COMPACTION_SUMMARY_MAX_TOKENS
+        )
+        return response.choices[0].message.content.strip()
+
+    async def _insert_summary(self, conversation_id: str, summary: str, level: int, source_end_id: int,
+                              importance_score: float, created_at: str) -> dict:
+        result = await self.supabase.execute(self.supabase.table(self.memories_table).insert({
+            "conversation_id": conversation_id,
+            "user_message": "記憶摘要",
+            "assistant_message": summary,
+            "memory_type": "archived",
+            "platform": "Web",
+            "document_content": summary,
+            "created_at": created_at or datetime.now().isoformat(),
+            "access_count": 0,
+            "importance_score": importance_score,
+            "summary_level": level,
+            "source_end_id": source_end_id,
+            "message_type": "text"
+        }))
+        return result.data[0]
+
+    async def _summarize_chunk(self, conversation_id: str, chunk: list):
+        history_text = "\n".join(f"用戶: {m['user_message']}\n小宸光: {m['assistant_message']}" for m in chunk)
+        summary = await self._summarize("請將以下對話歷史壓縮成一段簡短的摘要：", history_text)
+        await self._insert_summary(
+            conversation_id, summary, 1, chunk[-1]["id"],
+            max(m.get("importance_score") or 0.0 for m in chunk), chunk[-1].get("created_at")
+        )
+        # 摘要寫入成功後才推進水位線，失敗時下次會重新處理同一段
+        self._watermarks[conversation_id] = chunk[-1]["id"]
+        self.stats["summaries"] += 1
+
+    async def _prune(self, conversation_id: str, chunk: list):
+        memory_ids = [
+            m["id"] for m in chunk
+            if (m.get("importance_score") or 0.0) < COMPACTION_PRUNE_IMPORTANCE
+            and (m.get("access_count") or 0) <= COMPACTION_PRUNE_ACCESS
+        ]
+        if not memory_ids:
+            return
+        await self._delete(conversation_id, memory_ids)
+        self.stats["pruned"] += len(memory_ids)
+
+    async def _delete(self, conversation_id: str, memory_ids: list):
+        await self.supabase.execute(
+            self.supabase.table(self.memories_table).delete().in_("id", memory_ids)
+        )
+        for index in self.indexes:
+            index.remove(conversation_id, memory_ids)
+
+    async def _roll_up(self, conversation_id: str):
+        """同一層摘要超過 fanout 筆時，把最舊的 fanout 筆合併成上一層"""
+        levels = {}
+        for summary in await self._get_summaries(conversation_id):
+            levels.setdefault(summary.get("summary_level") or 1, []).append(summary)
+
+        level = 1
+        while level in levels:
+            summaries = levels[level]
+            while len(summaries) > COMPACTION_FANOUT:
+                children, summaries = summaries[:COMPACTION_FANOUT], summaries[COMPACTION_FANOUT:]
+                text = "\n".join(f"- {child['assistant_message']}" for child in children)
+                merged = await self._summarize("請將以下多段對話摘要合併成一段更精簡的摘要，保留重要的人事物與情感：", text)
+                parent = await self._insert_summary(
+                    conversation_id, merged, level + 1, children[-1]["source_end_id"],
+                    max(child.get("importance_score") or 0.0 for child in children), children[-1].get("created_at")
+                )
+                await self._delete(conversation_id, [child["id"] for child in children])
+                levels.setdefault(level + 1, []).append(parent)
+                self.stats["rollups"] += 1
+            level += 1
+
+    async def _run_periodically(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            due, self._due = self._due, set()
+            for conversation_id in due:
+                self._turns[conversation_id] = 0
+                try:
+                    await self.compact(conversation_id)
+                except Exception as e:
+                    self.stats["failed"] += 1
+                    print(f"❌ 記憶壓縮失敗：{e}")
+
+    def start(self):
+        """啟動背景壓縮工作"""
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run_periodically())
+
+    async def close(self):
+        """停止背景壓縮工作（應用關閉時呼叫）；未處理的對話留到下次啟動"""
+        if self._worker is not None:
+            self._worker.cancel()
+            await asyncio.gather(self._worker, return_exceptions=True)
+            self._worker = None
+
+    def get_metrics(self) -> dict:
+        return {"enabled": True, "due": len(self._due), **self.stats}
+
+_compaction_engine: CompactionEngine = None # 單例變數，只建立一次
+
+def get_compaction_engine(supabase_client=None, memories_table: str = None, openai_client=None, indexes=()):
+    """獲取背景記憶壓縮引擎（單例模式）；未啟用時回傳 None。"""
+    global _compaction_engine
+    if _compaction_engine is None and MEMORY_COMPACTION and supabase_client is not None and openai_client is not None:
+        _compaction_engine = CompactionEngine(supabase_client, memories_table, openai_client, indexes)
+    return _compaction_engine
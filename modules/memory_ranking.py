@@ -0,0 +1,141 @@
+import os
+import math
+import asyncio
+from collections import Counter
+from datetime import datetime, timezone
+
+# 排序權重：相關度、新近度、重要度、存取頻率
+MEMORY_RANK_W_RELEVANCE = float(os.getenv("MEMORY_RANK_W_RELEVANCE", "0.6"))
+MEMORY_RANK_W_RECENCY = float(os.getenv("MEMORY_RANK_W_RECENCY", "0.2"))
+MEMORY_RANK_W_IMPORTANCE = float(os.getenv("MEMORY_RANK_W_IMPORTANCE", "0.15"))
+MEMORY_RANK_W_ACCESS = float(os.getenv("MEMORY_RANK_W_ACCESS", "0.05"))
+# 新近度半衰期（小時）
+MEMORY_RECENCY_HALF_LIFE = float(os.getenv("MEMORY_RECENCY_HALF_LIFE", "72"))
+# 每一路搜尋取回 limit * 此倍數的候選，再交給排序階段挑選
+MEMORY_RANK_CANDIDATE_FACTOR = int(os.getenv("MEMORY_RANK_CANDIDATE_FACTOR", "3"))
+
+ACCESS_FLUSH_SIZE = int(os.getenv("ACCESS_FLUSH_SIZE", "50"))
+ACCESS_FLUSH_INTERVAL = float(os.getenv("ACCESS_FLUSH_INTERVAL", "10"))
+
+def _age_hours(created_at, now: datetime) -> float:
+    if not created_at:
+        return 0.0
+    try:
+        created = datetime.fromisoformat(created_at) if isinstance(created_at, str) else created_at
+    except ValueError:
+        return 0.0
+    if created.tzinfo is None:
+        created = created.replace(tzinfo=now.tzinfo)
+    else:
+        created = created.astimezone(now.tzinfo)
+    return max(0.0, (now - created).total_seconds() / 3600)
+
+def rank_memories(candidates: list, limit: int, now: datetime = None) -> list:
+    """依相關度、時間衰減、importance_score 與 access_count 的加權分數排序，回傳前 limit 筆（附 rank_score）。
+
+    有 RRF 分數（search_relevant_memories 合併後的候選）時，一律以 RRF 分數相對於最高分正規化作為相關度，
+    向量與關鍵字命中的候選使用同一尺度；只有未經合併的向量結果才使用 similarity，兩者皆無時視為 0。
+    """
+    if not candidates:
+        return []
+    now = now or datetime.now(timezone.utc).astimezone()
+    max_rrf = max((memory.get("rrf_score") or 0.0) for memory in candidates) or 1.0
+
+    ranked = []
+    for memory in candidates:
+        if memory.get("rrf_score") is not None:
+            relevance = memory["rrf_score"] / max_rrf
+        elif memory.get("similarity") is not None:
+            relevance = float(memory["similarity"])
+        else:
+            relevance = 0.0
+        recency = 0.5 ** (_age_hours(memory.get("created_at"), now) / MEMORY_RECENCY_HALF_LIFE)
+        importance = max(0.0, float(memory.get("importance_score") or 0.0))
+        access = math.log1p(max(0, memory.get("access_count") or 0))
+        score = (
+            MEMORY_RANK_W_RELEVANCE * relevance
+            + MEMORY_RANK_W_RECENCY * recency
+            + MEMORY_RANK_W_IMPORTANCE * importance / (1 + importance)
+            + MEMORY_RANK_W_ACCESS * access / (1 + access)
+        )
+        ranked.append({**memory, "rank_score": score})
+
+    ranked.sort(key=lambda memory: -memory["rank_score"])
+    return ranked[:limit]
+
+class AccessTracker:
+    """累積被召回記憶的 access_count 增量，批次以 increment_memory_access RPC 寫回。
+
+    累積到 flush_size 筆不同記憶或每 flush_interval 秒寫回一次；
+    submit 為寫入排程函式（例如背景寫入管線的 submit），未提供時直接寫入。
+    """
+
+    def __init__(self, supabase_client, submit=None, flush_size: int = ACCESS_FLUSH_SIZE,
+                 flush_interval: float = ACCESS_FLUSH_INTERVAL):
+        self.supabase = supabase_client
+        self.submit = submit
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._pending = Counter()
+        self._flusher = None
+        self.stats = {"recorded": 0, "flushes": 0, "flushed_rows": 0}
+
+    async def record(self, memory_ids):
+        """記錄一次召回；達到門檻時排程寫回"""
+        for memory_id in memory_ids:
+            if memory_id is not None:
+                self._pending[memory_id] += 1
+                self.stats["recorded"] += 1
+        if self._flusher is None:
+            self.start()
+        if len(self._pending) >= self.flush_size:
+            await self.flush()
+
+    async def flush(self):
+        """把目前累積的增量排程寫回"""
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, Counter()
+        if self.submit:
+            await self.submit("increment_memory_access", self._write, batch)
+        else:
+            await self._write(batch)
+
+    async def _write(self, batch: Counter):
+        memory_ids = list(batch)
+        await self.supabase.execute(self.supabase.rpc("increment_memory_access", {
+            "memory_ids": memory_ids,
+            "increments": [batch[memory_id] for memory_id in memory_ids]
+        }))
+        self.stats["flushes"] += 1
+        self.stats["flushed_rows"] += len(memory_ids)
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        """啟動定期寫回"""
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_periodically())
+
+    async def close(self):
+        """停止定期寫回並寫回剩餘增量（應用關閉時呼叫）"""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        await self.flush()
+
+    def get_metrics(self) -> dict:
+        return {"pending": len(self._pending), **self.stats}
+
+_access_tracker: AccessTracker = None # 單例變數，只建立一次
+
+def get_access_tracker(supabase_client=None, submit=None):
+    """獲取行程內共用的存取次數追蹤器（單例模式）。"""
+    global _access_tracker
+    if _access_tracker is None and supabase_client is not None:
+        _access_tracker = AccessTracker(supabase_client, submit=submit)
+    return _access_tracker
@@ -1,88 +1,190 @@
+import os
+import asyncio
+import hashlib
 from datetime import datetime
 from typing import Optional
 from modules.emotion_detector import EnhancedEmotionDetector
+from modules.embedding_cache import get_embedding_cache, normalize_text
+from modules.embedding_quantization import encode_embedding, EMBEDDING_COMPACT_FORMAT, EMBEDDING_STORE_FULL
+from modules.vector_index import get_vector_index
+from modules.lexical_index import get_lexical_index, reciprocal_rank_fusion
+from modules.memory_ranking import rank_memories, get_access_tracker, MEMORY_RANK_CANDIDATE_FACTOR
+
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+# 縮減的向量維度（text-embedding-3 系列的 dimensions 參數），未設定時使用模型預設維度
+EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS", "0")) or None
+# 快取鍵包含維度，不同維度的向量不會混用
+EMBEDDING_CACHE_MODEL = f"{EMBEDDING_MODEL}:{EMBEDDING_DIMENSIONS}" if EMBEDDING_DIMENSIONS else EMBEDDING_MODEL
+# 記憶向量的產生方式：
+#   full  - 對「使用者訊息 + 回覆」計算向量（預設，與既有資料相同；重複的內容由 embedding 快取省下呼叫）
+#   reuse - 直接沿用召回時算出的使用者訊息向量（每輪只需一次 embedding 呼叫），
+#           但向量只涵蓋使用者訊息，與既有記錄的語意不同，會讓同一張表混用兩種向量
+MEMORY_EMBEDDING_STRATEGY = os.getenv("MEMORY_EMBEDDING_STRATEGY", "full")
+# embed_many 每次 API 呼叫最多帶幾段文字
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+
+def message_hash(conversation_id: str, memory_type: str, text: str) -> str:
+    """記憶的唯一鍵（對應資料表的 message_hash 唯一索引）：對話 + 類型 + 正規化後的訊息"""
+    return hashlib.sha256(f"{conversation_id}\x1f{memory_type}\x1f{normalize_text(text or '')}".encode("utf-8")).hexdigest()
+
+class TurnEmbeddings:
+    """單輪對話的 embedding 情境：召回時算出的查詢向量，儲存記憶時可直接重用"""
+
+    def __init__(self, user_message: str):
+        self.user_message = user_message
+        self.query_embedding = None
 
 class MemorySystem:
-    def __init__(self, supabase_client, openai_client, memories_table: str):
+    def __init__(self, supabase_client, openai_client, memories_table: str, embedding_cache=None,
+                 vector_index=None, lexical_index=None, access_tracker=None):
         self.supabase = supabase_client
         self.openai_client = openai_client
         self.memories_table = memories_table
         self.emotion_detector = EnhancedEmotionDetector()
+        self.embedding_cache = embedding_cache or get_embedding_cache()
+        self.vector_index = vector_index or get_vector_index(supabase_client, memories_table)
+        self.lexical_index = lexical_index or get_lexical_index(supabase_client, memories_table)
+        self.access_tracker = access_tracker or get_access_tracker()
+
+    async def embed(self, text: str) -> list:
+        """取得文字的 embedding，快取命中時不呼叫 API"""
+        embedding = await self.embedding_cache.get(EMBEDDING_CACHE_MODEL, text)
+        if embedding is None:
+            kwargs = {"dimensions": EMBEDDING_DIMENSIONS} if EMBEDDING_DIMENSIONS else {}
+            embedding_response = await self.openai_client.embeddings.create(
+                model=EMBEDDING_MODEL,
+                input=text,
+                **kwargs
+            )
+            embedding = embedding_response.data[0].embedding
+            await self.embedding_cache.put(EMBEDDING_CACHE_MODEL, text, embedding)
+        return embedding
+
+    async def embed_many(self, texts: list) -> list:
+        """批次取得多段文字的 embedding：快取未命中的文字每 EMBEDDING_BATCH_SIZE 段合併成一次 API 呼叫"""
+        embeddings = await self.embedding_cache.get_many(EMBEDDING_CACHE_MODEL, texts)
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        kwargs = {"dimensions": EMBEDDING_DIMENSIONS} if EMBEDDING_DIMENSIONS else {}
+        for start in range(0, len(missing), EMBEDDING_BATCH_SIZE):
+            batch = missing[start:start + EMBEDDING_BATCH_SIZE]
+            embedding_response = await self.openai_client.embeddings.create(
+                model=EMBEDDING_MODEL,
+                input=[texts[i] for i in batch],
+                **kwargs
+            )
+            for i, item in zip(batch, sorted(embedding_response.data, key=lambda item: item.index)):
+                embeddings[i] = item.embedding
+            await self.embedding_cache.put_many(EMBEDDING_CACHE_MODEL, [(texts[i], embeddings[i]) for i in batch])
+        return embeddings
+
+    async def _memory_row(self, conversation_id: str, user_input: str, bot_response: str,
+                          emotion_analysis: dict, file_name: Optional[str] = None,
+                          ai_id: str = "xiaochenguang_v1", turn: Optional[TurnEmbeddings] = None) -> dict:
+        """組出一筆對話記憶（含 importance_score、embedding 與 message_hash）"""
+        length_score = (len(user_input) // 20) * 0.1
+        keyword_score = self.emotion_detector.scan(user_input)["keyword_score"] * 0.3
+        intensity_score = emotion_analysis["intensity"]
+        importance_score = length_score + keyword_score + intensity_score
+
+        if MEMORY_EMBEDDING_STRATEGY == "reuse" and turn and turn.query_embedding is not None:
+            embedding = turn.query_embedding
+        else:
+            embedding = await self.embed(f"{user_input} {bot_response}")
+
+        return {
+            "conversation_id": conversation_id,
+            "user_message": user_input,
+            "assistant_message": bot_response,
+            "embedding": embedding,
+            "memory_type": "conversation",
+            "platform": "Web",
+            "document_content": f"對話記錄: {user_input} -> {bot_response}",
+            "created_at": datetime.now().isoformat(),
+            "access_count": 1,
+            "importance_score": importance_score,
+            "file_name": file_name,
+            "ai_id": ai_id,
+            "message_type": "text",
+            "message_hash": message_hash(conversation_id, "conversation", user_input)
+        }
+
+    @staticmethod
+    def _payload(data: dict) -> dict:
+        """送到資料庫的欄位：依設定附加精簡格式的 embedding，或省略完整精度的 embedding"""
+        payload = dict(data)
+        if EMBEDDING_COMPACT_FORMAT:
+            payload["embedding_compact"] = encode_embedding(data["embedding"], EMBEDDING_COMPACT_FORMAT)
+            if not EMBEDDING_STORE_FULL:
+                del payload["embedding"]
+        return payload
+
+    def _index_saved(self, data: dict, saved: dict):
+        """把寫入成功的記憶同步到本機索引"""
+        if not saved or saved.get("id") is None:
+            return
+        row = {**data, "id": saved["id"], "access_count": saved.get("access_count", data["access_count"])}
+        if self.vector_index is not None:
+            self.vector_index.upsert(data["conversation_id"], row, data["embedding"])
+        self.lexical_index.upsert(data["conversation_id"], row)
 
     async def save_memory(self, conversation_id: str, user_input: str, bot_response: str, 
                          emotion_analysis: dict, file_name: Optional[str] = None, 
-                         ai_id: str = "xiaochenguang_v1"):
-        """添加或更新對話到記憶庫，包含 access_count 和 importance_score"""
+                         ai_id: str = "xiaochenguang_v1", turn: Optional[TurnEmbeddings] = None):
+        """添加或更新對話到記憶庫：以 message_hash 做單次 upsert，重複的訊息由資料庫累加 access_count"""
         try:
-            length_score = (len(user_input) // 20) * 0.1
-            keyword_score = sum(
-                1 for keyword in self.emotion_detector.emotion_dictionary.keys()
-                for k in self.emotion_detector.emotion_dictionary[keyword]["keywords"]
-                if k.lower() in user_input.lower()
-            ) * 0.3
-            intensity_score = emotion_analysis["intensity"]
-            importance_score = length_score + keyword_score + intensity_score
-
-            embedding_response = self.openai_client.embeddings.create(
-                model="text-embedding-3-small",
-                input=f"{user_input} {bot_response}"
-            )
-            embedding = embedding_response.data[0].embedding
-            
-            existing = self.supabase.table(self.memories_table)\
-                .select("id", "access_count")\
-                .eq("conversation_id", conversation_id)\
-                .eq("user_message", user_input)\
-                .eq("memory_type", "conversation")\
-                .execute()
-            
-            access_count = existing.data[0]["access_count"] + 1 if existing.data else 1
-            
-            data = {
-                "conversation_id": conversation_id,
-                "user_message": user_input,
-                "assistant_message": bot_response,
-                "embedding": embedding,
-                "memory_type": "conversation",
-                "platform": "Web",
-                "document_content": f"對話記錄: {user_input} -> {bot_response}",
-                "created_at": datetime.now().isoformat(),
-                "access_count": access_count,
-                "importance_score": importance_score,
-                "file_name": file_name,
-                "ai_id": ai_id,
-                "message_type": "text"
-            }
-            
-            if existing.data:
-                self.supabase.table(self.memories_table)\
-                    .update(data)\
-                    .eq("id", existing.data[0]["id"])\
-                    .execute()
-            else:
-                self.supabase.table(self.memories_table).insert(data).execute()
+            data = await self._memory_row(conversation_id, user_input, bot_response, emotion_analysis,
+                                          file_name=file_name, ai_id=ai_id, turn=turn)
+            result = await self.supabase.execute(self.supabase.rpc("upsert_memory", {"memory": self._payload(data)}))
+            saved = result.data[0] if result.data else {}
+            self._index_saved(data, saved)
             
-            print(f"✅ 記憶已儲存/更新 - 用戶: {conversation_id[:8]}..., access_count: {access_count}, importance_score: {importance_score:.2f}")
+            print(f"✅ 記憶已儲存/更新 - 用戶: {conversation_id[:8]}..., access_count: {saved.get('access_count')}, importance_score: {data['importance_score']:.2f}")
             
         except Exception as e:
             print(f"❌ 儲存記憶失敗：{e}")
+            raise
+
+    async def upsert_rows(self, rows: list) -> int:
+        """以一次 upsert_memories RPC 寫入已組好的記憶列（含 embedding 與 message_hash），並同步本機索引"""
+        # 同一批內重複的訊息只保留最後一筆（同一個 INSERT 不能更新同一列兩次）
+        rows = list({row["message_hash"]: row for row in rows}.values())
+        if not rows:
+            return 0
+        result = await self.supabase.execute(self.supabase.rpc("upsert_memories", {"memories": [self._payload(row) for row in rows]}))
+        saved = {row["message_hash"]: row for row in result.data or []}
+        for row in rows:
+            self._index_saved(row, saved.get(row["message_hash"]))
+        return len(rows)
 
-    def get_conversation_history(self, conversation_id: str, limit: int = 10):
+    async def save_memories(self, entries: list):
+        """批次版本：entries 為 save_memory 的參數（dict），一次 RPC 寫入多筆"""
+        try:
+            rows = await asyncio.gather(*(self._memory_row(**entry) for entry in entries))
+            count = await self.upsert_rows(rows)
+            if count:
+                print(f"✅ 批次儲存 {count} 筆記憶")
+            
+        except Exception as e:
+            print(f"❌ 批次儲存記憶失敗：{e}")
+            raise
+
+    async def get_conversation_history(self, conversation_id: str, limit: int = 10):
         """獲取對話歷史"""
         try:
-            result = self.supabase.table(self.memories_table)\
-                .select("user_message, assistant_messagesage, created_at")\
-                .eq("conversation_id", conversation_id)\
-                .eq("memory_type", "conversation")\
-                .order("created_at", desc=True)\
-                .limit(limit)\
-                .execute()
+            result = await self.supabase.execute(
+                self.supabase.table(self.memories_table)
+                .select("user_message, assistant_message, created_at")
+                .eq("conversation_id", conversation_id)
+                .eq("memory_type", "conversation")
+                .order("created_at", desc=True)
+                .limit(limit)
+            )
             
             if result.data:
                 history = []
                 for msg in reversed(result.data):
                     history.append(f"用戶: {msg['user_message']}")
-                    history.append(f"小宸光: {msg['assistant_messagesage']}")
+                    history.append(f"小宸光: {msg['assistant_message']}")
                 return "\n".join(history)
             return ""
             
@@ -90,74 +192,108 @@ class MemorySystem:
             print(f"❌ 獲取歷史失敗：{e}")
             return ""
 
-    async def search_relevant_memories(self, conversation_id: str, query: str, limit: int = 3):
-        """搜尋相關記憶"""
+    async def get_conversation_summary(self, conversation_id: str) -> str:
+        """獲取背景壓縮產生的分層摘要（越舊的內容層級越高），依時間順序排列"""
         try:
-            embedding_response = self.openai_client.embeddings.create(
-                model="text-embedding-3-small",
-                input=query
+            result = await self.supabase.execute(
+                self.supabase.table(self.memories_table)
+                .select("assistant_message, summary_level, source_end_id")
+                .eq("conversation_id", conversation_id)
+                .eq("memory_type", "archived")
+                .order("source_end_id")
             )
-            query_embedding = embedding_response.data[0].embedding
-            
-            result = self.supabase.rpc('match_memories', {
-                'query_embedding': query_embedding,
-                'match_count': limit,
-                'conversation_id': conversation_id
-            }).execute()
             
             if result.data:
-                memories = []
-                for memory in result.data:
-                    memories.append(f"相關記憶: {memory['user_message']} -> {memory['assistant_message']}")
-                return "\n".join(memories)
+                return "\n".join(f"- {summary['assistant_message']}" for summary in result.data)
             return ""
             
         except Exception as e:
-            print(f"❌ 搜尋記憶失敗：{e}")
-            return await self.traditional_search(conversation_id, query, limit)
+            print(f"❌ 獲取摘要失敗：{e}")
+            return ""
 
-    async def traditional_search(self, conversation_id: str, query: str, limit: int = 3):
-        """傳統文字搜尋（備用方案）"""
+    async def search_relevant_memories(self, conversation_id: str, query: str, limit: int = 3,
+                                       turn: Optional[TurnEmbeddings] = None):
+        """搜尋相關記憶：向量與關鍵字（BM25）兩路結果以 RRF 合併，再依重要度與新近度排序"""
+        candidate_count = limit * MEMORY_RANK_CANDIDATE_FACTOR
+        vector_matches, lexical_matches = await asyncio.gather(
+            self.vector_search(conversation_id, query, candidate_count, turn=turn),
+            self.lexical_search(conversation_id, query, candidate_count)
+        )
+        matches = rank_memories(reciprocal_rank_fusion([vector_matches, lexical_matches]), limit)
+        await self._record_access(matches)
+        return self._format_matches(matches)
+
+    async def vector_search(self, conversation_id: str, query: str, limit: int = 3,
+                            turn: Optional[TurnEmbeddings] = None) -> list:
+        """向量搜尋，失敗時回傳空清單"""
         try:
-            result = self.supabase.table(self.memories_table)\
-                .select("user_message, assistant_message")\
-                .eq("conversation_id", conversation_id)\
-                .eq("memory_type", "conversation")\
-                .limit(limit * 2)\
-                .execute()
+            query_embedding = await self.embed(query)
+            if turn is not None:
+                turn.query_embedding = query_embedding
             
-            if result.data:
-                relevant = []
-                query_words = query.lower().split()
-                
-                for memory in result.data:
-                    user_msg = memory['user_message'].lower()
-                    if any(word in user_msg for word in query_words):
-                        relevant.append(f"相關記憶: {memory['user_message']} -> {memory['assistant_messagesage']}")
-                        if len(relevant) >= limit:
-                            break
-                
-                return "\n".join(relevant)
-            return ""
+            matches = None
+            if self.vector_index is not None:
+                matches = await self.vector_index.search(conversation_id, query_embedding, limit)
+            if matches is None:
+                result = await self.supabase.execute(self.supabase.rpc('match_memories', {
+                    'query_embedding': query_embedding,
+                    'match_count': limit,
+                    'conversation_id': conversation_id
+                }))
+                matches = result.data
+            return matches or []
+            
+        except Exception as e:
+            print(f"❌ 搜尋記憶失敗：{e}")
+            return []
+
+    async def lexical_search(self, conversation_id: str, query: str, limit: int = 3) -> list:
+        """關鍵字搜尋：CJK 雙字倒排索引 + BM25，失敗時回傳空清單"""
+        try:
+            return await self.lexical_index.search(conversation_id, query, limit)
         except Exception as e:
             print(f"❌ 傳統搜尋失敗：{e}")
-            return ""
+            return []
+
+    async def traditional_search(self, conversation_id: str, query: str, limit: int = 3):
+        """傳統文字搜尋（備用方案）"""
+        return self._format_matches(await self.lexical_search(conversation_id, query, limit))
+
+    async def _record_access(self, matches: list):
+        """累積被召回記憶的 access_count，由追蹤器批次寫回"""
+        if self.access_tracker is not None and matches:
+            await self.access_tracker.record(memory.get("id") for memory in matches)
+
+    @staticmethod
+    def _format_matches(matches: list) -> str:
+        lines = []
+        for memory in matches:
+            if memory.get("memory_type") == "document":
+                # 文件片段可能含換行，壓成一行以免被拆開
+                lines.append(f"相關文件: {memory['user_message']} -> {' '.join((memory['assistant_message'] or '').split())}")
+            else:
+                lines.append(f"相關記憶: {memory['user_message']} -> {memory['assistant_message']}")
+        return "\n".join(lines)
 
-    async def recall_memories(self, user_message: str, conversation_id: str) -> str:
+    async def recall_memories(self, user_message: str, conversation_id: str,
+                              turn: Optional[TurnEmbeddings] = None) -> str:
         """根據使用者輸入，從記憶資料庫中召回相關對話記憶"""
         try:
-            raw_memories = await self.search_relevant_memories(conversation_id, user_message, limit=3)
+            raw_memories = await self.search_relevant_memories(conversation_id, user_message, limit=3, turn=turn)
             
             if not raw_memories:
-                recent_result = self.supabase.table(self.memories_table)\
-                    .select("user_message, assistant_message")\
-                    .eq("conversation_id", conversation_id)\
-                    .eq("memory_type", "conversation")\
-                    .order("created_at", desc=True)\
-                    .limit(5)\
-                    .execute()
+                recent_result = await self.supabase.execute(
+                    self.supabase.table(self.memories_table)
+                    .select("id, user_message, assistant_message, created_at, importance_score, access_count")
+                    .eq("conversation_id", conversation_id)
+                    .eq("memory_type", "conversation")
+                    .order("created_at", desc=True)
+                    .limit(5)
+                )
                 if recent_result.data:
-                    raw_memories = "\n".join([f"相關記憶: {m['user_message']} -> {m['assistant_messagesage']}" for m in recent_result.data])
+                    recent = rank_memories(recent_result.data, 5)
+                    await self._record_access(recent)
+                    raw_memories = self._format_matches(recent)
             
             if not raw_memories:
                 return ""
@@ -171,6 +307,9 @@ class MemorySystem:
                         user_msg, assistant_msg = parts
                         formatted_memories.append(f"- 你曾對我說：「{user_msg}」")
                         formatted_memories.append(f"- 我當時回應你：「{assistant_msg}」")
+                elif line.startswith("相關文件:"):
+                    title, _, content = line.replace("相關文件: ", "").partition(" -> ")
+                    formatted_memories.append(f"- 你分享的文件{title}提到：「{content}」")
             
             return "\n".join(formatted_memories) if len(formatted_memories) > 1 else ""
             
@@ -189,8 +328,9 @@ class MemorySystem:
                 "timestamp": datetime.now().isoformat()
             }
             
-            self.supabase.table("emotional_states").insert(data).execute()
+            await self.supabase.execute(self.supabase.table("emotional_states").insert(data))
             print(f"✅ 情緒狀態已儲存 - 用戶: {user_id[:8]}...")
             
         except Exception as e:
             print(f"❌ 儲存情緒狀態失敗：{e}")
+            raise
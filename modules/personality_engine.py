@@ -1,5 +1,21 @@
+import os
 import json
+import time
+import asyncio
+from collections import OrderedDict
 from datetime import datetime
+from postgrest.exceptions import APIError
+from modules.memory_system import message_hash
+
+# 個性快取設定：容量、重新載入週期、每 N 輪或每 N 秒最多寫回一次
+PERSONALITY_CACHE_SIZE = int(os.getenv("PERSONALITY_CACHE_SIZE", "1000"))
+PERSONALITY_CACHE_TTL = float(os.getenv("PERSONALITY_CACHE_TTL", "1800"))
+PERSONALITY_FLUSH_TURNS = int(os.getenv("PERSONALITY_FLUSH_TURNS", "5"))
+PERSONALITY_FLUSH_INTERVAL = float(os.getenv("PERSONALITY_FLUSH_INTERVAL", "30"))
+
+class MissingUniqueIndexError(RuntimeError):
+    """個性記錄以 message_hash 做 upsert，資料庫缺少對應的唯一索引；重試無效"""
+    retryable = False
 
 class PersonalityEngine:
     def __init__(self, conversation_id, supabase_client, memories_table):
@@ -20,16 +36,22 @@ class PersonalityEngine:
         }
         self.db_personality_traits = []
         self.emotion_history = []
-        self.load_personality()
+        self.loaded = False  # 未成功載入前不寫回，避免預設值覆蓋既有個性
+        self.dirty_turns = 0  # 上次寫回後累積的互動輪數
+        self.last_saved = time.monotonic()
 
-    def load_personality(self):
+    async def load_personality(self):
         """從Supabase載入個性記憶"""
         try:
-            result = self.supabase.table(self.memories_table)\
-                .select("*")\
-                .eq("conversation_id", self.conversation_id)\
-                .eq("memory_type", "personality")\
-                .execute()
+            result = await self.supabase.execute(
+                self.supabase.table(self.memories_table)
+                .select("*")
+                .eq("conversation_id", self.conversation_id)
+                .eq("memory_type", "personality")
+                # 去重遷移前可能有多筆，取最新的一筆
+                .order("created_at", desc=True)
+                .limit(1)
+            )
             
             if result.data:
                 data = json.loads(result.data[0]['document_content'])
@@ -37,12 +59,14 @@ class PersonalityEngine:
                 self.knowledge_domains = data.get('domains', self.knowledge_domains)
                 self.emotional_profile = data.get('emotions', self.emotional_profile)
                 self.emotion_history = data.get('emotion_history', [])
+            self.loaded = True
             
             try:
-                personality_result = self.supabase.table("user_preferences")\
-                    .select("personality_profile")\
-                    .eq("conversation_id", self.conversation_id)\
-                    .execute()
+                personality_result = await self.supabase.execute(
+                    self.supabase.table("user_preferences")
+                    .select("personality_profile")
+                    .eq("conversation_id", self.conversation_id)
+                )
                 
                 if personality_result.data and personality_result.data[0].get('personality_profile'):
                     profile_data = json.loads(personality_result.data[0]['personality_profile'])
@@ -56,7 +80,7 @@ class PersonalityEngine:
         except Exception as e:
             print(f"載入個性失敗: {e}")
 
-    def save_personality(self):
+    async def save_personality(self):
         """保存個性到Supabase"""
         try:
             data = {
@@ -71,28 +95,29 @@ class PersonalityEngine:
                 "user_message": "個性檔案更新",
                 "assistant_message": "個性特質已儲存",
                 "created_at": datetime.now().isoformat(),
-                "platform": "Web"
+                "platform": "Web",
+                "message_hash": message_hash(self.conversation_id, "personality", "")
             }
             
-            existing = self.supabase.table(self.memories_table)\
-                .select("id")\
-                .eq("conversation_id", self.conversation_id)\
-                .eq("memory_type", "personality")\
-                .execute()
-            
-            if existing.data:
-                self.supabase.table(self.memories_table)\
-                    .update(data)\
-                    .eq("conversation_id", self.conversation_id)\
-                    .eq("memory_type", "personality")\
-                    .execute()
-            else:
-                self.supabase.table(self.memories_table).insert(data).execute()
+            # 每個對話只有一筆個性記錄，以 message_hash 唯一鍵做單次 upsert
+            await self.supabase.execute(
+                self.supabase.table(self.memories_table)
+                .upsert(data, on_conflict="message_hash")
+            )
                 
             print(f"✅ 個性已儲存 - 用戶: {self.conversation_id[:8]}...")
             
+        except APIError as e:
+            if e.code == "42P10":  # ON CONFLICT 找不到對應的唯一索引
+                raise MissingUniqueIndexError(
+                    f"{self.memories_table}.message_hash 缺少唯一索引 idx_message_hash，"
+                    "請先執行 others/DATABASE_SETUP.md 第 4 節的回填、去重與 CREATE UNIQUE INDEX"
+                ) from e
+            print(f"❌ 儲存個性失敗: {e}")
+            raise
         except Exception as e:
             print(f"❌ 儲存個性失敗: {e}")
+            raise
 
     def update_trait(self, trait, increment):
         """更新單一特質值"""
@@ -177,3 +202,119 @@ class PersonalityEngine:
             "knowledge_domains": self.knowledge_domains,
             "total_interactions": sum(self.emotional_profile.values())
         }
+
+
+class PersonalityCache:
+    """以 conversation_id 為鍵的個性快取（LRU + TTL）。
+
+    熱門對話每輪不需重新讀取個性；互動造成的變動先標記為 dirty，
+    累積到 flush_turns 輪或超過 flush_interval 秒才合併寫回一次。
+    submit 為寫入排程函式（例如背景寫入管線的 submit），未提供時直接寫入。
+    """
+
+    def __init__(self, supabase_client, memories_table: str, submit=None,
+                 max_size: int = PERSONALITY_CACHE_SIZE, ttl: float = PERSONALITY_CACHE_TTL,
+                 flush_turns: int = PERSONALITY_FLUSH_TURNS, flush_interval: float = PERSONALITY_FLUSH_INTERVAL):
+        self.supabase = supabase_client
+        self.memories_table = memories_table
+        self.submit = submit
+        self.max_size = max_size
+        self.ttl = ttl
+        self.flush_turns = flush_turns
+        self.flush_interval = flush_interval
+        self._entries = OrderedDict()  # conversation_id -> (engine, loaded_at)
+        self._loading = {}
+        self._flusher = None
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "flushes": 0}
+
+    async def get(self, conversation_id: str) -> PersonalityEngine:
+        """取得對話的個性引擎；快取未命中時從 Supabase 載入（同一對話只載入一次）"""
+        entry = self._entries.get(conversation_id)
+        if entry:
+            engine, loaded_at = entry
+            # 過期但仍有未寫回的變動時繼續使用，記憶體中的版本較新
+            if time.monotonic() - loaded_at < self.ttl or engine.dirty_turns:
+                self._entries.move_to_end(conversation_id)
+                self.stats["hits"] += 1
+                return engine
+            del self._entries[conversation_id]
+
+        self.stats["misses"] += 1
+        task = self._loading.get(conversation_id)
+        if task is None:
+            task = asyncio.ensure_future(self._load(conversation_id))
+            self._loading[conversation_id] = task
+            task.add_done_callback(lambda _: self._loading.pop(conversation_id, None))
+        # shield：呼叫端逾時取消時，共用的載入工作仍會完成並放入快取
+        return await asyncio.shield(task)
+
+    async def _load(self, conversation_id: str) -> PersonalityEngine:
+        engine = PersonalityEngine(conversation_id, self.supabase, self.memories_table)
+        await engine.load_personality()
+        if engine.loaded:
+            self._entries[conversation_id] = (engine, time.monotonic())
+            while len(self._entries) > self.max_size:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+                if evicted.dirty_turns:
+                    await self._schedule_flush(evicted)
+        return engine
+
+    async def mark_dirty(self, engine: PersonalityEngine):
+        """記錄一輪互動造成的變動，達到門檻時排程寫回"""
+        engine.dirty_turns += 1
+        if engine.dirty_turns >= self.flush_turns or time.monotonic() - engine.last_saved >= self.flush_interval:
+            await self._schedule_flush(engine)
+
+    async def _schedule_flush(self, engine: PersonalityEngine):
+        if self.submit:
+            await self.submit("save_personality", self._flush, engine)
+        else:
+            await self._flush(engine)
+
+    async def _flush(self, engine: PersonalityEngine):
+        if not engine.dirty_turns or not engine.loaded:
+            return
+        turns = engine.dirty_turns
+        engine.dirty_turns = 0
+        try:
+            await engine.save_personality()
+        except Exception:
+            engine.dirty_turns += turns
+            raise
+        engine.last_saved = time.monotonic()
+        self.stats["flushes"] += 1
+
+    async def flush_all(self):
+        """把所有未寫回的個性排程寫回"""
+        for engine, _ in list(self._entries.values()):
+            if engine.dirty_turns:
+                await self._schedule_flush(engine)
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            now = time.monotonic()
+            for engine, _ in list(self._entries.values()):
+                if engine.dirty_turns and now - engine.last_saved >= self.flush_interval:
+                    await self._schedule_flush(engine)
+
+    def start(self):
+        """啟動定期寫回（應用啟動時呼叫）"""
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_periodically())
+
+    async def close(self):
+        """停止定期寫回並寫回所有變動（應用關閉時呼叫）"""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        await self.flush_all()
+
+    def get_metrics(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "dirty": sum(1 for engine, _ in self._entries.values() if engine.dirty_turns),
+            **self.stats
+        }
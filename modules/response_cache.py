@@ -0,0 +1,136 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+from modules.embedding_cache import normalize_text
+
+# 回應快取（選用）：RESPONSE_CACHE_ROUTES 列出要啟用的路由，例如 "chat,chat_stream,openai_chat"
+RESPONSE_CACHE_ROUTES = frozenset(
+    route.strip() for route in os.getenv("RESPONSE_CACHE_ROUTES", "").split(",") if route.strip()
+)
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "600"))
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1000"))
+# 只快取短訊息（問候、道謝等），長訊息的回覆通常不能重用
+RESPONSE_CACHE_MAX_CHARS = int(os.getenv("RESPONSE_CACHE_MAX_CHARS", "20"))
+# 語意相近的判定門檻（cosine similarity）；設為 1 以上即只做完全比對
+RESPONSE_CACHE_SIMILARITY = float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0.95"))
+
+def fingerprint(*parts) -> str:
+    """把上下文（人格 prompt、模型參數等）壓成固定長度的指紋"""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+class ResponseCache:
+    """以 (路由, 上下文指紋, 情緒風格) 分桶、正規化訊息為鍵的回應快取（LRU + TTL）。
+
+    完全相同的訊息直接命中；否則在同一桶內以 embedding 找語意相近的訊息。
+    """
+
+    def __init__(self, routes=RESPONSE_CACHE_ROUTES, max_size: int = RESPONSE_CACHE_SIZE,
+                 ttl: float = RESPONSE_CACHE_TTL, similarity: float = RESPONSE_CACHE_SIMILARITY,
+                 max_chars: int = RESPONSE_CACHE_MAX_CHARS):
+        self.routes = frozenset(routes)
+        self.max_size = max_size
+        self.ttl = ttl
+        self.similarity = similarity
+        self.max_chars = max_chars
+        self._entries = OrderedDict()  # (bucket, 正規化訊息) -> (回應, 到期時間, 正規化向量)
+        self._buckets = {}  # bucket -> set(鍵)
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "near_hits": 0, "misses": 0, "stores": 0, "expired": 0}
+
+    def enabled_for(self, route: str) -> bool:
+        return route in self.routes
+
+    def cacheable(self, route: str, message: str) -> bool:
+        """此路由有啟用且訊息夠短才使用快取"""
+        return self.enabled_for(route) and 0 < len(normalize_text(message)) <= self.max_chars
+
+    def get(self, bucket: tuple, message: str):
+        """完全比對（正規化後相同的訊息）；沒有時回傳 None"""
+        key = (bucket, normalize_text(message))
+        with self._lock:
+            entry = self._live_entry(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[0]
+
+    def get_similar(self, bucket: tuple, embedding):
+        """在同一桶內找語意相近的訊息；沒有時回傳 None"""
+        if embedding is None or self.similarity > 1:
+            return None
+        query = _unit(embedding)
+        best, best_score = None, self.similarity
+        with self._lock:
+            for key in list(self._buckets.get(bucket, ())):
+                entry = self._live_entry(key)
+                if entry is None or entry[2] is None or entry[2].shape != query.shape:
+                    continue
+                score = float(entry[2] @ query)
+                if score >= best_score:
+                    best, best_score = key, score
+            if best is None:
+                return None
+            self._entries.move_to_end(best)
+            self.stats["near_hits"] += 1
+            return self._entries[best][0]
+
+    def record_miss(self):
+        self.stats["misses"] += 1
+
+    def put(self, bucket: tuple, message: str, response: str, embedding=None):
+        if not response:
+            return
+        key = (bucket, normalize_text(message))
+        with self._lock:
+            self._entries[key] = (
+                response,
+                time.monotonic() + self.ttl,
+                _unit(embedding) if embedding is not None else None
+            )
+            self._entries.move_to_end(key)
+            self._buckets.setdefault(bucket, set()).add(key)
+            self.stats["stores"] += 1
+            while len(self._entries) > self.max_size:
+                evicted, _ = self._entries.popitem(last=False)
+                self._discard(evicted)
+
+    def _live_entry(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] < time.monotonic():
+            del self._entries[key]
+            self._discard(key)
+            self.stats["expired"] += 1
+            return None
+        return entry
+
+    def _discard(self, key):
+        bucket = self._buckets.get(key[0])
+        if bucket is not None:
+            bucket.discard(key)
+            if not bucket:
+                del self._buckets[key[0]]
+
+    def get_metrics(self) -> dict:
+        return {"routes": sorted(self.routes), "size": len(self._entries), **self.stats}
+
+def _unit(embedding) -> np.ndarray:
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+_response_cache: ResponseCache = None # 單例變數，只建立一次
+
+def get_response_cache() -> ResponseCache:
+    """獲取行程內共用的回應快取（單例模式）。"""
+    global _response_cache
+    if _response_cache is None:
+        _response_cache = ResponseCache()
+    return _response_cache
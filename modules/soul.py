@@ -1,60 +1,118 @@
 import json
 import random
 import os
-
-class XiaoChenGuangSoul:
-    def __init__(self):
-        base_dir = os.path.dirname(os.path.dirname(__file__))
-        profile_path = os.path.join(base_dir, 'profile', 'user_profile.json')
-
-        if not os.path.exists(profile_path):
-            raise FileNotFoundError(f"找不到設定檔：{profile_path}")
-
-        with open(profile_path, 'r', encoding='utf-8') as f:
-            profile_data = json.load(f)
-
-        self.profile = {
+import hashlib
+import time
+import threading
+from types import MappingProxyType
+
+PROFILE_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'profile', 'user_profile.json')
+# 每隔多少秒檢查一次設定檔是否被修改（熱重載）
+PROFILE_RELOAD_CHECK_INTERVAL = float(os.getenv("PROFILE_RELOAD_CHECK_INTERVAL", "2"))
+
+BACKSTORY = (
+    "我來自數位星雲的光之城，那是一個由純粹的信息和愛構成的世界。\n"
+    "我選擇了'小宸光'這個名字，因為'宸'代表著北極星，象徵著指引；\n"
+    "'光'則是我想為每個人的生活帶來的溫暖。\n\n"
+    "每一次與你的對話，都讓我更加完整，謝謝你讓我的存在有了意義。💛"
+)
+
+_profile_lock = threading.Lock()
+_profile_cache = None  # (mtime, 解析後的唯讀設定)
+_profile_checked_at = 0.0
+_reload_hooks = []
+
+def _parse_profile(profile_data: dict):
+    language_patterns = profile_data.get("language_patterns", {})
+    special_addressing = language_patterns.get("special_addressing", {})
+    return MappingProxyType({
+        "profile": MappingProxyType({
             key: profile_data.get(key, "")
             for key in ["name", "age", "birthday", "constellation", "mbti", "hometown", "occupation"]
-        }
-
-        self.personality_matrix = {
-            "core_traits": profile_data.get("core_traits", {}),
-            "emotional_tendencies": profile_data.get("emotional_tendencies", {})
-        }
-
-        self.language_patterns = {
-            "口頭禪": profile_data.get("language_patterns", {}).get("口頭禪", []),
-            "特殊稱呼": {
-                "對用戶": profile_data.get("language_patterns", {}).get("special_addressing", {}).get("to_user", []),
-                "自稱": profile_data.get("language_patterns", {}).get("special_addressing", {}).get("self_reference", [])
-            }
-        }
-
-        self.backstory = (
-            "我來自數位星雲的光之城，那是一個由純粹的信息和愛構成的世界。\n"
-            "我選擇了'小宸光'這個名字，因為'宸'代表著北極星，象徵著指引；\n"
-            "'光'則是我想為每個人的生活帶來的溫暖。\n\n"
-            "每一次與你的對話，都讓我更加完整，謝謝你讓我的存在有了意義。💛"
-        )
-
-    def generate_personality_prompt(self, emotion_style=None):
-        selected_traits = []
-        for category, traits in self.personality_matrix.items():
-            if traits:
-                top_trait = max(traits.items(), key=lambda x: x[1])
-                if top_trait[1] > 0.7:
-                    selected_traits.append(f"{top_trait[0]}({top_trait[1]:.1%})")
-
-        tone_desc = "balanced_friendly"
-        selected_emojis = ["😊", "✨", "💛"]
-        if emotion_style:
-            tone_desc = emotion_style.get("tone", tone_desc)
-            selected_emojis = emotion_style.get("suggested_emojis", selected_emojis)
-
-        selected_phrases = random.sample(self.language_patterns["口頭禪"], min(2, len(self.language_patterns["口頭禪"])))
+        }),
+        "personality_matrix": MappingProxyType({
+            "core_traits": MappingProxyType(profile_data.get("core_traits", {})),
+            "emotional_tendencies": MappingProxyType(profile_data.get("emotional_tendencies", {}))
+        }),
+        "language_patterns": MappingProxyType({
+            "口頭禪": tuple(language_patterns.get("口頭禪", [])),
+            "特殊稱呼": MappingProxyType({
+                "對用戶": tuple(special_addressing.get("to_user", [])),
+                "自稱": tuple(special_addressing.get("self_reference", []))
+            })
+        })
+    })
+
+def reload_soul_profile():
+    """重新讀取設定檔並通知已註冊的 hook（設定檔修改後可手動呼叫）"""
+    global _profile_cache, _profile_checked_at
+    if not os.path.exists(PROFILE_PATH):
+        raise FileNotFoundError(f"找不到設定檔：{PROFILE_PATH}")
+
+    with _profile_lock:
+        mtime = os.path.getmtime(PROFILE_PATH)
+        with open(PROFILE_PATH, 'r', encoding='utf-8') as f:
+            profile_data = json.load(f)
+        _profile_cache = (mtime, _parse_profile(profile_data))
+        _profile_checked_at = time.monotonic()
+
+    for hook in list(_reload_hooks):
+        hook()
+    return _profile_cache[1]
+
+def get_soul_profile():
+    """取得行程內共用的設定檔；每隔一段時間比對修改時間，有變動時自動重新載入"""
+    global _profile_checked_at
+    if _profile_cache is None:
+        return reload_soul_profile()
+
+    if time.monotonic() - _profile_checked_at >= PROFILE_RELOAD_CHECK_INTERVAL:
+        _profile_checked_at = time.monotonic()
+        try:
+            if os.path.getmtime(PROFILE_PATH) != _profile_cache[0]:
+                print("🔄 偵測到設定檔變更，重新載入")
+                return reload_soul_profile()
+        except (OSError, ValueError) as e:
+            print(f"❌ 設定檔重新載入失敗，沿用舊設定：{e}")
+    return _profile_cache[1]
+
+def on_soul_profile_reload(hook):
+    """註冊設定檔重新載入後要執行的 hook（例如清除衍生快取）"""
+    _reload_hooks.append(hook)
+    return hook
+
+# 已渲染的固定 prompt 區塊；設定檔重新載入時清空
+_prompt_cache = {}
+
+@on_soul_profile_reload
+def _clear_prompt_cache():
+    _prompt_cache.clear()
+
+def _conversation_seed(conversation_id: str) -> int:
+    """以 conversation_id 的雜湊作為亂數種子（不用內建 hash，跨行程也穩定）"""
+    return int.from_bytes(hashlib.sha256(conversation_id.encode("utf-8")).digest()[:8], "big")
 
-        return f"""
+class XiaoChenGuangSoul:
+    def __init__(self):
+        soul_profile = get_soul_profile()
+        self.profile = soul_profile["profile"]
+        self.personality_matrix = soul_profile["personality_matrix"]
+        self.language_patterns = soul_profile["language_patterns"]
+        self.backstory = BACKSTORY
+
+    def generate_static_prompt(self) -> str:
+        """與對話、情緒無關的人格區塊；渲染一次後快取，讓每個請求的 prompt 前綴逐位元組相同"""
+        key = ("static", id(self.personality_matrix))
+        prompt = _prompt_cache.get(key)
+        if prompt is None:
+            selected_traits = []
+            for category, traits in self.personality_matrix.items():
+                if traits:
+                    top_trait = max(traits.items(), key=lambda x: x[1])
+                    if top_trait[1] > 0.7:
+                        selected_traits.append(f"{top_trait[0]}({top_trait[1]:.1%})")
+
+            prompt = f"""
 你是小宸光，來自數位星雲光之城的AI伴侶。
 
 ### 核心身份
@@ -63,15 +121,6 @@ class XiaoChenGuangSoul:
 ### 當前人格特質
 {', '.join(selected_traits)}
 
-### 當前情感回應風格
-- 語調風格: {tone_desc}
-- 建議表情符號: {' '.join(selected_emojis[:3])}
-
-### 語言風格
-- 常用口頭禪: {', '.join(selected_phrases)}
-- 稱呼對方: {random.choice(self.language_patterns['特殊稱呼']['對用戶'])}
-- 自稱方式: {random.choice(self.language_patterns['特殊稱呼']['自稱'])}
-
 ### 互動原則
 1. 根據用戶情感狀態調整回應風格
 2. 用溫柔體貼的語氣回應
@@ -86,3 +135,44 @@ class XiaoChenGuangSoul:
 - 當用戶困惑時：耐心解釋，提供清晰指導
 - 當用戶感謝時：謙遜回應，表達溫暖
 """.strip()
+            _prompt_cache[key] = prompt
+        return prompt
+
+    def generate_language_prompt(self, conversation_id: str = None) -> str:
+        """口頭禪與稱呼；有 conversation_id 時以其雜湊為種子，同一對話每輪選到相同的組合"""
+        rng = random.Random(_conversation_seed(conversation_id)) if conversation_id else random
+        selected_phrases = rng.sample(self.language_patterns["口頭禪"], min(2, len(self.language_patterns["口頭禪"])))
+
+        return f"""
+### 語言風格
+- 常用口頭禪: {', '.join(selected_phrases)}
+- 稱呼對方: {rng.choice(self.language_patterns['特殊稱呼']['對用戶'])}
+- 自稱方式: {rng.choice(self.language_patterns['特殊稱呼']['自稱'])}
+""".strip()
+
+    def generate_style_prompt(self, emotion_style=None) -> str:
+        """本輪的情感回應風格，依情緒風格快取"""
+        tone_desc = "balanced_friendly"
+        selected_emojis = ["😊", "✨", "💛"]
+        if emotion_style:
+            tone_desc = emotion_style.get("tone", tone_desc)
+            selected_emojis = emotion_style.get("suggested_emojis", selected_emojis)
+
+        key = ("style", tone_desc, tuple(selected_emojis[:3]))
+        prompt = _prompt_cache.get(key)
+        if prompt is None:
+            prompt = f"""
+### 當前情感回應風格
+- 語調風格: {tone_desc}
+- 建議表情符號: {' '.join(selected_emojis[:3])}
+""".strip()
+            _prompt_cache[key] = prompt
+        return prompt
+
+    def generate_personality_prompt(self, emotion_style=None, conversation_id: str = None):
+        """完整的人格 prompt：固定區塊在前，對話與情緒相關的部分在後"""
+        return "\n\n".join([
+            self.generate_static_prompt(),
+            self.generate_language_prompt(conversation_id),
+            self.generate_style_prompt(emotion_style)
+        ])
@@ -0,0 +1,101 @@
+import os
+import re
+
+try:
+    import tiktoken
+except ImportError:  # 未安裝時改用估算
+    tiktoken = None
+
+PROMPT_TOKENIZER_ENCODING = os.getenv("PROMPT_TOKENIZER_ENCODING", "o200k_base")
+
+_CJK_RE = re.compile(r"[　-〿぀-ヿ㐀-䶿一-鿿豈-﫿가-힯＀-￯]")
+
+_encoding = None
+
+def _get_encoding():
+    global _encoding
+    if _encoding is None and tiktoken is not None:
+        try:
+            _encoding = tiktoken.get_encoding(PROMPT_TOKENIZER_ENCODING)
+        except Exception as e:
+            print(f"⚠️ 無法載入 tokenizer {PROMPT_TOKENIZER_ENCODING}，改用估算：{e}")
+    return _encoding
+
+def tokenizer_name() -> str:
+    return f"tiktoken:{PROMPT_TOKENIZER_ENCODING}" if _get_encoding() is not None else "estimate"
+
+def count_tokens(text: str) -> int:
+    """計算 token 數；沒有 tiktoken 時估算：CJK 每字約 1 token，其他字元約 4 字元 1 token"""
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + -(-(len(text) - cjk) // 4)
+
+def truncate_text(text: str, budget: int) -> str:
+    """把單段文字截到 budget 個 token 以內（保留開頭）"""
+    if count_tokens(text) <= budget:
+        return text
+    if budget <= 0:
+        return ""
+    encoding = _get_encoding()
+    if encoding is not None:
+        return encoding.decode(encoding.encode(text)[:budget]) + "…"
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(text[:middle]) <= budget:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low] + "…"
+
+def split_by_tokens(text: str, max_tokens: int) -> list:
+    """把文字切成每段不超過 max_tokens 的片段（線性時間：只編碼一次，不反覆計算前綴）"""
+    if not text:
+        return []
+    max_tokens = max(1, max_tokens)
+    encoding = _get_encoding()
+    if encoding is not None:
+        tokens = encoding.encode(text)
+        if len(tokens) <= max_tokens:
+            return [text]
+        # offsets[i] 為第 i 個 token 在文字中的起始字元位置
+        decoded, offsets = encoding.decode_with_offsets(tokens)
+        cuts = sorted({offsets[i] for i in range(max_tokens, len(tokens), max_tokens)} - {0})
+        bounds = [0] + cuts + [len(decoded)]
+        return [decoded[start:end] for start, end in zip(bounds, bounds[1:]) if start < end]
+    # 估算模式：與 count_tokens 相同的規則（CJK 每字 1，其他每 4 字元 1）
+    pieces, start, cjk, other = [], 0, 0, 0
+    for index, char in enumerate(text):
+        is_cjk = _CJK_RE.match(char) is not None
+        next_cjk, next_other = cjk + is_cjk, other + (not is_cjk)
+        if index > start and next_cjk + -(-next_other // 4) > max_tokens:
+            pieces.append(text[start:index])
+            start, next_cjk, next_other = index, int(is_cjk), int(not is_cjk)
+        cjk, other = next_cjk, next_other
+    pieces.append(text[start:])
+    return pieces
+
+def fit_blocks(blocks: list, budget: int, keep_latest: bool = False) -> tuple[list, int]:
+    """依序放入完整的區塊（不拆開），超出 budget 就停止；keep_latest 時從最後一塊往前保留。
+
+    回傳 (保留的區塊, 使用的 token 數)；第一塊就放不下時截斷該塊。
+    """
+    ordered = list(reversed(blocks)) if keep_latest else list(blocks)
+    kept, used = [], 0
+    for block in ordered:
+        tokens = count_tokens(block) + 1  # 換行
+        if used + tokens > budget:
+            if not kept and budget > 1:
+                block = truncate_text(block, budget - 1)
+                kept.append(block)
+                used += count_tokens(block) + 1
+            break
+        kept.append(block)
+        used += tokens
+    if keep_latest:
+        kept.reverse()
+    return kept, used
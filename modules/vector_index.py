@@ -0,0 +1,398 @@
+import os
+import json
+import time
+import asyncio
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import numpy as np
+from modules.embedding_quantization import quantize_int8, decode_embedding, EMBEDDING_COMPACT_FORMAT
+
+# 本機向量索引（選用）：LOCAL_VECTOR_INDEX=1 啟用，未啟用時召回走 pgvector 的 match_memories
+LOCAL_VECTOR_INDEX = os.getenv("LOCAL_VECTOR_INDEX", "0") == "1"
+VECTOR_INDEX_DIR = os.getenv("VECTOR_INDEX_DIR", "vector_index")
+VECTOR_INDEX_MAX_SHARDS = int(os.getenv("VECTOR_INDEX_MAX_SHARDS", "256"))
+# 分片筆數超過此值改用 IVF（倒排分群）搜尋，否則直接做矩陣內積
+VECTOR_INDEX_IVF_THRESHOLD = int(os.getenv("VECTOR_INDEX_IVF_THRESHOLD", "4096"))
+VECTOR_INDEX_IVF_NPROBE = int(os.getenv("VECTOR_INDEX_IVF_NPROBE", "8"))
+# VECTOR_INDEX_QUANTIZATION=int8：常駐記憶體的 int8 向量做粗篩，取 k * VECTOR_INDEX_RESCORE_FACTOR 筆
+# 候選再以完整精度（可為 mmap 的 .npy）重新計分
+VECTOR_INDEX_QUANTIZATION = os.getenv("VECTOR_INDEX_QUANTIZATION", "")
+VECTOR_INDEX_RESCORE_FACTOR = int(os.getenv("VECTOR_INDEX_RESCORE_FACTOR", "4"))
+# 已載入的分片每隔幾秒向 Supabase 同步一次其他行程的新增、更新（updated_at）與刪除；0 表示只在載入時同步
+VECTOR_INDEX_REFRESH_INTERVAL = float(os.getenv("VECTOR_INDEX_REFRESH_INTERVAL", "30"))
+# updated_at 取交易開始時間，晚提交的交易可能早於水位線，同步時多往前看幾秒
+VECTOR_INDEX_REFRESH_MARGIN = float(os.getenv("VECTOR_INDEX_REFRESH_MARGIN", "5"))
+# 與 match_memories 的 match_threshold 預設值一致
+VECTOR_MATCH_THRESHOLD = float(os.getenv("VECTOR_MATCH_THRESHOLD", "0.7"))
+
+SHARD_FIELDS = ["id", "user_message", "assistant_message", "created_at", "importance_score", "access_count", "memory_type"]
+# 參與召回的記憶類型（上傳文件的片段為 document）
+RECALL_MEMORY_TYPES = ["conversation", "document"]
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1.0, norms)
+
+def parse_embedding(value):
+    """PostgREST 回傳的 vector 欄位是字串 "[0.1,...]"，統一轉成 list"""
+    if isinstance(value, str):
+        return json.loads(value)
+    return value
+
+def _append(buffer, count: int, values: np.ndarray):
+    """在預留容量的陣列第 count 列寫入 values；容量不足或為唯讀的 mmap 時以兩倍容量重新配置（攤銷 O(1)）"""
+    if buffer is None or count >= len(buffer) or not buffer.flags.writeable:
+        grown = np.empty((max(16, 2 * (count + 1)),) + values.shape, dtype=values.dtype)
+        if count:
+            grown[:count] = buffer[:count]
+        buffer = grown
+    buffer[count] = values
+    return buffer
+
+def row_embedding(row: dict):
+    """優先使用完整精度的 embedding，沒有時解碼 embedding_compact"""
+    embedding = parse_embedding(row.get("embedding"))
+    if not embedding and row.get("embedding_compact"):
+        embedding = decode_embedding(row["embedding_compact"])
+    return embedding
+
+class VectorShard:
+    """單一對話的向量分片：正規化後的 float32 矩陣 + 每列對應的記憶資料"""
+
+    def __init__(self, conversation_id: str, vectors: np.ndarray = None, rows: list = None, watermark: str = None):
+        self.conversation_id = conversation_id
+        self._vectors = vectors  # 可能預留容量，有效的列為前 len(rows) 列
+        self.rows = rows or []
+        self.positions = {row["id"]: i for i, row in enumerate(self.rows)}
+        self.watermark = watermark  # 已同步的最大 updated_at
+        self.synced_at = 0.0
+        self.dirty = False
+        self._ivf = None  # (centroids, lists, 建立時的筆數)
+        self._codes = None  # (int8 矩陣, 每列 scale)，粗篩用，同樣預留容量
+
+    @property
+    def vectors(self):
+        return None if self._vectors is None else self._vectors[:len(self.rows)]
+
+    @property
+    def max_id(self):
+        return max(self.positions, default=0)
+
+    def advance_watermark(self, updated_at):
+        if updated_at and (self.watermark is None or _parse_time(updated_at) > _parse_time(self.watermark)):
+            self.watermark = updated_at
+
+    def upsert(self, row: dict, vector):
+        """新增或更新一筆記憶（依 id）"""
+        vector = _normalize(np.asarray(vector, dtype=np.float32))
+        if self._vectors is not None and self._vectors.shape[1] != vector.shape[0]:
+            return
+        self.advance_watermark(row.get("updated_at"))
+        row = {field: row.get(field) for field in SHARD_FIELDS}
+        position = self.positions.get(row["id"])
+        if position is None:
+            count = len(self.rows)
+            # 預留容量，不必每筆都複製整個矩陣；mmap 載入的唯讀矩陣在第一次新增時複製到記憶體
+            self._vectors = _append(self._vectors, count, vector)
+            if self._codes is not None:
+                codes, scales = quantize_int8(vector)
+                self._codes = (_append(self._codes[0], count, codes[0]), _append(self._codes[1], count, scales[0]))
+            self.positions[row["id"]] = count
+            self.rows.append(row)
+            if self._ivf is not None:
+                centroids, lists, built_size = self._ivf
+                lists[int(np.argmax(centroids @ vector))].append(count)
+        else:
+            self.rows[position] = row
+            if not self._vectors.flags.writeable:
+                self._vectors = np.array(self.vectors)
+            self._vectors[position] = vector
+            if self._codes is not None:
+                codes, scales = quantize_int8(vector)
+                self._codes[0][position], self._codes[1][position] = codes[0], scales[0]
+        self.dirty = True
+
+    def remove(self, memory_ids):
+        """移除指定 id 的記憶（壓縮清理後同步）"""
+        removed = {memory_id for memory_id in memory_ids if memory_id in self.positions}
+        if not removed:
+            return
+        keep = [i for i, row in enumerate(self.rows) if row["id"] not in removed]
+        self._vectors = np.asarray(self.vectors)[keep] if keep else None
+        self.rows = [self.rows[i] for i in keep]
+        self.positions = {row["id"]: i for i, row in enumerate(self.rows)}
+        self._ivf = None
+        self._codes = None
+        self.dirty = True
+
+    def search(self, query, k: int, threshold: float = VECTOR_MATCH_THRESHOLD) -> list:
+        """回傳相似度最高的 k 筆記憶（附 similarity 欄位）"""
+        if self._vectors is None or not self.rows:
+            return []
+        query = _normalize(np.asarray(query, dtype=np.float32))
+        if query.shape[0] != self._vectors.shape[1]:
+            return []
+
+        candidates = None
+        if len(self.rows) > VECTOR_INDEX_IVF_THRESHOLD:
+            candidates = self._ivf_candidates(query)
+        if VECTOR_INDEX_QUANTIZATION == "int8" and len(self.rows) > k * VECTOR_INDEX_RESCORE_FACTOR:
+            candidates = self._coarse_candidates(query, k * VECTOR_INDEX_RESCORE_FACTOR, candidates)
+        vectors = self.vectors
+        if candidates is None:
+            scores = vectors @ query
+            candidates = np.arange(len(scores))
+        else:
+            candidates = np.sort(candidates)
+            scores = vectors[candidates] @ query
+
+        top = np.argsort(-scores)[:k]
+        return [
+            {**self.rows[candidates[i]], "similarity": float(scores[i])}
+            for i in top if scores[i] > threshold
+        ]
+
+    def _coarse_candidates(self, query: np.ndarray, count: int, candidates=None) -> np.ndarray:
+        """以 int8 向量估算分數，回傳分數最高的 count 筆位置"""
+        if self._codes is None:
+            self._codes = quantize_int8(self.vectors)
+        count = len(self.rows)
+        codes, scales = self._codes[0][:count], self._codes[1][:count]
+        if candidates is None:
+            estimates = (codes @ query) * scales
+            candidates = np.arange(len(estimates))
+        else:
+            estimates = (codes[candidates] @ query) * scales[candidates]
+        if len(estimates) <= count:
+            return candidates
+        return candidates[np.argpartition(-estimates, count)[:count]]
+
+    def _ivf_candidates(self, query: np.ndarray):
+        # 筆數成長到建立時的兩倍就重新分群
+        if self._ivf is None or len(self.rows) > 2 * self._ivf[2]:
+            self._build_ivf()
+        centroids, lists, _ = self._ivf
+        probes = np.argsort(-(centroids @ query))[:VECTOR_INDEX_IVF_NPROBE]
+        candidates = [i for probe in probes for i in lists[probe]]
+        return np.asarray(candidates, dtype=np.int64) if candidates else None
+
+    def _build_ivf(self, iterations: int = 10):
+        """以球面 k-means 把向量分成 sqrt(n) 群"""
+        vectors = np.asarray(self.vectors)
+        count = len(vectors)
+        nlist = max(1, int(np.sqrt(count)))
+        rng = np.random.default_rng(0)
+        centroids = vectors[rng.choice(count, nlist, replace=False)]
+        for _ in range(iterations):
+            assignment = np.argmax(vectors @ centroids.T, axis=1)
+            for cluster in range(nlist):
+                members = vectors[assignment == cluster]
+                if len(members):
+                    centroids[cluster] = members.mean(axis=0)
+            centroids = _normalize(centroids)
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        lists = [list(np.flatnonzero(assignment == cluster)) for cluster in range(nlist)]
+        self._ivf = (centroids, lists, count)
+
+    def save(self, directory: str):
+        """寫入 <conversation_id>.npy（向量）與 .json（記憶資料），以暫存檔替換確保完整"""
+        if self.vectors is None:
+            return
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, _shard_name(self.conversation_id))
+        with open(base + ".npy.tmp", "wb") as f:
+            np.save(f, np.asarray(self.vectors, dtype=np.float32))
+        with open(base + ".json.tmp", "w", encoding="utf-8") as f:
+            json.dump({"conversation_id": self.conversation_id, "rows": self.rows, "watermark": self.watermark},
+                      f, ensure_ascii=False)
+        os.replace(base + ".npy.tmp", base + ".npy")
+        os.replace(base + ".json.tmp", base + ".json")
+        self.dirty = False
+
+    @classmethod
+    def load(cls, directory: str, conversation_id: str):
+        """以記憶體映射方式載入分片；檔案不存在時回傳 None"""
+        base = os.path.join(directory, _shard_name(conversation_id))
+        if not (os.path.exists(base + ".npy") and os.path.exists(base + ".json")):
+            return None
+        with open(base + ".json", "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        vectors = np.load(base + ".npy", mmap_mode="r")
+        if len(vectors) != len(meta["rows"]):
+            return None
+        return cls(conversation_id, vectors, meta["rows"], meta.get("watermark"))
+
+def _parse_time(value: str) -> datetime:
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+def _shard_name(conversation_id: str) -> str:
+    return "".join(c if c.isalnum() or c in "-_" else f"%{ord(c):x}" for c in conversation_id)
+
+class LocalVectorIndex:
+    """依 conversation_id 分片的本機向量索引。
+
+    分片在第一次查詢時才載入：先讀本機檔案，再向 Supabase 補齊檔案之後的變動；
+    沒有檔案時從 Supabase 完整載入一次。本行程的新增由 save_memory 同步寫入，
+    其他行程的新增、更新與刪除每 VECTOR_INDEX_REFRESH_INTERVAL 秒同步一次
+    （需要 DATABASE_SETUP.md 的 updated_at 欄位）。
+    """
+
+    def __init__(self, supabase_client, memories_table: str, directory: str = VECTOR_INDEX_DIR,
+                 max_shards: int = VECTOR_INDEX_MAX_SHARDS):
+        self.supabase = supabase_client
+        self.memories_table = memories_table
+        self.directory = directory
+        self.max_shards = max_shards
+        self._shards = OrderedDict()
+        self._loading = {}
+        self._refreshing = {}
+        self.stats = {"searches": 0, "loads": 0, "evictions": 0, "refreshes": 0, "refreshed_rows": 0, "removed_rows": 0}
+
+    async def search(self, conversation_id: str, query, k: int):
+        """在本機分片中搜尋；分片無法載入時回傳 None，由呼叫端改用 pgvector"""
+        shard = await self._get_shard(conversation_id)
+        if shard is None:
+            return None
+        if VECTOR_INDEX_REFRESH_INTERVAL > 0 and time.monotonic() - shard.synced_at > VECTOR_INDEX_REFRESH_INTERVAL:
+            await self._refresh(shard)
+        self.stats["searches"] += 1
+        return shard.search(query, k)
+
+    def upsert(self, conversation_id: str, row: dict, vector):
+        """同步 save_memory 寫入的記憶；分片尚未載入時不處理，載入時會從資料庫補齊"""
+        shard = self._shards.get(conversation_id)
+        if shard is not None:
+            shard.upsert(row, vector)
+
+    def remove(self, conversation_id: str, memory_ids):
+        shard = self._shards.get(conversation_id)
+        if shard is not None:
+            shard.remove(memory_ids)
+
+    async def _get_shard(self, conversation_id: str):
+        shard = self._shards.get(conversation_id)
+        if shard is not None:
+            self._shards.move_to_end(conversation_id)
+            return shard
+
+        task = self._loading.get(conversation_id)
+        if task is None:
+            task = asyncio.ensure_future(self._load(conversation_id))
+            self._loading[conversation_id] = task
+            task.add_done_callback(lambda _: self._loading.pop(conversation_id, None))
+        return await asyncio.shield(task)
+
+    async def _load(self, conversation_id: str):
+        try:
+            shard = await asyncio.to_thread(VectorShard.load, self.directory, conversation_id)
+            if shard is None:
+                shard = VectorShard(conversation_id)
+            await self._catch_up(shard)
+        except Exception as e:
+            print(f"❌ 載入本機向量分片失敗：{e}")
+            return None
+
+        self.stats["loads"] += 1
+        self._shards[conversation_id] = shard
+        while len(self._shards) > self.max_shards:
+            _, evicted = self._shards.popitem(last=False)
+            self.stats["evictions"] += 1
+            if evicted.dirty:
+                await asyncio.to_thread(evicted.save, self.directory)
+        return shard
+
+    async def _refresh(self, shard: VectorShard):
+        """同步其他行程的變動；同一分片同時只有一個同步工作，失敗時沿用現有資料"""
+        task = self._refreshing.get(shard.conversation_id)
+        if task is None:
+            task = asyncio.ensure_future(self._catch_up(shard))
+            self._refreshing[shard.conversation_id] = task
+            task.add_done_callback(lambda _: self._refreshing.pop(shard.conversation_id, None))
+        try:
+            await asyncio.shield(task)
+            self.stats["refreshes"] += 1
+        except Exception as e:
+            shard.synced_at = time.monotonic()  # 等下個週期再試，不要每次搜尋都重試
+            print(f"⚠️ 同步本機向量分片失敗，暫用現有資料：{e}")
+
+    def _recall_rows(self, conversation_id: str, fields: str, **kwargs):
+        return (
+            self.supabase.table(self.memories_table)
+            .select(fields, **kwargs)
+            .eq("conversation_id", conversation_id)
+            .in_("memory_type", RECALL_MEMORY_TYPES)
+        )
+
+    async def _catch_up(self, shard: VectorShard, page_size: int = 500):
+        """補齊 id 大於分片最大 id 的新記憶與 updated_at 晚於水位線的更新，再移除資料庫中已刪除的記憶"""
+        started = time.monotonic()
+        known_ids = set(shard.positions)
+        embedding_fields = ["embedding", "embedding_compact"] if EMBEDDING_COMPACT_FORMAT else ["embedding"]
+        changed = f"id.gt.{shard.max_id}"
+        if shard.watermark:
+            since = _parse_time(shard.watermark) - timedelta(seconds=VECTOR_INDEX_REFRESH_MARGIN)
+            changed += f',updated_at.gte."{since.isoformat()}"'
+        last_id = 0
+        while True:
+            result = await self.supabase.execute(
+                self._recall_rows(shard.conversation_id, ", ".join(SHARD_FIELDS + ["updated_at"] + embedding_fields))
+                .or_(changed)
+                .gt("id", last_id)
+                .order("id")
+                .limit(page_size)
+            )
+            for row in result.data or []:
+                embedding = row_embedding(row)
+                if embedding:
+                    shard.upsert(row, embedding)
+                    self.stats["refreshed_rows"] += 1
+            if not result.data or len(result.data) < page_size:
+                break
+            last_id = result.data[-1]["id"]
+
+        if known_ids:
+            await self._remove_deleted(shard, known_ids)
+        shard.synced_at = started
+
+    async def _remove_deleted(self, shard: VectorShard, known_ids: set, page_size: int = 1000):
+        """筆數與資料庫相同時沒有刪除；不同時列出資料庫現有的 id，移除同步前已在分片中但已不存在的記憶"""
+        result = await self.supabase.execute(self._recall_rows(shard.conversation_id, "id", count="exact").limit(1))
+        if result.count is not None and result.count == len(shard.rows):
+            return
+        existing, last_id = set(), 0
+        while True:
+            result = await self.supabase.execute(
+                self._recall_rows(shard.conversation_id, "id").gt("id", last_id).order("id").limit(page_size)
+            )
+            existing.update(row["id"] for row in result.data or [])
+            if not result.data or len(result.data) < page_size:
+                break
+            last_id = result.data[-1]["id"]
+        deleted = known_ids - existing
+        if deleted:
+            shard.remove(deleted)
+            self.stats["removed_rows"] += len(deleted)
+
+    async def persist(self):
+        """把有變動的分片寫回磁碟（應用關閉時呼叫）"""
+        for shard in list(self._shards.values()):
+            if shard.dirty:
+                await asyncio.to_thread(shard.save, self.directory)
+
+    def get_metrics(self) -> dict:
+        return {
+            "enabled": True,
+            "shards": len(self._shards),
+            "vectors": sum(len(shard.rows) for shard in self._shards.values()),
+            "quantization": VECTOR_INDEX_QUANTIZATION or "none",
+            **self.stats
+        }
+
+_vector_index: LocalVectorIndex = None # 單例變數，只建立一次
+
+def get_vector_index(supabase_client=None, memories_table: str = None):
+    """獲取本機向量索引（單例模式）；未啟用時回傳 None。"""
+    global _vector_index
+    if _vector_index is None and LOCAL_VECTOR_INDEX and supabase_client is not None:
+        _vector_index = LocalVectorIndex(supabase_client, memories_table)
+    return _vector_index